@@ -0,0 +1,301 @@
+import os
+import sys
+import json
+import argparse
+import glob
+import itertools
+import random
+import shutil
+import subprocess
+import tempfile
+import time
+from typing import Dict, List, Any
+
+SOURCE_TEMPLATES = {
+    ".py": (
+        "class Widget{n}:\n"
+        "    def __init__(self, value):\n"
+        "        self.value = value\n\n"
+        "    def render(self):\n"
+        "        return f'<widget {{self.value}}>'\n\n\n"
+        "def helper_{n}(items):\n"
+        "    return [item * {n} for item in items if item]\n\n\n"
+    ),
+    ".go": (
+        "type Widget{n} struct {{\n\tValue int\n}}\n\n"
+        "func (w *Widget{n}) Render() string {{\n\treturn fmt.Sprintf(\"<widget %d>\", w.Value)\n}}\n\n"
+        "func Helper{n}(items []int) int {{\n\treturn len(items) * {n}\n}}\n\n"
+    ),
+    ".java": (
+        "    public static class Widget{n} {{\n"
+        "        private final int value;\n\n"
+        "        public Widget{n}(int value) {{\n            this.value = value;\n        }}\n\n"
+        "        public String render() {{\n            return \"<widget \" + value + \">\";\n        }}\n"
+        "    }}\n\n"
+    ),
+}
+
+
+def generate_source(extension: str, size: int, rng: random.Random) -> str:
+    template = SOURCE_TEMPLATES[extension]
+    body = []
+    length = 0
+    while length < size:
+        block = template.format(n=rng.randint(0, 99999))
+        body.append(block)
+        length += len(block)
+    if extension == ".go":
+        return "package main\n\nimport \"fmt\"\n\n" + "".join(body)
+    if extension == ".java":
+        return "public class Generated {\n" + "".join(body) + "}\n"
+    return "".join(body)
+
+
+def generate_tree(
+    root: str,
+    files: int,
+    depth: int,
+    fanout: int,
+    file_size: int,
+    extensions: List[str],
+    seed: int,
+) -> List[str]:
+    # Files are spread over a directory tree `depth` levels deep with `fanout`
+    # subdirectories per level. Sizes vary around file_size, with the odd large file.
+    rng = random.Random(seed)
+    directories = [root]
+    level = [root]
+    for _ in range(depth):
+        level = [
+            os.path.join(parent, f"dir{i}") for parent in level for i in range(fanout)
+        ]
+        directories.extend(level)
+    for directory in directories:
+        os.makedirs(directory, exist_ok=True)
+
+    paths = []
+    for n in range(files):
+        extension = extensions[n % len(extensions)]
+        size = int(file_size * rng.lognormvariate(0, 0.75))
+        path = os.path.join(rng.choice(directories), f"file{n}{extension}")
+        with open(path, "w") as f:
+            f.write(generate_source(extension, size, rng))
+        paths.append(path)
+    return paths
+
+
+def directory_size(path: str) -> int:
+    return sum(
+        os.path.getsize(os.path.join(directory, name))
+        for directory, _, names in os.walk(path)
+        for name in names
+    )
+
+
+def run_pipeline(
+    tree: str, config: Dict[str, Any], work_dir: str, label: str
+) -> Dict[str, Any]:
+    output_dir = os.path.join(work_dir, f"output-{label}")
+    config = {**config, "output_dir": output_dir}
+    config_file = os.path.join(work_dir, f"config-{label}.json")
+    with open(config_file, "w") as f:
+        json.dump(config, f)
+
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "treesummary.py")
+    log_file = os.path.join(work_dir, f"log-{label}.txt")
+    start = time.monotonic()
+    with open(log_file, "w") as log:
+        process = subprocess.Popen(
+            [sys.executable, script, tree, "--config", config_file, "--restart", "--no-cache"],
+            stdout=log,
+            stderr=subprocess.STDOUT,
+            stdin=subprocess.DEVNULL,
+        )
+        # wait4 gives the resource usage of this run alone, unlike RUSAGE_CHILDREN
+        _, status, rusage = os.wait4(process.pid, 0)
+    wall_time = time.monotonic() - start
+    if os.waitstatus_to_exitcode(status) != 0:
+        raise RuntimeError(f"Run {label} failed, see {log_file}")
+
+    # ru_maxrss is in kilobytes on Linux and bytes on macOS
+    peak_rss = rusage.ru_maxrss * (1 if sys.platform == "darwin" else 1024)
+    with open(sorted(glob.glob(os.path.join(output_dir, "run_report_*.json")))[-1]) as f:
+        report = json.load(f)
+    timings = report["timings_s"]
+    calls = report["model_calls"]
+    state_file = os.path.join(output_dir, "treesummary_state.db")
+    return {
+        "parallel": config["parallel"],
+        "supersummary_interval": config["supersummary_interval"],
+        "wall_time_s": wall_time,
+        "peak_rss_mb": peak_rss / 1024 / 1024,
+        "state_write_s": timings.get("state_write", {}).get("total", 0),
+        "output_write_s": timings.get("output_write", {}).get("total", 0),
+        "state_mb": (
+            sum(
+                os.path.getsize(path)
+                for path in glob.glob(state_file + "*")
+            )
+            / 1024
+            / 1024
+        ),
+        "output_mb": directory_size(output_dir) / 1024 / 1024,
+        "block_reads": rusage.ru_inblock,
+        "block_writes": rusage.ru_oublock,
+        "model_calls": sum(stage["calls"] for stage in calls.values()),
+        "throttled": sum(
+            stage["outcomes"].get("throttled", 0) for stage in calls.values()
+        ),
+        "file_latency_p50_s": calls.get("files", {}).get("latency_s", {}).get("p50"),
+        "file_latency_p99_s": calls.get("files", {}).get("latency_s", {}).get("p99"),
+    }
+
+
+def parse_int_list(value: str) -> List[int]:
+    return [int(v) for v in value.split(",") if v]
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Benchmark the TreeSummary pipeline against a simulated model backend"
+    )
+    parser.add_argument("--files", type=int, default=500, help="Number of files to generate")
+    parser.add_argument("--depth", type=int, default=3, help="Directory depth of the tree")
+    parser.add_argument("--fanout", type=int, default=4, help="Subdirectories per directory")
+    parser.add_argument(
+        "--file-size", type=int, default=2000, help="Median file size in bytes"
+    )
+    parser.add_argument(
+        "--extensions", default=".py,.go,.java", help="Comma separated file extensions"
+    )
+    parser.add_argument(
+        "--latency-ms", type=float, default=200, help="Simulated latency per request"
+    )
+    parser.add_argument(
+        "--jitter-ms", type=float, default=50, help="Random variation in the latency"
+    )
+    parser.add_argument(
+        "--throttle-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests to answer with a ThrottlingException",
+    )
+    parser.add_argument(
+        "--latency-per-1k-tokens-ms",
+        type=float,
+        default=0,
+        help="Simulated latency added per 1,000 input tokens",
+    )
+    parser.add_argument(
+        "--straggler-rate",
+        type=float,
+        default=0.0,
+        help="Fraction of requests that take ten times as long",
+    )
+    parser.add_argument(
+        "--response-tokens", type=int, default=300, help="Approximate size of each response"
+    )
+    parser.add_argument(
+        "--parallel", default="1,4,16", help="Comma separated parallel settings to run"
+    )
+    parser.add_argument(
+        "--interval",
+        default="50",
+        help="Comma separated supersummary_interval settings to run",
+    )
+    parser.add_argument(
+        "--async-requests", action="store_true", help="Use the asyncio request path"
+    )
+    parser.add_argument(
+        "--config",
+        default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "config.json"),
+        help="Base configuration file",
+    )
+    parser.add_argument("--seed", type=int, default=0, help="Seed for the tree and backend")
+    parser.add_argument("--output", help="Write the results as JSON to this file")
+    parser.add_argument(
+        "--keep", action="store_true", help="Keep the generated tree and run outputs"
+    )
+    args = parser.parse_args()
+
+    with open(args.config, "r") as config_file:
+        base_config = json.load(config_file)
+    base_config.update(
+        {
+            "backend": "stub",
+            "backends": {},
+            "stub_latency_ms": args.latency_ms,
+            "stub_jitter_ms": args.jitter_ms,
+            "stub_throttle_rate": args.throttle_rate,
+            "stub_response_tokens": args.response_tokens,
+            "stub_seed": args.seed,
+            "stub_latency_per_1k_tokens_ms": args.latency_per_1k_tokens_ms,
+            "stub_straggler_rate": args.straggler_rate,
+            "async_requests": args.async_requests,
+            "batch_inference": False,
+            "limit": 0,
+            "max_cost_usd": 0,
+            "verbose": False,
+        }
+    )
+
+    work_dir = tempfile.mkdtemp(prefix="treesummary-benchmark-")
+    tree = os.path.join(work_dir, "tree")
+    extensions = [e.strip() for e in args.extensions.split(",") if e.strip()]
+    generate_tree(
+        tree,
+        args.files,
+        args.depth,
+        args.fanout,
+        args.file_size,
+        extensions,
+        args.seed,
+    )
+    base_config["file_extensions"] = extensions
+    print(
+        f"Generated {args.files} files ({directory_size(tree) / 1024 / 1024:.1f} MB) under {tree}"
+    )
+
+    results = []
+    for parallel, interval in itertools.product(
+        parse_int_list(args.parallel), parse_int_list(args.interval)
+    ):
+        label = f"p{parallel}-i{interval}"
+        print(f"Running with parallel={parallel}, supersummary_interval={interval}...")
+        config = {
+            **base_config,
+            "parallel": parallel,
+            "max_in_flight_requests": parallel,
+            "supersummary_interval": interval,
+        }
+        # A failed run leaves the benchmark files in place so its log can be read
+        result = run_pipeline(tree, config, work_dir, label)
+        result["files_per_sec"] = args.files / result["wall_time_s"]
+        results.append(result)
+
+    if args.keep:
+        print(f"Benchmark files have been kept in {work_dir}")
+    else:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    print()
+    print(
+        f"{'parallel':>8} {'interval':>8} {'wall s':>8} {'files/s':>8} {'rss MB':>8} "
+        f"{'state s':>8} {'output s':>8} {'state MB':>8} {'calls':>6} {'throttled':>9}"
+    )
+    for r in results:
+        print(
+            f"{r['parallel']:>8} {r['supersummary_interval']:>8} {r['wall_time_s']:>8.2f} "
+            f"{r['files_per_sec']:>8.1f} {r['peak_rss_mb']:>8.1f} {r['state_write_s']:>8.3f} "
+            f"{r['output_write_s']:>8.3f} {r['state_mb']:>8.2f} {r['model_calls']:>6} "
+            f"{r['throttled']:>9}"
+        )
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump({"arguments": vars(args), "results": results}, f, indent=2)
+        print(f"Results have been saved to {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,238 @@
+import asyncio
+import hashlib
+import http.server
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from treesummary import (
+    MarkdownSink,
+    StateStore,
+    create_stage_clients,
+    hash_file,
+    process_batch,
+    process_batch_async,
+    scan_directory,
+)
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config.json")
+
+
+class FakeConverseServer(http.server.ThreadingHTTPServer):
+    """OpenAI-compatible chat completions server that records how many requests overlap."""
+
+    daemon_threads = True
+
+    def __init__(self, delay: float, throttle_first: int = 0):
+        self.delay = delay
+        self.throttle_first = throttle_first
+        self.lock = threading.Lock()
+        self.in_flight = 0
+        self.peak = 0
+        self.requests = 0
+        super().__init__(("127.0.0.1", 0), FakeConverseHandler)
+
+
+class FakeConverseHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, *args):
+        pass
+
+    def do_POST(self):
+        server = self.server
+        body = json.loads(self.rfile.read(int(self.headers["Content-Length"])))
+        with server.lock:
+            server.requests += 1
+            throttled = server.requests <= server.throttle_first
+            server.in_flight += 1
+            server.peak = max(server.peak, server.in_flight)
+        try:
+            time.sleep(server.delay)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+        if throttled:
+            self.reply(429, {"error": "slow down"})
+            return
+        prompt = body["messages"][-1]["content"]
+        self.reply(
+            200,
+            {
+                "choices": [
+                    {
+                        "message": {"content": f"Summary of {len(prompt)} characters"},
+                        "finish_reason": "stop",
+                    }
+                ],
+                "usage": {"prompt_tokens": 100, "completion_tokens": 10, "total_tokens": 110},
+            },
+        )
+
+    def reply(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+
+@pytest.fixture
+def fake_server():
+    servers = []
+
+    def start(delay=0.05, throttle_first=0):
+        server = FakeConverseServer(delay, throttle_first)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        servers.append(server)
+        return server
+
+    yield start
+    for server in servers:
+        server.shutdown()
+        server.server_close()
+
+
+def run_batch(tmp_path, server, async_requests, window, files=12, pack_below=0):
+    project = tmp_path / "project"
+    project.mkdir()
+    for i in range(files):
+        (project / f"module_{i}.py").write_text(f"def f{i}():\n    return {i}\n" * (i + 1))
+    with open(CONFIG_FILE) as f:
+        config = json.load(f)
+    config.update(
+        {
+            "backend": "openai",
+            "base_url": f"http://127.0.0.1:{server.server_address[1]}/v1",
+            "async_requests": async_requests,
+            "max_in_flight_requests": window,
+            "parallel": window,
+            "pack_files_below_tokens": pack_below,
+            "cache_enabled": False,
+            "generate_file_modernisation_recommendations": False,
+            "verbose": False,
+            "max_throttle_retries": 3,
+        }
+    )
+    index = scan_directory(str(project), config)
+    paths = sorted(index.stats)
+    client = create_stage_clients(config, ["files"])["files"]
+    store = StateStore(str(tmp_path / "state.db"))
+    state = store.load()
+    sink = MarkdownSink(str(tmp_path / "summary.md"), None)
+    try:
+        if async_requests:
+            processed = asyncio.run(
+                process_batch_async(paths, client, config, store, state, sink, index=index)
+            )
+        else:
+            processed = process_batch(paths, client, config, store, state, sink, index=index)
+    finally:
+        sink.close()
+    return paths, processed, state
+
+
+@pytest.mark.parametrize("async_requests", [False, True])
+def test_window_bounds_requests_in_flight(tmp_path, fake_server, async_requests):
+    server = fake_server()
+    paths, processed, state = run_batch(tmp_path, server, async_requests, window=4)
+    assert processed == set(paths)
+    assert set(state["summaries"]) == set(paths)
+    assert all(
+        state["summaries"][p]["summary"].startswith("Summary of") for p in paths
+    )
+    # The window is filled but never exceeded
+    assert server.peak == 4
+
+
+@pytest.mark.parametrize("async_requests", [False, True])
+def test_throttled_requests_are_retried(tmp_path, fake_server, async_requests, monkeypatch):
+    monkeypatch.setattr("treesummary.throttle_backoff", lambda attempt: 0.01)
+    server = fake_server(delay=0.01, throttle_first=3)
+    paths, processed, state = run_batch(tmp_path, server, async_requests, window=2, files=5)
+    assert processed == set(paths)
+    assert server.requests == len(paths) + 3
+
+
+@pytest.mark.parametrize("async_requests", [False, True])
+def test_unparsed_pack_falls_back_to_separate_requests(tmp_path, fake_server, async_requests):
+    # The fake server doesn't answer in the packed format, so each file in the pack
+    # is sent again on its own, within the same window
+    server = fake_server()
+    paths, processed, state = run_batch(
+        tmp_path, server, async_requests, window=3, files=6, pack_below=10000
+    )
+    assert processed == set(paths)
+    assert set(state["summaries"]) == set(paths)
+    assert server.requests == 1 + len(paths)
+    assert server.peak <= 3
+
+
+class EditingClient:
+    """Client that changes each file on disk while its request is in flight."""
+
+    def __init__(self, edit):
+        self.edit = edit
+
+    def converse(self, **kwargs):
+        text = kwargs["messages"][-1]["content"][-1]["text"]
+        self.edit(text)
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": "Summary"}]}},
+            "usage": {"inputTokens": 1, "outputTokens": 1, "totalTokens": 2},
+        }
+
+
+def summarise_with(tmp_path, edit):
+    project = tmp_path / "project"
+    project.mkdir()
+    for name in ["a.py", "b.py"]:
+        (project / name).write_text(f"# {name}\nx = 1\n")
+    with open(CONFIG_FILE) as f:
+        config = json.load(f)
+    config.update(
+        {
+            "pack_files_below_tokens": 0,
+            "cache_enabled": False,
+            "generate_file_modernisation_recommendations": False,
+            "parallel": 1,
+        }
+    )
+    index = scan_directory(str(project), config)
+    store = StateStore(str(tmp_path / "state.db"))
+    state = store.load()
+    sink = MarkdownSink(str(tmp_path / "summary.md"), None)
+    client = EditingClient(lambda text: edit(project, text))
+    try:
+        process_batch(sorted(index.stats), client, config, store, state, sink, index=index)
+    finally:
+        sink.close()
+    return project, state
+
+
+def test_file_deleted_in_flight_does_not_stop_the_run(tmp_path):
+    def delete_a(project, text):
+        if "# a.py" in text:
+            (project / "a.py").unlink()
+
+    # a.py is recorded as it was read, and dropped as deleted on the next scan
+    project, state = summarise_with(tmp_path, delete_a)
+    assert set(state["summaries"]) == {str(project / "a.py"), str(project / "b.py")}
+    assert state["file_hashes"][str(project / "a.py")] == hashlib.sha256(
+        b"# a.py\nx = 1\n"
+    ).hexdigest()
+
+
+def test_file_changed_in_flight_keeps_the_summarised_hash(tmp_path):
+    def change_a(project, text):
+        if "# a.py" in text:
+            (project / "a.py").write_text("# a.py\nx = 2\n")
+
+    project, state = summarise_with(tmp_path, change_a)
+    path = str(project / "a.py")
+    assert state["file_hashes"][path] == hashlib.sha256(b"# a.py\nx = 1\n").hexdigest()
+    assert hash_file(path) != state["file_hashes"][path]
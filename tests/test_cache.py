@@ -0,0 +1,16 @@
+import os
+
+from treesummary import SummaryCache
+
+
+def test_overwriting_an_entry_replaces_its_size(tmp_path):
+    cache = SummaryCache(str(tmp_path / "cache"), max_bytes=10 * 1024 * 1024)
+    for i in range(5):
+        cache.put("ab" * 32, {"summary": "x" * (100 * (i + 1))})
+    on_disk = sum(
+        os.path.getsize(os.path.join(root, name))
+        for root, _, names in os.walk(tmp_path / "cache")
+        for name in names
+    )
+    assert cache._size == on_disk
+    assert cache.get("ab" * 32) == {"summary": "x" * 500}
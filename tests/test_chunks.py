@@ -0,0 +1,32 @@
+from treesummary import CHUNK_BOUNDARIES
+
+JAVA = CHUNK_BOUNDARIES[".java"]
+
+
+def test_java_declarations_start_chunks():
+    for line in [
+        "public class Foo {",
+        "    private static final int compute(int x) {",
+        "    public Map<String, List<Integer>> lookup(String key) {",
+        "    String[] names() {",
+        "\tvoid run() {",
+        "    @Override",
+        "    public Foo(int x) {",
+    ]:
+        assert JAVA.match(line), line
+
+
+def test_java_statements_do_not_start_chunks():
+    for line in [
+        "        return foo(bar);",
+        "    return foo(bar);",
+        "    new Foo(bar);",
+        "    throw new IllegalStateException(message);",
+        "    } else if (x) {",
+        "    else if (x) {",
+        "        String name = compute(x);",
+        "        int total = sum(a, b);",
+        "        private void nested() {",
+    ]:
+        assert not JAVA.match(line), line
+
@@ -0,0 +1,23 @@
+from treesummary import stale_copies, summary_text
+
+
+def state(summaries, duplicate_of):
+    return {"summaries": summaries, "duplicate_of": duplicate_of}
+
+
+def test_copies_of_changed_file_are_stale():
+    s = state({"a.py": {}, "b.py": {}, "c.py": {}}, {"b.py": "a.py", "c.py": "x.py"})
+    # x.py has no summary any more, so c.py is stale even though nothing changed
+    assert stale_copies(["a.py"], s) == ["b.py", "c.py"]
+    assert stale_copies([], s) == ["c.py"]
+
+
+def test_changed_copy_is_not_listed_twice():
+    s = state({"a.py": {}, "b.py": {}}, {"b.py": "a.py"})
+    assert stale_copies(["a.py", "b.py"], s) == []
+
+
+def test_summary_text_falls_back_when_original_is_gone():
+    copy = {"summary": "Parses config", "duplicate_of": "a.py", "similarity": 1.0}
+    assert summary_text(copy, {"a.py": {}}) == "Duplicate of a.py (100% similar)."
+    assert summary_text(copy, {}) == "Parses config"
@@ -0,0 +1,92 @@
+import os
+
+from treesummary import compile_ignore_rule, is_ignored, scan_directory, translate_ignore_pattern
+
+
+def rules(*lines, base=""):
+    return [compile_ignore_rule(line, base) for line in lines]
+
+
+def test_translate_ignore_pattern():
+    assert translate_ignore_pattern("*.py") == "[^/]*\\.py"
+    assert translate_ignore_pattern("a/**/b") == "a/(?:.*/)?b"
+    assert translate_ignore_pattern("file?.[!c]") == "file[^/]\\.[^c]"
+
+
+def test_unanchored_pattern_matches_at_any_depth():
+    assert is_ignored("build", True, rules("build/"))
+    assert is_ignored("src/build", True, rules("build/"))
+
+
+def test_leading_slash_anchors_pattern():
+    assert is_ignored("build", True, rules("/build/"))
+    assert not is_ignored("src/build", True, rules("/build/"))
+    assert is_ignored("build", True, rules("/build"))
+    assert not is_ignored("src/build", True, rules("/build"))
+
+
+def test_middle_slash_anchors_pattern():
+    assert is_ignored("docs/build", True, rules("docs/build/"))
+    assert not is_ignored("src/docs/build", True, rules("docs/build/"))
+
+
+def test_directory_only_pattern_skips_files():
+    assert not is_ignored("build", False, rules("build/"))
+    assert is_ignored("build", False, rules("build"))
+
+
+def test_negation_and_last_match_wins():
+    assert not is_ignored("keep.log", False, rules("*.log", "!keep.log"))
+    assert is_ignored("keep.log", False, rules("!keep.log", "*.log"))
+    assert not is_ignored("keep", True, rules("!keep"))
+
+
+def test_rules_from_nested_ignore_file_are_relative_to_it():
+    nested = rules("/out/", base="pkg")
+    assert is_ignored("pkg/out", True, nested)
+    assert not is_ignored("out", True, nested)
+    assert not is_ignored("pkg/sub/out", True, nested)
+
+
+def test_comments_and_blank_lines_are_skipped():
+    assert compile_ignore_rule("# comment", "") is None
+    assert compile_ignore_rule("   \n", "") is None
+
+
+def write(path, text=""):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        f.write(text)
+
+
+def test_scan_directory_applies_ignore_paths_and_gitignore(tmp_path):
+    root = str(tmp_path)
+    for name in ["build/a.py", "src/build/b.py", "keep/c.py", "src/d.py", "src/e.py"]:
+        write(os.path.join(root, name))
+    write(os.path.join(root, "src", ".gitignore"), "e.py\n")
+    config = {
+        "file_extensions": [".py"],
+        "ignore_paths": ["/build/", "!keep"],
+        "respect_gitignore": True,
+    }
+    files = {os.path.relpath(f, root) for f in scan_directory(root, config).files}
+    assert files == {"src/build/b.py", "keep/c.py", "src/d.py"}
+
+
+def test_gitignore_can_reinclude_configured_path(tmp_path):
+    root = str(tmp_path)
+    write(os.path.join(root, "a.py"))
+    write(os.path.join(root, "generated.py"))
+    write(os.path.join(root, ".gitignore"), "!generated.py\n")
+    config = {"file_extensions": [".py"], "ignore_paths": ["generated.py"]}
+    files = {os.path.relpath(f, root) for f in scan_directory(root, config).files}
+    assert files == {"a.py", "generated.py"}
+
+
+def test_symlinked_directories_are_not_followed(tmp_path):
+    root = str(tmp_path)
+    write(os.path.join(root, "a", "b.py"))
+    os.symlink("..", os.path.join(root, "a", "loop"))
+    config = {"file_extensions": [".py"], "ignore_paths": []}
+    files = [os.path.relpath(f, root) for f in scan_directory(root, config).files]
+    assert files == ["a/b.py"]
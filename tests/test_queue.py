@@ -0,0 +1,46 @@
+import json
+import os
+
+from treesummary import (
+    FileIndex,
+    WorkQueue,
+    build_dependency_graph,
+    build_file_context,
+    scan_directory,
+)
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config.json")
+
+
+def test_workers_build_prompts_from_the_published_context(tmp_path):
+    project = tmp_path / "project"
+    (project / "pkg").mkdir(parents=True)
+    (project / "pkg" / "a.py").write_text("from pkg import b\n")
+    (project / "pkg" / "b.py").write_text("x = 1\n")
+    (project / "pkg" / "c.py").write_text("y = 2\n")
+    (project / "main.py").write_text("print(1)\n")
+    with open(CONFIG_FILE) as f:
+        config = json.load(f)
+    index = scan_directory(str(project), config)
+    build_dependency_graph(index)
+    work_items = [(f,) for f in sorted(index.files)]
+
+    queue = WorkQueue(str(tmp_path / "state.db"), 600, 3)
+    queue.publish(
+        str(project),
+        work_items,
+        {},
+        "project tree",
+        [index.context_for(item) for item in work_items],
+    )
+    leased = queue.lease("worker", len(work_items))
+    assert queue.project_tree() == "project tree"
+
+    worker_index = FileIndex(str(project))
+    for _, paths, _, context in leased:
+        worker_index.add_context(context)
+    for (file_path,) in work_items:
+        assert build_file_context(file_path, "content", worker_index) == build_file_context(
+            file_path, "content", index
+        )
+    queue.close()
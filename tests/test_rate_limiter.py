@@ -0,0 +1,28 @@
+from treesummary import RateLimiter
+
+
+def test_burst_of_throttles_halves_the_limit_once():
+    limiter = RateLimiter({}, 16)
+    epochs = [limiter.acquire(100) for _ in range(16)]
+    for epoch in epochs:
+        limiter.release(100, None, True, epoch)
+    assert limiter.concurrency == 8
+    assert limiter.throttle_count == 16
+
+
+def test_throttle_after_a_decrease_halves_again():
+    limiter = RateLimiter({}, 16)
+    first = limiter.acquire(100)
+    limiter.release(100, None, True, first)
+    second = limiter.acquire(100)
+    limiter.release(100, None, True, second)
+    assert limiter.concurrency == 4
+
+
+def test_successes_grow_the_limit_back():
+    limiter = RateLimiter({}, 4)
+    limiter.release(100, None, True, limiter.acquire(100))
+    assert limiter.concurrency == 2
+    for _ in range(2):
+        limiter.release(100, 150, False, limiter.acquire(100))
+    assert limiter.concurrency == 3
@@ -0,0 +1,104 @@
+import json
+import os
+
+import pytest
+
+from botocore.exceptions import ClientError
+
+from treesummary import (
+    BudgetExceededError,
+    StubClient,
+    group_files_for_supersummary,
+    refresh_supersummaries,
+)
+
+CONFIG_FILE = os.path.join(os.path.dirname(os.path.dirname(__file__)), "config.json")
+
+
+class FailingClient:
+    def converse(self, **kwargs):
+        raise ClientError(
+            {"Error": {"Code": "ValidationException", "Message": "bad request"}}, "Converse"
+        )
+
+
+class BudgetClient(StubClient):
+    """Answers the first request, then reports that the budget has run out."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = 0
+
+    def converse(self, **kwargs):
+        self.calls += 1
+        if self.calls > 1:
+            raise BudgetExceededError("spent $1.00 of the $1.00 budget")
+        return super().converse(**kwargs)
+
+
+def make_state(files):
+    return {
+        "summaries": {f: {"summary": f"Summary of {f}"} for f in files},
+        "file_hashes": {f: f"hash-{f}" for f in files},
+        "duplicate_of": {},
+        "supersummaries": {},
+    }
+
+
+def load_config(**overrides):
+    with open(CONFIG_FILE) as f:
+        config = json.load(f)
+    config.update({"directory": "/p", "parallel": 2, **overrides})
+    return config
+
+
+def test_adding_a_file_only_regroups_its_neighbours():
+    files = sorted(f"/p/d{i // 50}/f{i}.py" for i in range(200))
+    before = group_files_for_supersummary(files, 10)
+    after = group_files_for_supersummary(sorted(files + ["/p/d0/f0a.py"]), 10)
+    assert all(len(group) <= 10 for group in before)
+    unchanged = set(map(tuple, before)) & set(map(tuple, after))
+    assert len(unchanged) >= len(before) - 2
+
+
+def test_failed_supersummaries_are_retried_on_the_next_run():
+    files = [f"/p/f{i}.py" for i in range(6)]
+    state = make_state(files)
+    config = load_config(supersummary_interval=4)
+
+    assert refresh_supersummaries(files, state, FailingClient(), config, False) == []
+    assert state["supersummaries"]["/p"] == {}
+
+    levels = refresh_supersummaries(files, state, StubClient(), config, False)
+    assert levels and all("bad request" not in text for text in levels[0])
+    assert len(state["supersummaries"]["/p"]) == len(levels[0])
+
+
+def test_supersummaries_paid_for_are_kept_when_the_budget_runs_out():
+    files = [f"/p/f{i}.py" for i in range(12)]
+    state = make_state(files)
+    config = load_config(supersummary_interval=4, parallel=1)
+
+    with pytest.raises(BudgetExceededError):
+        refresh_supersummaries(files, state, BudgetClient(), config, False)
+    assert len(state["supersummaries"]["/p"]) == 1
+
+
+def test_level_zero_groups_stay_within_the_token_budget():
+    files = [f"/p/f{i}.py" for i in range(8)]
+    state = make_state(files)
+    for f in files:
+        state["summaries"][f] = {"summary": "x" * 4000}
+    config = load_config(supersummary_interval=100, supersummary_token_budget=2500)
+
+    groups = []
+
+    class RecordingClient(StubClient):
+        def converse(self, **kwargs):
+            groups.append(kwargs["messages"][0]["content"][0]["text"].count("File: "))
+            return super().converse(**kwargs)
+
+    refresh_supersummaries(files, state, RecordingClient(), config, True)
+    # Each summary is about 1,000 tokens, so no more than two fit in a group
+    assert groups and max(groups) <= 2
+    assert sum(groups) == len(files)
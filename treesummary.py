@@ -1,551 +1,4588 @@
 import os
 import json
 import argparse
-from typing import Dict, List, Any
+import asyncio
+import contextlib
+from typing import Dict, Generator, Iterable, Iterator, List, Any, Optional, Set, Tuple
 import boto3
 from botocore.config import Config
 from botocore.exceptions import ClientError
-from concurrent.futures import ThreadPoolExecutor, as_completed
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    Future,
+    ProcessPoolExecutor,
+    ThreadPoolExecutor,
+    wait,
+)
 import tqdm
 from datetime import datetime
 import pickle
+import sqlite3
+import time
 import subprocess
-import shutil
+import tempfile
+import cProfile
+import csv
+import pstats
 import glob
+import hashlib
+import heapq
+import io
+import itertools
+import http.client
+import http.server
+import queue
+import random
+import re
+import socket
+import threading
+import urllib.parse
+import zlib
 
 
-def load_state(state_file: str) -> Dict[str, Any]:
-    if os.path.exists(state_file):
-        with open(state_file, "rb") as f:
-            return pickle.load(f)
-    return {"processed_files": set(), "last_directory": None}
+class StoredSummaries:
+    """Dict-like view of the file summaries in the state database, read back on demand."""
 
+    def __init__(self, conn: sqlite3.Connection, paths: Set[str]):
+        self.conn = conn
+        self.paths = paths
 
-def save_state(state_file: str, state: Dict[str, Any]):
-    with open(state_file, "wb") as f:
-        pickle.dump(state, f)
+    def __contains__(self, path: str) -> bool:
+        return path in self.paths
 
+    def __getitem__(self, path: str) -> Dict[str, str]:
+        row = self.conn.execute(
+            "SELECT result FROM files WHERE path = ?", (path,)
+        ).fetchone()
+        if path not in self.paths or row is None or row[0] is None:
+            raise KeyError(path)
+        return json.loads(row[0])
 
-def get_directory_tree(
-    path: str, max_depth: int = 3, ignore_paths: List[str] = []
+    def __setitem__(self, path: str, summary: Dict[str, str]):
+        # The summary itself has already been written by StateStore.record_file()
+        self.paths.add(path)
+
+    def pop(self, path: str, default: Any = None) -> Any:
+        self.paths.discard(path)
+        return default
+
+    def __iter__(self):
+        return iter(list(self.paths))
+
+    def __len__(self) -> int:
+        return len(self.paths)
+
+
+class StateStore:
+    """SQLite-backed run state: one transactional write per completed file, safe to kill mid-run."""
+
+    def __init__(self, state_file: str, shared: bool = False, read_only: bool = False):
+        self.state_file = state_file
+        if read_only and os.path.exists(state_file):
+            self.conn = sqlite3.connect(
+                f"file:{urllib.parse.quote(os.path.abspath(state_file))}?mode=ro",
+                uri=True,
+                timeout=60,
+            )
+            return
+        # Without a state file to read, a read-only store starts out empty in memory
+        self.conn = sqlite3.connect(":memory:" if read_only else state_file, timeout=60)
+        # WAL needs shared memory, which processes on different hosts don't have, so
+        # a state file shared with workers uses a rollback journal instead
+        self.conn.execute(f"PRAGMA journal_mode={'DELETE' if shared else 'WAL'}")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.executescript(
+                """
+                CREATE TABLE IF NOT EXISTS files (
+                    path TEXT PRIMARY KEY,
+                    hash TEXT,
+                    mtime REAL,
+                    result TEXT
+                );
+                CREATE TABLE IF NOT EXISTS supersummaries (
+                    directory TEXT,
+                    signature TEXT,
+                    text TEXT,
+                    PRIMARY KEY (directory, signature)
+                );
+                CREATE TABLE IF NOT EXISTS final_outputs (
+                    directory TEXT,
+                    name TEXT,
+                    signature TEXT,
+                    text TEXT,
+                    PRIMARY KEY (directory, name)
+                );
+                CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT);
+                """
+            )
+
+    def load(self) -> Dict[str, Any]:
+        state = {
+            "processed_files": set(),
+            "last_directory": None,
+            "file_hashes": {},
+            "file_mtimes": {},
+            # Summaries stay on disk and are only read back when a reduce step needs
+            # them, so memory doesn't grow with the number of summarised files
+            "summaries": StoredSummaries(self.conn, set()),
+            # Which file each copy of a duplicated file shares its summary with
+            "duplicate_of": {},
+            "supersummaries": {},
+            "final_outputs": {},
+        }
+        for path, file_hash, mtime, has_result, duplicate_of in self.conn.execute(
+            "SELECT path, hash, mtime, result IS NOT NULL, json_extract(result, '$.duplicate_of') FROM files"
+        ):
+            state["processed_files"].add(path)
+            if has_result:
+                state["summaries"].paths.add(path)
+                state["file_hashes"][path] = file_hash
+                state["file_mtimes"][path] = mtime
+            if duplicate_of:
+                state["duplicate_of"][path] = duplicate_of
+        for directory, signature, text in self.conn.execute(
+            "SELECT directory, signature, text FROM supersummaries"
+        ):
+            state["supersummaries"].setdefault(directory, {})[signature] = text
+        for directory, name, signature, text in self.conn.execute(
+            "SELECT directory, name, signature, text FROM final_outputs"
+        ):
+            state["final_outputs"].setdefault(directory, {})[name] = {
+                "signature": signature,
+                "text": text,
+            }
+        row = self.conn.execute(
+            "SELECT value FROM meta WHERE key = 'last_directory'"
+        ).fetchone()
+        if row:
+            state["last_directory"] = row[0]
+        return state
+
+    def record_file(
+        self, file_path: str, file_hash: str, mtime: float, result: Dict[str, str]
+    ):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO files (path, hash, mtime, result) VALUES (?, ?, ?, ?)",
+                (file_path, file_hash, mtime, json.dumps(result)),
+            )
+
+    def iter_summaries(self, file_paths: Set[str]):
+        for path, result in self.conn.execute(
+            "SELECT path, result FROM files WHERE result IS NOT NULL ORDER BY path"
+        ):
+            if path in file_paths:
+                yield path, json.loads(result)
+
+    def remove_files(self, file_paths: List[str]):
+        with self.conn:
+            self.conn.executemany(
+                "DELETE FROM files WHERE path = ?", [(f,) for f in file_paths]
+            )
+
+    def set_last_directory(self, directory: str):
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO meta (key, value) VALUES ('last_directory', ?)",
+                (directory,),
+            )
+
+    def save_outputs(self, state: Dict[str, Any], directory: str):
+        with METRICS.timer("state_write"), self.conn:
+            self.conn.execute(
+                "DELETE FROM supersummaries WHERE directory = ?", (directory,)
+            )
+            self.conn.executemany(
+                "INSERT INTO supersummaries (directory, signature, text) VALUES (?, ?, ?)",
+                [
+                    (directory, signature, text)
+                    for signature, text in state["supersummaries"]
+                    .get(directory, {})
+                    .items()
+                ],
+            )
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO final_outputs (directory, name, signature, text) VALUES (?, ?, ?, ?)",
+                [
+                    (directory, name, output["signature"], output["text"])
+                    for name, output in state["final_outputs"]
+                    .get(directory, {})
+                    .items()
+                ],
+            )
+
+    def import_legacy_state(self, legacy_state_file: str):
+        # Older versions pickled the set of processed paths without their summaries
+        with open(legacy_state_file, "rb") as f:
+            legacy_state = pickle.load(f)
+        with self.conn:
+            self.conn.executemany(
+                "INSERT OR IGNORE INTO files (path) VALUES (?)",
+                [(f,) for f in legacy_state.get("processed_files", set())],
+            )
+
+    def clear(self):
+        with self.conn:
+            for table in ("files", "supersummaries", "final_outputs", "meta"):
+                self.conn.execute(f"DELETE FROM {table}")
+
+    def close(self):
+        self.conn.close()
+
+
+class WorkQueue:
+    """Work items leased to workers from the state database, retried when a lease expires."""
+
+    def __init__(self, state_file: str, lease_seconds: float, max_attempts: int):
+        # Transactions are managed explicitly so that leasing can take the write lock
+        # before it reads, and the heartbeat thread shares the connection
+        self.conn = sqlite3.connect(
+            state_file, timeout=60, isolation_level=None, check_same_thread=False
+        )
+        self.lock = threading.Lock()
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.conn.executescript(
+            """
+            CREATE TABLE IF NOT EXISTS work_queue (
+                id INTEGER PRIMARY KEY,
+                paths TEXT,
+                duplicates TEXT,
+                context TEXT,
+                status TEXT,
+                owner TEXT,
+                lease_expires REAL,
+                attempts INTEGER DEFAULT 0
+            );
+            CREATE TABLE IF NOT EXISTS queue_meta (key TEXT PRIMARY KEY, value TEXT);
+            """
+        )
+        # Queues from before the context was published are replaced on the next publish
+        columns = [row[1] for row in self.conn.execute("PRAGMA table_info(work_queue)")]
+        if "context" not in columns:
+            self.conn.execute("ALTER TABLE work_queue ADD COLUMN context TEXT")
+
+    @contextlib.contextmanager
+    def transaction(self):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self.conn.execute("ROLLBACK")
+                raise
+            self.conn.execute("COMMIT")
+
+    def publish(
+        self,
+        directory: str,
+        work_items: List[Tuple[str, ...]],
+        duplicates: Dict[str, List[Tuple[str, float]]],
+        project_tree: str,
+        contexts: List[Dict[str, Any]],
+    ):
+        # Each item carries the parts of the index its files' prompts need, so that
+        # workers don't have to scan the tree themselves
+        with self.transaction():
+            self.conn.execute("DELETE FROM work_queue")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO queue_meta (key, value) VALUES (?, ?)",
+                [("directory", directory), ("project_tree", project_tree)],
+            )
+            self.conn.executemany(
+                "INSERT INTO work_queue (paths, duplicates, context, status) VALUES (?, ?, ?, 'pending')",
+                [
+                    (
+                        json.dumps(item),
+                        json.dumps({f: duplicates[f] for f in item if f in duplicates}),
+                        json.dumps(context),
+                    )
+                    for item, context in zip(work_items, contexts)
+                ],
+            )
+
+    def _meta(self, key: str) -> Optional[str]:
+        with self.lock:
+            row = self.conn.execute(
+                "SELECT value FROM queue_meta WHERE key = ?", (key,)
+            ).fetchone()
+        return row[0] if row else None
+
+    def directory(self) -> Optional[str]:
+        return self._meta("directory")
+
+    def project_tree(self) -> Optional[str]:
+        return self._meta("project_tree")
+
+    def lease(
+        self, owner: str, count: int
+    ) -> List[
+        Tuple[int, Tuple[str, ...], Dict[str, List[Tuple[str, float]]], Dict[str, Any]]
+    ]:
+        now = time.time()
+        with self.transaction():
+            # Items whose worker has stopped renewing its lease are handed out again,
+            # unless they've already been tried too many times
+            self.conn.execute(
+                "UPDATE work_queue SET status = 'failed' WHERE status IN ('pending', 'leased') AND attempts >= ? AND (status = 'pending' OR lease_expires < ?)",
+                (self.max_attempts, now),
+            )
+            rows = self.conn.execute(
+                "SELECT id, paths, duplicates, context FROM work_queue WHERE status = 'pending' OR (status = 'leased' AND lease_expires < ?) ORDER BY id LIMIT ?",
+                (now, count),
+            ).fetchall()
+            self.conn.executemany(
+                "UPDATE work_queue SET status = 'leased', owner = ?, lease_expires = ?, attempts = attempts + 1 WHERE id = ?",
+                [(owner, now + self.lease_seconds, row[0]) for row in rows],
+            )
+        return [
+            (
+                item_id,
+                tuple(json.loads(paths)),
+                {f: [tuple(d) for d in dups] for f, dups in json.loads(duplicates).items()},
+                json.loads(context) if context else {},
+            )
+            for item_id, paths, duplicates, context in rows
+        ]
+
+    def renew(self, owner: str):
+        with self.transaction():
+            self.conn.execute(
+                "UPDATE work_queue SET lease_expires = ? WHERE owner = ? AND status = 'leased'",
+                (time.time() + self.lease_seconds, owner),
+            )
+
+    def finish(self, owner: str, item_ids: List[int], status: str):
+        # Only items this worker still holds are updated, in case its lease expired
+        # and another worker took them over
+        with self.transaction():
+            self.conn.executemany(
+                "UPDATE work_queue SET status = ?, owner = NULL WHERE id = ? AND owner = ? AND status = 'leased'",
+                [(status, item_id, owner) for item_id in item_ids],
+            )
+
+    def counts(self) -> Dict[str, int]:
+        with self.lock:
+            return dict(
+                self.conn.execute(
+                    "SELECT status, COUNT(*) FROM work_queue GROUP BY status"
+                ).fetchall()
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+def hash_content(content: str) -> str:
+    return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+
+def hash_file(file_path: str) -> str:
+    with open(file_path, "rb") as f:
+        return hashlib.sha256(f.read()).hexdigest()
+
+
+def summary_cache_key(content_hash: str, config: Dict[str, Any]) -> str:
+    # Anything that changes what the model would return for this file must be part of the key
+    key_fields = {
+        "content_hash": content_hash,
+        "model_id": config["model_id"],
+        "system_prompt": config["system_prompt"],
+        "file_prompt": config["file_prompt"],
+        "file_modernisation_prompt": (
+            config.get("file_modernisation_prompt")
+            if config.get("generate_file_modernisation_recommendations", False)
+            else None
+        ),
+        "max_tokens": config["max_tokens"],
+        "temperature": config["temperature"],
+        "top_p": config["top_p"],
+    }
+    return hash_content(json.dumps(key_fields, sort_keys=True))
+
+
+class SummaryCache:
+    """On-disk, content-addressed store of file_plan() results with size-based LRU eviction."""
+
+    def __init__(self, cache_dir: str, max_bytes: int):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+        self._size = sum(os.path.getsize(path) for path in self._entries())
+
+    def _entries(self) -> List[str]:
+        return glob.glob(os.path.join(self.cache_dir, "*", "*.json"))
+
+    def _path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f"{key}.json")
+
+    def get(self, key: str) -> Optional[Dict[str, str]]:
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                result = json.load(f)
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+
+        # Bump the mtime so eviction treats this entry as recently used
+        try:
+            os.utime(path)
+        except OSError:
+            pass
+        with self._lock:
+            self.hits += 1
+        return result
+
+    def put(self, key: str, result: Dict[str, str]):
+        path = self._path(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp_path = f"{path}.{threading.get_ident()}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(result, f)
+        size = os.path.getsize(tmp_path)
+
+        with self._lock:
+            # Replacing an entry frees the space the old one took
+            try:
+                size -= os.path.getsize(path)
+            except OSError:
+                pass
+            os.replace(tmp_path, path)
+            self._size += size
+            if self._size > self.max_bytes:
+                self._evict()
+
+    def _evict(self):
+        # Drop least recently used entries until we're comfortably under the limit
+        entries = []
+        for path in self._entries():
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+        entries.sort()
+
+        self._size = sum(size for _, size, _ in entries)
+        target = self.max_bytes * 0.9
+        for _, size, path in entries:
+            if self._size <= target:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            self._size -= size
+            self.evictions += 1
+
+    def stats(self) -> str:
+        lookups = self.hits + self.misses
+        hit_rate = (self.hits / lookups * 100) if lookups else 0.0
+        return (
+            f"Cache hits: {self.hits}, misses: {self.misses} ({hit_rate:.1f}% hit rate), "
+            f"evictions: {self.evictions}, size: {self._size / (1024 * 1024):.1f} MB"
+        )
+
+
+def translate_ignore_pattern(pattern: str) -> str:
+    # Translates a .gitignore-style glob into a regex over "/"-separated paths
+    regex = ""
+    i = 0
+    while i < len(pattern):
+        if pattern.startswith("**/", i):
+            regex += "(?:.*/)?"
+            i += 3
+        elif pattern.startswith("**", i):
+            regex += ".*"
+            i += 2
+        elif pattern[i] == "*":
+            regex += "[^/]*"
+            i += 1
+        elif pattern[i] == "?":
+            regex += "[^/]"
+            i += 1
+        elif pattern[i] == "[" and "]" in pattern[i + 1 :]:
+            end = pattern.index("]", i + 1)
+            regex += "[" + pattern[i + 1 : end].replace("!", "^", 1) + "]"
+            i = end + 1
+        else:
+            regex += re.escape(pattern[i])
+            i += 1
+    return regex
+
+
+def compile_ignore_rule(line: str, base: str) -> Optional[Tuple[Any, bool, bool, str]]:
+    line = line.rstrip("\n").rstrip()
+    if not line or line.startswith("#"):
+        return None
+    negate = line.startswith("!")
+    if negate:
+        line = line[1:]
+    dir_only = line.endswith("/")
+    line = line.rstrip("/")
+    if "/" in line:
+        # Patterns with a leading or middle slash are relative to the directory of
+        # the ignore file, a trailing slash alone only limits them to directories
+        regex = "^" + translate_ignore_pattern(line.lstrip("/")) + "$"
+    else:
+        regex = "(?:^|/)" + translate_ignore_pattern(line) + "$"
+    return re.compile(regex), negate, dir_only, base
+
+
+def is_ignored(rel_path: str, is_dir: bool, rules: List[Tuple[Any, bool, bool, str]]) -> bool:
+    # As with git, the last matching rule wins
+    ignored = False
+    for regex, negate, dir_only, base in rules:
+        if dir_only and not is_dir:
+            continue
+        if base:
+            if not rel_path.startswith(base + "/"):
+                continue
+            path = rel_path[len(base) + 1 :]
+        else:
+            path = rel_path
+        if regex.search(path):
+            ignored = not negate
+    return ignored
+
+
+class FileIndex:
+    """In-memory index of a tree built by a single pruned scan, used for all file lookups."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.files: List[str] = []
+        self.stats: Dict[str, Tuple[int, float]] = {}
+        self.directory_files: Dict[str, List[str]] = {}
+        self.subdirectories: Dict[str, List[str]] = {}
+        # Filled in by build_dependency_graph() when dependency_graph is enabled
+        self.dependencies: Optional[Dict[str, List[str]]] = None
+        self.dependents: Optional[Dict[str, List[str]]] = None
+        self.neighbourhood_tokens = 200
+        self.neighbourhoods: Dict[str, str] = {}
+        self._subtree_stats: Dict[str, Tuple[int, Dict[str, int], int]] = {}
+
+    def siblings(self, directory: str) -> List[str]:
+        files = self.directory_files.get(directory)
+        return files if files is not None else get_files_in_directory(directory)
+
+    def local_view(self, file_path: str) -> "FileIndex":
+        # Just the parts of the index build_file_context() reads for one file, small
+        # enough to send to a worker process
+        directory = os.path.dirname(file_path)
+        view = FileIndex(self.directory)
+        view.directory_files[directory] = self.siblings(directory)
+        if directory in self.directory_files:
+            view.neighbourhoods[directory] = self.neighbourhood(directory)
+        if self.dependencies is not None and self.dependents is not None:
+            view.dependencies = {file_path: self.dependencies.get(file_path, [])}
+            view.dependents = {file_path: self.dependents.get(file_path, [])}
+        return view
+
+    def context_for(self, files: Iterable[str]) -> Dict[str, Any]:
+        # The local views of a work item's files as plain data, for a coordinator to
+        # publish alongside the item
+        context: Dict[str, Any] = {"directory_files": {}, "neighbourhoods": {}}
+        if self.dependencies is not None and self.dependents is not None:
+            context["dependencies"] = {}
+            context["dependents"] = {}
+        for file_path in files:
+            view = self.local_view(file_path)
+            context["directory_files"].update(view.directory_files)
+            context["neighbourhoods"].update(view.neighbourhoods)
+            if "dependencies" in context:
+                context["dependencies"].update(view.dependencies)
+                context["dependents"].update(view.dependents)
+        return context
+
+    def add_context(self, context: Dict[str, Any]):
+        self.directory_files.update(context.get("directory_files", {}))
+        self.neighbourhoods.update(context.get("neighbourhoods", {}))
+        if "dependencies" in context:
+            if self.dependencies is None or self.dependents is None:
+                self.dependencies, self.dependents = {}, {}
+            self.dependencies.update(context["dependencies"])
+            self.dependents.update(context["dependents"])
+
+    def subtree_stats(self, directory: str) -> Tuple[int, Dict[str, int], int]:
+        # (files, files per extension, subdirectories) under a directory, worked out
+        # for the whole subtree at once and kept for later renders
+        if directory not in self._subtree_stats:
+            stack = [(directory, False)]
+            while stack:
+                current, children_done = stack.pop()
+                subdirectories = [
+                    os.path.join(current, d) for d in self.subdirectories.get(current, [])
+                ]
+                if not children_done:
+                    stack.append((current, True))
+                    stack.extend(
+                        (d, False) for d in subdirectories if d not in self._subtree_stats
+                    )
+                    continue
+                names = self.directory_files.get(current, [])
+                extensions: Dict[str, int] = {}
+                for name in names:
+                    extension = os.path.splitext(name)[1] or name
+                    extensions[extension] = extensions.get(extension, 0) + 1
+                files, directories = len(names), len(subdirectories)
+                for subdirectory in subdirectories:
+                    sub_files, sub_extensions, sub_directories = self._subtree_stats[
+                        subdirectory
+                    ]
+                    files += sub_files
+                    directories += sub_directories
+                    for extension, count in sub_extensions.items():
+                        extensions[extension] = extensions.get(extension, 0) + count
+                self._subtree_stats[current] = (files, extensions, directories)
+        return self._subtree_stats[directory]
+
+    def collapsed_label(self, directory: str) -> str:
+        # A directory that isn't expanded is shown as its file count and the most
+        # common extensions in it
+        files, extensions, directories = self.subtree_stats(directory)
+        top = sorted(extensions.items(), key=lambda e: (-e[1], e[0]))[:3]
+        histogram = ", ".join(f"{count} {extension}" for extension, count in top)
+        other = files - sum(count for _, count in top)
+        if other:
+            histogram += f", {other} other"
+        label = f"{os.path.basename(directory)}/ ({files} files"
+        if histogram:
+            label += f": {histogram}"
+        if directories:
+            label += f"; {directories} directories"
+        return label + ")"
+
+    def tree_text(
+        self,
+        max_depth: int = 3,
+        budget: int = 0,
+        focus: Optional[str] = None,
+        root: Optional[str] = None,
+    ) -> str:
+        # Directories are expanded breadth first for as long as the estimated size
+        # stays within the token budget (0 for no limit), and the rest are collapsed
+        # into counts. The directories leading down to `focus` are expanded first,
+        # whatever the budget.
+        root = root or self.directory
+        focus_path = set()
+        if focus is not None and (
+            focus == root or focus.startswith(os.path.join(root, ""))
+        ):
+            directory = focus
+            while directory != root:
+                focus_path.add(directory)
+                directory = os.path.dirname(directory)
+            focus_path.add(root)
+
+        def line_tokens(text: str, depth: int) -> int:
+            return estimate_tokens("  " * depth + text) + 1
+
+        expanded = set()
+        cost = line_tokens(self.collapsed_label(root), 0)
+        candidates = [(root not in focus_path, 0, root)]
+        while candidates:
+            _, depth, directory = heapq.heappop(candidates)
+            subdirectories = [
+                os.path.join(directory, d) for d in self.subdirectories.get(directory, [])
+            ]
+            delta = (
+                line_tokens(f"{os.path.basename(directory)}/", depth)
+                - line_tokens(self.collapsed_label(directory), depth)
+                + sum(
+                    line_tokens(name, depth + 1)
+                    for name in self.directory_files.get(directory, [])
+                )
+                + sum(
+                    line_tokens(self.collapsed_label(d), depth + 1)
+                    for d in subdirectories
+                )
+            )
+            if directory not in focus_path and budget and cost + delta > budget:
+                continue
+            expanded.add(directory)
+            cost += delta
+            if depth < max_depth:
+                for subdirectory in subdirectories:
+                    heapq.heappush(
+                        candidates,
+                        (subdirectory not in focus_path, depth + 1, subdirectory),
+                    )
+
+        tree = []
+        stack = [(root, 0)]
+        while stack:
+            directory, level = stack.pop()
+            if directory not in expanded:
+                tree.append(f"{'  ' * level}{self.collapsed_label(directory)}")
+                continue
+            tree.append(f"{'  ' * level}{os.path.basename(directory)}/")
+            sub_indent = "  " * (level + 1)
+            for file in self.directory_files.get(directory, []):
+                tree.append(f"{sub_indent}{file}")
+            for subdirectory in reversed(self.subdirectories.get(directory, [])):
+                stack.append((os.path.join(directory, subdirectory), level + 1))
+        return "\n".join(tree)
+
+    def neighbourhood(self, directory: str) -> str:
+        # The file's own directory in full, with its parent and sibling directories
+        # around it as far as the budget allows. Every file in a directory shares
+        # this, so it's rendered once per directory.
+        if directory not in self.neighbourhoods:
+            parent = os.path.dirname(directory)
+            root = parent if directory != self.directory and parent else directory
+            self.neighbourhoods[directory] = self.tree_text(
+                2, self.neighbourhood_tokens, focus=directory, root=root
+            )
+        return self.neighbourhoods[directory]
+
+
+def scan_directory(directory: str, config: Dict[str, Any]) -> FileIndex:
+    index = FileIndex(directory)
+    index.neighbourhood_tokens = config.get("neighbourhood_token_budget", 200)
+    extensions = tuple(config["file_extensions"])
+    verbose = config.get("verbose")
+
+    # The configured ignore_paths come first, so that .gitignore files lower down
+    # can override them, as they would git's global excludes file
+    config_rules = [
+        rule
+        for rule in (compile_ignore_rule(p, "") for p in config.get("ignore_paths", []))
+        if rule is not None
+    ]
+    respect_gitignore = config.get("respect_gitignore", True)
+
+    stack = [(directory, "", config_rules)]
+    while stack:
+        dir_path, rel_dir, rules = stack.pop()
+        try:
+            with os.scandir(dir_path) as it:
+                entries = sorted(it, key=lambda entry: entry.name)
+        except OSError as e:
+            print(f"Unable to scan {dir_path}: {e}")
+            continue
+
+        if respect_gitignore and any(e.name == ".gitignore" for e in entries):
+            try:
+                with open(os.path.join(dir_path, ".gitignore"), "r") as f:
+                    rules = rules + [
+                        rule
+                        for rule in (compile_ignore_rule(line, rel_dir) for line in f)
+                        if rule is not None
+                    ]
+            except (OSError, UnicodeDecodeError):
+                pass
+
+        files, subdirectories = [], []
+        for entry in entries:
+            rel_path = f"{rel_dir}/{entry.name}" if rel_dir else entry.name
+            try:
+                is_dir = entry.is_dir()
+            except OSError:
+                continue
+            if rules and is_ignored(rel_path, is_dir, rules):
+                if verbose and is_dir:
+                    print(f"Ignoring directory: {entry.path}")
+                continue
+
+            if is_dir:
+                # Like os.walk, symlinked directories aren't followed, which could
+                # otherwise loop back up the tree and list the same files again
+                if entry.is_symlink():
+                    continue
+                # Ignored directories are pruned here and never descended into
+                subdirectories.append(entry.name)
+                continue
+            files.append(entry.name)
+            if entry.name.endswith(extensions):
+                file_path = os.path.join(dir_path, entry.name)
+                try:
+                    stat = entry.stat()
+                except OSError:
+                    continue
+                index.files.append(file_path)
+                index.stats[file_path] = (stat.st_size, stat.st_mtime)
+
+        index.directory_files[dir_path] = files
+        index.subdirectories[dir_path] = subdirectories
+        for subdirectory in reversed(subdirectories):
+            stack.append(
+                (
+                    os.path.join(dir_path, subdirectory),
+                    f"{rel_dir}/{subdirectory}" if rel_dir else subdirectory,
+                    rules,
+                )
+            )
+    return index
+
+
+def get_files_in_directory(directory: str) -> List[str]:
+    return [
+        f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))
+    ]
+
+
+def map_in_processes(function: Any, items: List[Any], *args: Any) -> Iterator[Any]:
+    # CPU bound per-file work is spread over processes for large runs, a slice at a
+    # time so that only one slice's results are held at once
+    if len(items) < 256:
+        for item in items:
+            yield function(item, *args)
+        return
+    with ProcessPoolExecutor() as executor:
+        for start in range(0, len(items), 4096):
+            yield from executor.map(
+                function,
+                items[start : start + 4096],
+                *(itertools.repeat(arg) for arg in args),
+                chunksize=64,
+            )
+
+
+PYTHON_IMPORT = re.compile(
+    r"^[ \t]*(?:from[ \t]+(\.*[\w.]*)[ \t]+import[ \t]+\(?([\w., \t]+)"
+    r"|import[ \t]+([\w., \t]+))",
+    re.MULTILINE,
+)
+GO_IMPORT = re.compile(r'^import[ \t]+(?:[\w.]+[ \t]+)?"([^"]+)"', re.MULTILINE)
+GO_IMPORT_BLOCK = re.compile(r"^import[ \t]*\((.*?)\)", re.MULTILINE | re.DOTALL)
+JAVA_IMPORT = re.compile(
+    r"^[ \t]*import[ \t]+(?:static[ \t]+)?([\w.]+?)(\.\*)?[ \t]*;", re.MULTILINE
+)
+
+
+def parse_imports(file_path: str) -> List[Tuple[str, Tuple[str, ...], int]]:
+    # Returns (kind, dotted name parts, relative level) for each import. Kind is
+    # "module" for a file, "package" for every file in a directory, or "either" for
+    # a Python name that may be a module or something defined in one.
+    try:
+        with open(file_path, "r", errors="ignore") as f:
+            content = f.read()
+    except OSError:
+        return []
+
+    imports = []
+    extension = os.path.splitext(file_path)[1]
+    if extension == ".py":
+        for module, names, plain in PYTHON_IMPORT.findall(content):
+            if plain:
+                for name in plain.split(","):
+                    name = name.split(" as ")[0].strip()
+                    if name:
+                        imports.append(("module", tuple(name.split(".")), 0))
+                continue
+            level = len(module) - len(module.lstrip("."))
+            parts = tuple(p for p in module.lstrip(".").split(".") if p)
+            for name in names.split(","):
+                name = name.split(" as ")[0].strip(" \t()")
+                if name == "*":
+                    imports.append(("module", parts, level))
+                elif name:
+                    imports.append(("either", parts + (name,), level))
+    elif extension == ".go":
+        paths = GO_IMPORT.findall(content)
+        for block in GO_IMPORT_BLOCK.findall(content):
+            paths.extend(re.findall(r'"([^"]+)"', block))
+        for path in paths:
+            imports.append(("package", tuple(p for p in path.split("/") if p), 0))
+    elif extension == ".java":
+        for name, wildcard in JAVA_IMPORT.findall(content):
+            parts = tuple(name.split("."))
+            imports.append(("package" if wildcard else "either", parts, 0))
+    return imports
+
+
+def module_suffixes(parts: Tuple[str, ...]) -> Iterator[Tuple[str, ...]]:
+    for i in range(len(parts)):
+        yield parts[i:]
+
+
+def resolve_import(
+    parts: Tuple[str, ...], table: Dict[Tuple[str, ...], Set[str]], strip_prefix: bool
+) -> Optional[str]:
+    # The table holds every suffix of each path, so trees nested under a source root
+    # (src/, src/main/java/) still match. Go import paths also start with a module
+    # path the tree doesn't have, so for those the import is shortened as well.
+    for suffix in module_suffixes(parts) if strip_prefix else [parts]:
+        matches = table.get(suffix)
+        if matches:
+            # An ambiguous name is left out rather than guessed
+            return next(iter(matches)) if len(matches) == 1 else None
+    return None
+
+
+def build_dependency_graph(index: FileIndex, changed: Optional[Set[str]] = None):
+    # Given the files that changed, only their imports are parsed again and the rest
+    # of the graph already on the index is kept. That's only valid while the set of
+    # files in the tree is the same.
+    modules: Dict[Tuple[str, ...], Set[str]] = {}
+    packages: Dict[Tuple[str, ...], Set[str]] = {}
+    for file_path in index.files:
+        rel_path = os.path.relpath(file_path, index.directory)
+        name, extension = os.path.splitext(rel_path)
+        parts = tuple(name.split(os.sep))
+        if extension == ".py" and parts[-1] == "__init__":
+            parts = parts[:-1]
+        for suffix in module_suffixes(parts):
+            modules.setdefault(suffix, set()).add(file_path)
+        rel_directory = os.path.dirname(rel_path)
+        if rel_directory:
+            for suffix in module_suffixes(tuple(rel_directory.split(os.sep))):
+                packages.setdefault(suffix, set()).add(os.path.dirname(file_path))
+
+    if changed is None or index.dependencies is None or index.dependents is None:
+        files = index.files
+        dependencies: Dict[str, List[str]] = {}
+        dependents: Dict[str, List[str]] = {}
+    else:
+        files = [f for f in index.files if f in changed]
+        dependencies, dependents = index.dependencies, index.dependents
+        for file_path in files:
+            for target in dependencies.pop(file_path, []):
+                dependents[target].remove(file_path)
+
+    for file_path, imports in zip(files, map_in_processes(parse_imports, files)):
+        extension = os.path.splitext(file_path)[1]
+        rel_directory = os.path.relpath(os.path.dirname(file_path), index.directory)
+        package = tuple(p for p in rel_directory.split(os.sep) if p != ".")
+        targets = set()
+        for kind, parts, level in imports:
+            if kind == "package":
+                directory = resolve_import(parts, packages, extension == ".go")
+                if directory is not None:
+                    targets.update(
+                        os.path.join(directory, name)
+                        for name in index.directory_files.get(directory, [])
+                        if name.endswith(extension)
+                        and os.path.join(directory, name) in index.stats
+                    )
+                continue
+
+            if level:
+                # Relative Python imports are resolved from the importing package
+                parts = package[: max(0, len(package) - (level - 1))] + parts
+            target = resolve_import(parts, modules, False)
+            if target is None and kind == "either":
+                # The last name was a class or function defined in the module
+                target = resolve_import(parts[:-1], modules, False)
+            if target is not None:
+                targets.add(target)
+        targets.discard(file_path)
+        dependencies[file_path] = sorted(targets)
+        for target in dependencies[file_path]:
+            dependents.setdefault(target, []).append(file_path)
+
+    index.dependencies = dependencies
+    index.dependents = dependents
+
+
+def dependency_components(
+    files: List[str], dependencies: Dict[str, List[str]]
+) -> List[List[str]]:
+    # Tarjan's algorithm, iterative so deep import chains can't hit the recursion
+    # limit. Components come out dependencies first, in depth-first order, so files
+    # that import each other end up next to each other.
+    members = set(files)
+    order: Dict[str, int] = {}
+    lowlink: Dict[str, int] = {}
+    stack: List[str] = []
+    on_stack: Set[str] = set()
+    components = []
+    for root in files:
+        if root in order:
+            continue
+        work = [(root, iter(dependencies.get(root, [])))]
+        order[root] = lowlink[root] = len(order)
+        stack.append(root)
+        on_stack.add(root)
+        while work:
+            node, edges = work[-1]
+            for target in edges:
+                if target not in members:
+                    continue
+                if target not in order:
+                    order[target] = lowlink[target] = len(order)
+                    stack.append(target)
+                    on_stack.add(target)
+                    work.append((target, iter(dependencies.get(target, []))))
+                    break
+                if target in on_stack:
+                    lowlink[node] = min(lowlink[node], order[target])
+            else:
+                work.pop()
+                if work:
+                    parent = work[-1][0]
+                    lowlink[parent] = min(lowlink[parent], lowlink[node])
+                if lowlink[node] == order[node]:
+                    component = []
+                    while True:
+                        member = stack.pop()
+                        on_stack.discard(member)
+                        component.append(member)
+                        if member == node:
+                            break
+                    components.append(sorted(component))
+    return components
+
+
+def get_git_changes(directory: str, since: str) -> Optional[Tuple[Set[str], Set[str]]]:
+    try:
+        diff = subprocess.run(
+            ["git", "diff", "--name-status", "--no-renames", "--relative", since, "--"],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        untracked = subprocess.run(
+            ["git", "ls-files", "--others", "--exclude-standard"],
+            cwd=directory,
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+    except (OSError, subprocess.CalledProcessError) as e:
+        print(f"Unable to get changes since '{since}' from git: {e}")
+        return None
+
+    changed, deleted = set(), set()
+    for line in diff.stdout.splitlines():
+        status, _, path = line.partition("\t")
+        if not path:
+            continue
+        if status.startswith("D"):
+            deleted.add(os.path.join(directory, path))
+        else:
+            changed.add(os.path.join(directory, path))
+    for path in untracked.stdout.splitlines():
+        changed.add(os.path.join(directory, path))
+    return changed, deleted
+
+
+def get_changed_files(
+    index: FileIndex, state: Dict[str, Any], since: Optional[str]
+) -> List[str]:
+    all_files = index.files
+    directory = index.directory
+    git_changes = get_git_changes(directory, since) if since else None
+    if git_changes is not None:
+        changed, _ = git_changes
+        print(f"Git reports {len(changed)} changed or added files since '{since}'.")
+        # Files git considers unchanged still need summarising if we've never seen them
+        changed_files = [
+            f for f in all_files if f in changed or f not in state["summaries"]
+        ]
+        return changed_files + stale_copies(changed_files, state)
+
+    if since:
+        print("Falling back to comparing file hashes against the saved state.")
+
+    changed_files = []
+    for file_path in all_files:
+        if file_path not in state["summaries"]:
+            changed_files.append(file_path)
+            continue
+        # Only hash files whose modification time has moved
+        if index.stats[file_path][1] == state["file_mtimes"].get(file_path):
+            continue
+        try:
+            if hash_file(file_path) == state["file_hashes"].get(file_path):
+                continue
+        except OSError:
+            # Left for the summarising step to report
+            pass
+        changed_files.append(file_path)
+    return changed_files + stale_copies(changed_files, state)
+
+
+def stale_copies(changed_files: List[str], state: Dict[str, Any]) -> List[str]:
+    # Copies of a file that has changed or gone no longer match what they point at,
+    # so they're summarised again, to be re-linked or summarised in their own right
+    changed = set(changed_files)
+    return sorted(
+        copy
+        for copy, original in state["duplicate_of"].items()
+        if copy not in changed and (original in changed or original not in state["summaries"])
+    )
+
+
+def remove_deleted_files(
+    all_files: List[str], state: Dict[str, Any], store: StateStore, directory: str
+) -> List[str]:
+    current_files = set(all_files)
+    prefix = os.path.join(directory, "")
+    deleted = [
+        f
+        for f in state["summaries"]
+        if f.startswith(prefix) and f not in current_files
+    ]
+    for file_path in deleted:
+        state["summaries"].pop(file_path, None)
+        state["file_hashes"].pop(file_path, None)
+        state["file_mtimes"].pop(file_path, None)
+        state["duplicate_of"].pop(file_path, None)
+        state["processed_files"].discard(file_path)
+    store.remove_files(deleted)
+    return deleted
+
+
+# Near-duplicates are found with MinHash: each file is reduced to a signature of
+# the smallest shingle hash in each bin, and signatures are bucketed band by band so
+# only files sharing a band are ever compared
+SHINGLE_SIZE = 5
+MINHASH_BINS = 64
+MINHASH_BAND_ROWS = 4
+MINHASH_EMPTY = 0xFFFFFFFF
+
+
+def minhash_signature(content: str) -> Optional[Tuple[int, ...]]:
+    words = re.findall(r"\w+", content)
+    # Very short files share most of their shingles by chance, so they are only
+    # matched exactly
+    if len(words) < SHINGLE_SIZE * 8:
+        return None
+    signature = [MINHASH_EMPTY] * MINHASH_BINS
+    for i in range(len(words) - SHINGLE_SIZE + 1):
+        value = zlib.crc32(" ".join(words[i : i + SHINGLE_SIZE]).encode())
+        slot, value = value % MINHASH_BINS, value // MINHASH_BINS
+        if value < signature[slot]:
+            signature[slot] = value
+    return tuple(signature)
+
+
+def signature_similarity(a: Tuple[int, ...], b: Tuple[int, ...]) -> float:
+    filled = [(x, y) for x, y in zip(a, b) if x != MINHASH_EMPTY or y != MINHASH_EMPTY]
+    if not filled:
+        return 0.0
+    return sum(x == y for x, y in filled) / len(filled)
+
+
+def signature_bands(extension: str, signature: Tuple[int, ...]) -> List[Tuple[Any, ...]]:
+    bands = []
+    for start in range(0, MINHASH_BINS, MINHASH_BAND_ROWS):
+        rows = signature[start : start + MINHASH_BAND_ROWS]
+        if any(row != MINHASH_EMPTY for row in rows):
+            bands.append((extension, start, rows))
+    return bands
+
+
+def file_fingerprint(
+    file_path: str, near_duplicates: bool
+) -> Optional[Tuple[str, Optional[Tuple[int, ...]]]]:
+    try:
+        with open(file_path, "rb") as f:
+            data = f.read()
+    except OSError:
+        return None
+    signature = None
+    if near_duplicates:
+        signature = minhash_signature(data.decode("utf-8", errors="ignore"))
+    return hashlib.sha256(data).hexdigest(), signature
+
+
+def find_duplicates(
+    files: List[str], config: Dict[str, Any]
+) -> Tuple[List[str], Dict[str, List[Tuple[str, float]]]]:
+    # Returns the files that still need summarising, and for each of them the
+    # identical or near-identical files that can share its summary
+    if not config.get("deduplicate_files", True):
+        return files, {}
+    threshold = config.get("near_duplicate_threshold", 0.9)
+
+    by_hash: Dict[str, str] = {}
+    by_band: Dict[Tuple[Any, ...], str] = {}
+    signatures: Dict[str, Tuple[int, ...]] = {}
+    representatives: List[str] = []
+    duplicates: Dict[str, List[Tuple[str, float]]] = {}
+    for file_path, fingerprint in zip(
+        files, map_in_processes(file_fingerprint, files, bool(threshold))
+    ):
+        if fingerprint is None:
+            # Left for the summarising step to report
+            representatives.append(file_path)
+            continue
+
+        content_hash, signature = fingerprint
+        representative, similarity = by_hash.get(content_hash), 1.0
+        bands = []
+        if representative is None and signature is not None:
+            bands = signature_bands(os.path.splitext(file_path)[1], signature)
+            candidates = {by_band[band] for band in bands if band in by_band}
+            for candidate in sorted(candidates):
+                candidate_similarity = signature_similarity(
+                    signature, signatures[candidate]
+                )
+                if candidate_similarity >= threshold and (
+                    representative is None or candidate_similarity > similarity
+                ):
+                    representative, similarity = candidate, candidate_similarity
+
+        if representative is not None:
+            # 100% is kept for byte-identical files, as the MinHash estimate can
+            # round up for files that differ by a few tokens
+            if content_hash not in by_hash:
+                similarity = min(round(similarity, 2), 0.99)
+            duplicates.setdefault(representative, []).append((file_path, similarity))
+            continue
+        representatives.append(file_path)
+        by_hash[content_hash] = file_path
+        if signature is not None:
+            signatures[file_path] = signature
+            for band in bands:
+                by_band.setdefault(band, file_path)
+    return representatives, duplicates
+
+
+THROTTLING_ERROR_CODES = {
+    "ThrottlingException",
+    "TooManyRequestsException",
+    "ServiceUnavailableException",
+}
+
+
+class ThrottledError(Exception):
+    pass
+
+
+class RequestTimeoutError(ThrottledError):
+    # Retried like throttling, but without the limiter cutting its concurrency
+    pass
+
+
+class RateLimiter:
+    """Token buckets for requests/min and tokens/min plus an AIMD concurrency limit."""
+
+    def __init__(self, config: Dict[str, Any], max_concurrency: int):
+        self.requests_per_minute = config.get("requests_per_minute") or 0
+        self.tokens_per_minute = config.get("tokens_per_minute") or 0
+        self.max_concurrency = max(1, max_concurrency)
+        self.concurrency = self.max_concurrency
+        self.in_flight = 0
+        self.throttle_count = 0
+        # Counts the times the limit has been halved, so that throttles from requests
+        # sent before the last decrease don't halve it again
+        self.decreases = 0
+        self._successes = 0
+        self._request_allowance = float(self.requests_per_minute)
+        self._token_allowance = float(self.tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._request_allowance = min(
+            self.requests_per_minute,
+            self._request_allowance + elapsed * self.requests_per_minute / 60,
+        )
+        self._token_allowance = min(
+            self.tokens_per_minute,
+            self._token_allowance + elapsed * self.tokens_per_minute / 60,
+        )
+
+    def try_acquire(self, tokens: int) -> Tuple[float, int]:
+        # Returns no wait once a request slot has been taken, otherwise how long to
+        # wait, along with the number of decreases so far to pass back to release()
+        with self._lock:
+            self._refill()
+            if self.in_flight >= self.concurrency:
+                return 0.05, self.decreases
+            if self.requests_per_minute and self._request_allowance < 1:
+                return (
+                    (1 - self._request_allowance) * 60 / self.requests_per_minute,
+                    self.decreases,
+                )
+            # A request bigger than the whole bucket is let through once the bucket is full
+            tokens = min(tokens, self.tokens_per_minute)
+            if self.tokens_per_minute and self._token_allowance < tokens:
+                return (
+                    (tokens - self._token_allowance) * 60 / self.tokens_per_minute,
+                    self.decreases,
+                )
+
+            self.in_flight += 1
+            if self.requests_per_minute:
+                self._request_allowance -= 1
+            if self.tokens_per_minute:
+                self._token_allowance -= tokens
+            return 0, self.decreases
+
+    def acquire(self, tokens: int) -> int:
+        while True:
+            wait, epoch = self.try_acquire(tokens)
+            if not wait:
+                return epoch
+            time.sleep(wait)
+
+    async def acquire_async(self, tokens: int) -> int:
+        while True:
+            wait, epoch = self.try_acquire(tokens)
+            if not wait:
+                return epoch
+            await asyncio.sleep(wait)
+
+    def release(
+        self,
+        estimated_tokens: int,
+        used_tokens: Optional[int],
+        throttled: bool,
+        epoch: Optional[int] = None,
+    ):
+        with self._lock:
+            self.in_flight -= 1
+            if self.tokens_per_minute and used_tokens is not None:
+                # Refund (or charge) the difference between the estimate and actual usage
+                self._token_allowance = min(
+                    self.tokens_per_minute,
+                    self._token_allowance
+                    + min(estimated_tokens, self.tokens_per_minute)
+                    - used_tokens,
+                )
+            if throttled:
+                self.throttle_count += 1
+                self._successes = 0
+                # A burst of throttles is one congestion event, so the limit is only
+                # halved by the first throttled request sent since the last decrease
+                if epoch is None or epoch == self.decreases:
+                    self.concurrency = max(1, self.concurrency // 2)
+                    self.decreases += 1
+            else:
+                self._successes += 1
+                if (
+                    self._successes >= self.concurrency
+                    and self.concurrency < self.max_concurrency
+                ):
+                    self._successes = 0
+                    self.concurrency += 1
+
+
+def request_input_tokens(request: Dict[str, Any]) -> int:
+    text = "".join(
+        block["text"]
+        for message in request["messages"]
+        for block in message["content"]
+        if "text" in block
+    )
+    system = "".join(block["text"] for block in request["system"] if "text" in block)
+    return estimate_tokens(text) + estimate_tokens(system)
+
+
+def request_token_estimate(request: Dict[str, Any]) -> int:
+    return request_input_tokens(request) + request["inferenceConfig"]["maxTokens"]
+
+
+class BudgetExceededError(Exception):
+    pass
+
+
+def model_cost(
+    config: Dict[str, Any],
+    model_id: str,
+    input_tokens: int,
+    output_tokens: int,
+    cache_read_tokens: int = 0,
+    cache_write_tokens: int = 0,
+) -> Optional[float]:
+    pricing = config.get("model_pricing", {}).get(model_id)
+    if not pricing:
+        return None
+    # Without explicit cache prices, fall back to Anthropic's usual multipliers
+    input_price = pricing["input_per_1k_tokens"]
+    return (
+        input_tokens / 1000 * input_price
+        + output_tokens / 1000 * pricing["output_per_1k_tokens"]
+        + cache_read_tokens / 1000 * pricing.get("cache_read_per_1k_tokens", input_price * 0.1)
+        + cache_write_tokens
+        / 1000
+        * pricing.get("cache_write_per_1k_tokens", input_price * 1.25)
+    )
+
+
+class UsageTracker:
+    """Totals the token usage reported by each response and enforces max_cost_usd."""
+
+    def __init__(self, config: Dict[str, Any]):
+        self.config = config
+        self.max_cost = config.get("max_cost_usd") or 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_read_tokens = 0
+        self.cache_write_tokens = 0
+        self.cost = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, model_id: str, usage: Dict[str, int], price_factor: float = 1.0):
+        input_tokens = usage.get("inputTokens", 0)
+        output_tokens = usage.get("outputTokens", 0)
+        cache_read_tokens = usage.get("cacheReadInputTokens", 0)
+        cache_write_tokens = usage.get("cacheWriteInputTokens", 0)
+        if self.config.get("verbose"):
+            print(
+                f"Request used {input_tokens} input, {output_tokens} output, {cache_read_tokens} cache read and {cache_write_tokens} cache write tokens."
+            )
+        with self._lock:
+            self.input_tokens += input_tokens
+            self.output_tokens += output_tokens
+            self.cache_read_tokens += cache_read_tokens
+            self.cache_write_tokens += cache_write_tokens
+            self.cost += (
+                model_cost(
+                    self.config,
+                    model_id,
+                    input_tokens,
+                    output_tokens,
+                    cache_read_tokens,
+                    cache_write_tokens,
+                )
+                or 0
+            ) * price_factor
+
+    def check_budget(self):
+        if self.max_cost and self.cost >= self.max_cost:
+            raise BudgetExceededError(
+                f"spent ${self.cost:.2f} of the ${self.max_cost:.2f} budget"
+            )
+
+    def budget_exceeded(self) -> bool:
+        return bool(self.max_cost) and self.cost >= self.max_cost
+
+
+def percentile(values: List[float], p: float) -> float:
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+# Percentiles in the run report come from a random sample of each series of at
+# most this many values, so the report's memory use doesn't grow with the run
+REPORT_SAMPLE_SIZE = 1024
+
+
+class Reservoir:
+    """Count, total and maximum of a series of values, plus a fixed-size random sample of them."""
+
+    def __init__(self):
+        self.count = 0
+        self.total: float = 0
+        self.max: float = 0
+        self.sample: List[float] = []
+        self.random = random.Random(0)
+
+    def add(self, value: float):
+        self.count += 1
+        self.total += value
+        self.max = value if self.count == 1 else max(self.max, value)
+        if len(self.sample) < REPORT_SAMPLE_SIZE:
+            self.sample.append(value)
+        else:
+            slot = self.random.randrange(self.count)
+            if slot < REPORT_SAMPLE_SIZE:
+                self.sample[slot] = value
+
+    def distribution(self) -> Dict[str, float]:
+        if not self.count:
+            return {"count": 0}
+        return {
+            "count": self.count,
+            "total": self.total,
+            "mean": self.total / self.count,
+            "p50": percentile(self.sample, 50),
+            "p90": percentile(self.sample, 90),
+            "p99": percentile(self.sample, 99),
+            "max": self.max,
+        }
+
+
+CALL_REPORT_FIELDS = [
+    "stage",
+    "model_id",
+    "outcome",
+    "queue_wait_s",
+    "latency_s",
+    "server_latency_ms",
+    "ttft_s",
+    "input_tokens",
+    "output_tokens",
+    "cache_read_tokens",
+    "cache_write_tokens",
+]
+
+
+class RunMetrics:
+    """Collects local stage timings and model call statistics for the run report, logging each call to a CSV file."""
+
+    def __init__(self):
+        self.stage = "files"
+        self.started = time.time()
+        self.timings: Dict[str, Reservoir] = {}
+        self.stages: Dict[str, Dict[str, Any]] = {}
+        self.call_log = None
+        self.call_writer = None
+        self._lock = threading.Lock()
+
+    def open_call_log(self, csv_file: str):
+        # Calls are written out as they're made rather than kept for the report
+        self.call_log = open(csv_file, "w", newline="")
+        self.call_writer = csv.DictWriter(self.call_log, fieldnames=CALL_REPORT_FIELDS)
+        self.call_writer.writeheader()
+
+    @contextlib.contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+            with self._lock:
+                self.timings.setdefault(name, Reservoir()).add(elapsed)
+
+    def record_call(
+        self,
+        model_id: str,
+        outcome: str,
+        queue_wait: Optional[float],
+        latency: Optional[float],
+        response: Optional[Dict[str, Any]] = None,
+    ):
+        usage = (response or {}).get("usage", {})
+        # Only streamed responses have a time to first token
+        ttft = (response or {}).get("metrics", {}).get("timeToFirstTokenMs")
+        call = {
+            "stage": self.stage,
+            "model_id": model_id,
+            "outcome": outcome,
+            "queue_wait_s": queue_wait,
+            "latency_s": latency,
+            "server_latency_ms": (response or {}).get("metrics", {}).get("latencyMs"),
+            "ttft_s": ttft / 1000 if ttft is not None else None,
+            "input_tokens": usage.get("inputTokens", 0),
+            "output_tokens": usage.get("outputTokens", 0),
+            "cache_read_tokens": usage.get("cacheReadInputTokens", 0),
+            "cache_write_tokens": usage.get("cacheWriteInputTokens", 0),
+        }
+        with self._lock:
+            if self.call_writer is not None:
+                self.call_writer.writerow(call)
+            stage = self.stages.setdefault(
+                call["stage"],
+                {
+                    "calls": 0,
+                    "outcomes": {},
+                    "queue_wait_s": Reservoir(),
+                    "latency_s": Reservoir(),
+                    "ttft_s": Reservoir(),
+                    "input_tokens": Reservoir(),
+                    "output_tokens": Reservoir(),
+                    "cache_read_tokens": 0,
+                    "cache_write_tokens": 0,
+                },
+            )
+            stage["calls"] += 1
+            stage["outcomes"][outcome] = stage["outcomes"].get(outcome, 0) + 1
+            for field in ("queue_wait_s", "latency_s", "ttft_s", "input_tokens", "output_tokens"):
+                if call[field] is not None:
+                    stage[field].add(call[field])
+            stage["cache_read_tokens"] += call["cache_read_tokens"]
+            stage["cache_write_tokens"] += call["cache_write_tokens"]
+
+    def report(self, usage: UsageTracker) -> Dict[str, Any]:
+        with self._lock:
+            return {
+                "started": datetime.fromtimestamp(self.started).isoformat(),
+                "wall_time_s": time.time() - self.started,
+                "timings_s": {
+                    name: values.distribution() for name, values in self.timings.items()
+                },
+                "model_calls": {
+                    name: {
+                        key: value.distribution() if isinstance(value, Reservoir) else value
+                        for key, value in stage.items()
+                    }
+                    for name, stage in self.stages.items()
+                },
+                "usage": {
+                    "input_tokens": usage.input_tokens,
+                    "output_tokens": usage.output_tokens,
+                    "cache_read_tokens": usage.cache_read_tokens,
+                    "cache_write_tokens": usage.cache_write_tokens,
+                    "cost_usd": usage.cost,
+                },
+            }
+
+    def write_report(self, usage: UsageTracker, json_file: str):
+        report = self.report(usage)
+        with open(json_file, "w") as f:
+            json.dump(report, f, indent=2)
+        with self._lock:
+            if self.call_log is not None:
+                self.call_log.close()
+                self.call_log = self.call_writer = None
+        return report
+
+
+# Shared by the whole run; main() sets METRICS.stage as it moves between stages
+METRICS = RunMetrics()
+
+
+def is_throttling_error(e: ClientError) -> bool:
+    return e.response.get("Error", {}).get("Code") in THROTTLING_ERROR_CODES
+
+
+class RateLimitedClient:
+    """Wraps a Bedrock client so every converse call goes through the RateLimiter."""
+
+    def __init__(
+        self,
+        client: Any,
+        limiter: RateLimiter,
+        usage: UsageTracker,
+        hedge_after: float = 0,
+        deadline: float = 0,
+    ):
+        self.client = client
+        self.limiter = limiter
+        self.usage = usage
+        self.hedge_after = hedge_after
+        self.deadline = deadline
+        self.hedges = 0
+        self.timeouts = 0
+        self._lock = threading.Lock()
+
+    def hedge_wait(self, started: float, hedged: bool) -> Tuple[bool, Optional[float]]:
+        # Whether the next wait ends in a hedge rather than the deadline, and how long
+        # it lasts. A hedge is only worth sending if it has time to finish before the
+        # deadline.
+        hedging = bool(
+            self.hedge_after
+            and not hedged
+            and (not self.deadline or self.hedge_after < self.deadline)
+        )
+        until = self.hedge_after if hedging else self.deadline
+        return hedging, max(0, started + until - time.monotonic()) if until else None
+
+    def timed_out(self, model_id: str, started: float) -> RequestTimeoutError:
+        with self._lock:
+            self.timeouts += 1
+        METRICS.record_call(model_id, "timeout", None, time.monotonic() - started)
+        return RequestTimeoutError(f"No response from {model_id} within {self.deadline}s")
+
+    def _start(self, kwargs: Dict[str, Any], attempt: Dict[str, Any]) -> Future:
+        # Each copy gets its own thread rather than a pool's, so that copies left
+        # running after losing or timing out never hold up new requests
+        future: Future = Future()
+
+        def run():
+            future.set_running_or_notify_cancel()
+            try:
+                future.set_result(self._converse(kwargs, attempt))
+            except BaseException as e:
+                future.set_exception(e)
+            finally:
+                attempt["sent"].set()
+
+        threading.Thread(target=run, daemon=True).start()
+        return future
+
+    def converse(self, **kwargs) -> Dict[str, Any]:
+        if not self.hedge_after and not self.deadline:
+            return self._converse(kwargs)
+        attempt: Dict[str, Any] = {"sent": threading.Event()}
+        futures = {self._start(kwargs, attempt): attempt}
+        # Time spent waiting on the rate limiter doesn't make a request slow, so the
+        # clock starts once it has actually been sent
+        attempt["sent"].wait()
+        started = time.monotonic()
+        hedged = False
+        try:
+            while True:
+                hedging, timeout = self.hedge_wait(started, hedged)
+                done, _ = wait(futures, timeout=timeout, return_when=FIRST_COMPLETED)
+                for future in done:
+                    futures.pop(future)
+                    # The first answer wins. A failure only counts once nothing is left
+                    # that could still answer.
+                    if future.exception() is None or not futures:
+                        return future.result()
+                if done:
+                    continue
+                if hedging:
+                    # A second copy of a slow request often comes back before the first
+                    hedged = True
+                    with self._lock:
+                        self.hedges += 1
+                    attempt = {"sent": threading.Event()}
+                    futures[self._start(kwargs, attempt)] = attempt
+                    continue
+                raise self.timed_out(kwargs["modelId"], started)
+        finally:
+            # Threads can't be cancelled, so requests that lost or timed out run on,
+            # but they give up their place in the limiter for new work straight away
+            for attempt in futures.values():
+                self._release(attempt, None, False)
+
+    def _release(self, attempt: Dict[str, Any], used_tokens: Optional[int], throttled: bool):
+        with self._lock:
+            if attempt.get("released"):
+                return
+            attempt["released"] = True
+            if "estimated_tokens" not in attempt:
+                return
+        self.limiter.release(
+            attempt["estimated_tokens"], used_tokens, throttled, attempt.get("epoch")
+        )
+
+    def _converse(
+        self, kwargs: Dict[str, Any], attempt: Optional[Dict[str, Any]] = None
+    ) -> Dict[str, Any]:
+        attempt = {} if attempt is None else attempt
+        self.usage.check_budget()
+        estimated_tokens = request_token_estimate(kwargs)
+        queued = time.perf_counter()
+        epoch = self.limiter.acquire(estimated_tokens)
+        with self._lock:
+            abandoned = attempt.get("released")
+            attempt["estimated_tokens"] = estimated_tokens
+            attempt["epoch"] = epoch
+        if abandoned:
+            # The request was settled while this copy waited for the limiter
+            self.limiter.release(estimated_tokens, None, False)
+            raise RequestTimeoutError("Request was no longer needed")
+        if "sent" in attempt:
+            attempt["sent"].set()
+        started = time.perf_counter()
+        try:
+            response = self.client.converse(**kwargs)
+        except Exception as e:
+            return self.settle(kwargs, attempt, queued, started, error=e)
+        return self.settle(kwargs, attempt, queued, started, response)
+
+    def settle(
+        self,
+        kwargs: Dict[str, Any],
+        attempt: Dict[str, Any],
+        queued: float,
+        started: float,
+        response: Optional[Dict[str, Any]] = None,
+        error: Optional[BaseException] = None,
+    ) -> Dict[str, Any]:
+        # Records a finished request and frees its place in the limiter, for both the
+        # thread pool and asyncio clients. Errors are raised again, with throttling
+        # raised as ThrottledError.
+        model_id = kwargs["modelId"]
+        latency = time.perf_counter() - started
+        if error is None:
+            METRICS.record_call(model_id, "ok", started - queued, latency, response)
+            self._release(attempt, response.get("usage", {}).get("totalTokens"), False)
+            self.usage.record(model_id, response.get("usage", {}))
+            return response
+        throttled = isinstance(error, ClientError) and is_throttling_error(error)
+        self._release(attempt, None, throttled)
+        if isinstance(error, asyncio.CancelledError):
+            outcome = "cancelled"
+        else:
+            outcome = "throttled" if throttled else "error"
+        METRICS.record_call(model_id, outcome, started - queued, latency)
+        if throttled:
+            raise ThrottledError(str(error)) from error
+        raise error
+
+
+class AsyncRateLimitedClient:
+    def __init__(self, client: Any, rate_limited_client: RateLimitedClient):
+        self.client = client
+        self.rate_limited_client = rate_limited_client
+        self.limiter = rate_limited_client.limiter
+        self.usage = rate_limited_client.usage
+
+    async def converse(self, **kwargs) -> Dict[str, Any]:
+        # Hedges and timeouts are counted on the shared client, so they're reported
+        # the same way whichever path made the requests
+        shared = self.rate_limited_client
+        if not shared.hedge_after and not shared.deadline:
+            return await self._converse(kwargs)
+        sent = asyncio.Event()
+        tasks = [asyncio.ensure_future(self._converse(kwargs, sent))]
+        tasks[0].add_done_callback(lambda _: sent.set())
+        try:
+            await sent.wait()
+            started = time.monotonic()
+            hedged = False
+            while True:
+                hedging, timeout = shared.hedge_wait(started, hedged)
+                done, _ = await asyncio.wait(
+                    tasks, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                for task in done:
+                    tasks.remove(task)
+                    if task.exception() is None or not tasks:
+                        return task.result()
+                if done:
+                    continue
+                if hedging:
+                    hedged = True
+                    shared.hedges += 1
+                    tasks.append(asyncio.ensure_future(self._converse(kwargs)))
+                    continue
+                raise shared.timed_out(kwargs["modelId"], started)
+        finally:
+            # Unlike threads, the requests that lost can be cancelled
+            for task in tasks:
+                task.cancel()
+
+    async def _converse(
+        self, kwargs: Dict[str, Any], sent: Optional[asyncio.Event] = None
+    ) -> Dict[str, Any]:
+        self.usage.check_budget()
+        estimated_tokens = request_token_estimate(kwargs)
+        queued = time.perf_counter()
+        epoch = await self.limiter.acquire_async(estimated_tokens)
+        attempt = {"estimated_tokens": estimated_tokens, "epoch": epoch}
+        if sent is not None:
+            sent.set()
+        started = time.perf_counter()
+        shared = self.rate_limited_client
+        try:
+            response = await self.client.converse(**kwargs)
+        except (Exception, asyncio.CancelledError) as e:
+            return shared.settle(kwargs, attempt, queued, started, error=e)
+        return shared.settle(kwargs, attempt, queued, started, response)
+
+
+def backend_error(code: str, message: str) -> ClientError:
+    # Non-Bedrock backends raise the same ClientError as boto3, so throttling and
+    # error handling work the same whichever backend a stage uses
+    return ClientError({"Error": {"Code": code, "Message": message}}, "Converse")
+
+
+class OpenAICompatibleClient:
+    """Sends Converse-style requests to an OpenAI-compatible chat completions endpoint."""
+
+    def __init__(self, base_url: str, api_key: Optional[str], max_connections: int, timeout: float):
+        url = urllib.parse.urlparse(base_url.rstrip("/"))
+        self.connection_class = (
+            http.client.HTTPSConnection if url.scheme == "https" else http.client.HTTPConnection
+        )
+        self.netloc = url.netloc
+        self.path = f"{url.path}/chat/completions"
+        self.headers = {"Content-Type": "application/json"}
+        if api_key:
+            self.headers["Authorization"] = f"Bearer {api_key}"
+        self.timeout = timeout
+        # Keep-alive connections are reused across requests rather than opened per call
+        self.pool: queue.LifoQueue = queue.LifoQueue(maxsize=max_connections)
+
+    def _connection(self) -> http.client.HTTPConnection:
+        try:
+            return self.pool.get_nowait()
+        except queue.Empty:
+            return self.connection_class(self.netloc, timeout=self.timeout)
+
+    def _release(self, connection: http.client.HTTPConnection):
+        try:
+            self.pool.put_nowait(connection)
+        except queue.Full:
+            connection.close()
+
+    def converse(self, **kwargs) -> Dict[str, Any]:
+        # cachePoint blocks are dropped; servers such as vLLM and llama.cpp cache the
+        # shared system prefix on their own
+        system = "\n\n".join(block["text"] for block in kwargs["system"] if "text" in block)
+        messages = [{"role": "system", "content": system}] + [
+            {
+                "role": message["role"],
+                "content": "".join(
+                    block["text"] for block in message["content"] if "text" in block
+                ),
+            }
+            for message in kwargs["messages"]
+        ]
+        inference_config = kwargs["inferenceConfig"]
+        body = json.dumps(
+            {
+                "model": kwargs["modelId"],
+                "messages": messages,
+                "max_tokens": inference_config["maxTokens"],
+                "temperature": inference_config["temperature"],
+                "top_p": inference_config["topP"],
+            }
+        )
+
+        connection = self._connection()
+        try:
+            connection.request("POST", self.path, body=body, headers=self.headers)
+            response = connection.getresponse()
+            payload = response.read()
+        except (OSError, http.client.HTTPException) as e:
+            connection.close()
+            raise backend_error("ServiceUnavailableException", str(e)) from e
+        self._release(connection)
+
+        if response.status == 429:
+            raise backend_error("ThrottlingException", payload.decode(errors="replace"))
+        if response.status >= 500:
+            raise backend_error("ServiceUnavailableException", payload.decode(errors="replace"))
+        if response.status >= 400:
+            raise backend_error(f"HTTP{response.status}", payload.decode(errors="replace"))
+
+        result = json.loads(payload)
+        choice = result["choices"][0]
+        usage = result.get("usage") or {}
+        cached_tokens = (usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0
+        return {
+            "output": {
+                "message": {
+                    "role": "assistant",
+                    "content": [{"text": choice["message"]["content"] or ""}],
+                }
+            },
+            "stopReason": choice.get("finish_reason"),
+            "usage": {
+                "inputTokens": usage.get("prompt_tokens", 0) - cached_tokens,
+                "outputTokens": usage.get("completion_tokens", 0),
+                "totalTokens": usage.get("total_tokens", 0),
+                "cacheReadInputTokens": cached_tokens,
+            },
+        }
+
+
+class StubClient:
+    """Deterministic offline backend that answers every request without a network call."""
+
+    def __init__(
+        self,
+        latency_ms: float = 0,
+        jitter_ms: float = 0,
+        throttle_rate: float = 0,
+        response_tokens: int = 0,
+        seed: int = 0,
+        latency_per_1k_tokens_ms: float = 0,
+        straggler_rate: float = 0,
+    ):
+        self.latency = latency_ms / 1000
+        self.jitter = jitter_ms / 1000
+        self.throttle_rate = throttle_rate
+        self.latency_per_1k_tokens = latency_per_1k_tokens_ms / 1000
+        self.straggler_rate = straggler_rate
+        self.filler = " stub" * (response_tokens * 4 // 5)
+        # Latency and throttling are random but repeatable for a given seed
+        self.random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def converse(self, **kwargs) -> Dict[str, Any]:
+        with self._lock:
+            delay = max(0.0, self.latency + self.random.uniform(-self.jitter, self.jitter))
+            throttled = self.random.random() < self.throttle_rate
+            # A few requests take ten times as long, like a slow host on a real backend
+            if self.random.random() < self.straggler_rate:
+                delay *= 10
+        delay += request_input_tokens(kwargs) / 1000 * self.latency_per_1k_tokens
+        if delay:
+            time.sleep(delay)
+        if throttled:
+            raise backend_error("ThrottlingException", "Simulated throttling")
+        text = "".join(
+            block["text"]
+            for message in kwargs["messages"]
+            for block in message["content"]
+            if "text" in block
+        )
+        digest = hash_content(text)[:12]
+
+        if PACK_RESPONSE_INSTRUCTION in text:
+            sections = []
+            for file_path in re.findall(r"^File: (.+)$", text, re.MULTILINE):
+                section = f"### FILE: {file_path}\nStub summary {digest} of {file_path}.{self.filler}"
+                if PACK_MODERNISATION_INSTRUCTION in text:
+                    section += "\n#### Modernisation Recommendations\nNo recommendations."
+                sections.append(section)
+            output = "\n\n".join(sections)
+        elif text.startswith(COMBINED_RESPONSE_INSTRUCTION):
+            output = json.dumps(
+                {
+                    "summary": f"Stub summary {digest} of {len(text)} characters.{self.filler}",
+                    "modernisation_recommendations": "No recommendations.",
+                }
+            )
+        else:
+            output = f"Stub response {digest} to {len(text)} characters.{self.filler}"
+
+        input_tokens = request_input_tokens(kwargs)
+        output_tokens = estimate_tokens(output)
+        return {
+            "output": {"message": {"role": "assistant", "content": [{"text": output}]}},
+            "stopReason": "end_turn",
+            "usage": {
+                "inputTokens": input_tokens,
+                "outputTokens": output_tokens,
+                "totalTokens": input_tokens + output_tokens,
+            },
+        }
+
+    def converse_stream(self, **kwargs) -> Dict[str, Any]:
+        response = self.converse(**kwargs)
+        text = response_text(response)
+        return {
+            "stream": iter(
+                [
+                    {"messageStart": {"role": "assistant"}},
+                    *(
+                        {"contentBlockDelta": {"contentBlockIndex": 0, "delta": {"text": text[i : i + 64]}}}
+                        for i in range(0, len(text), 64)
+                    ),
+                    {"contentBlockStop": {"contentBlockIndex": 0}},
+                    {"messageStop": {"stopReason": response["stopReason"]}},
+                    {"metadata": {"usage": response["usage"], "metrics": {"latencyMs": 0}}},
+                ]
+            )
+        }
+
+
+class StreamingClient:
+    """Sends each request with converse_stream to time the first token, returning a converse response."""
+
+    def __init__(self, client: Any):
+        self.client = client
+
+    def converse(self, **kwargs) -> Dict[str, Any]:
+        started = time.perf_counter()
+        response = self.client.converse_stream(**kwargs)
+        first_token = None
+        blocks: Dict[int, List[str]] = {}
+        result = {"stopReason": None, "usage": {}, "metrics": {}}
+        for event in response["stream"]:
+            if "contentBlockDelta" in event:
+                if first_token is None:
+                    first_token = time.perf_counter() - started
+                delta = event["contentBlockDelta"]
+                blocks.setdefault(delta.get("contentBlockIndex", 0), []).append(
+                    delta.get("delta", {}).get("text", "")
+                )
+            elif "messageStop" in event:
+                result["stopReason"] = event["messageStop"].get("stopReason")
+            elif "metadata" in event:
+                result["usage"] = event["metadata"].get("usage", {})
+                result["metrics"] = dict(event["metadata"].get("metrics", {}))
+        result["output"] = {
+            "message": {
+                "role": "assistant",
+                "content": [{"text": "".join(blocks[i])} for i in sorted(blocks)] or [{"text": ""}],
+            }
+        }
+        if first_token is not None:
+            result["metrics"]["timeToFirstTokenMs"] = first_token * 1000
+        return result
+
+
+def create_backend_client(config: Dict[str, Any], max_connections: int) -> Any:
+    client = create_base_client(config, max_connections)
+    # Streaming measures the time to the first token, for backends that support it
+    if config.get("stream_requests", False) and hasattr(client, "converse_stream"):
+        return StreamingClient(client)
+    return client
+
+
+def create_base_client(config: Dict[str, Any], max_connections: int) -> Any:
+    backend = config.get("backend", "bedrock")
+    if backend == "bedrock":
+        return boto3.client(
+            service_name="bedrock-runtime",
+            region_name=config["aws_region"],
+            config=Config(
+                retries={"max_attempts": 5, "mode": "standard"},
+                # botocore only pools 10 connections by default, which would cap parallel
+                max_pool_connections=max(10, max_connections),
+            ),
+        )
+    if backend == "openai":
+        api_key_env = config.get("api_key_env", "OPENAI_API_KEY")
+        return OpenAICompatibleClient(
+            config.get("base_url", "http://localhost:8000/v1"),
+            os.environ.get(api_key_env),
+            max_connections,
+            config.get("request_timeout", 300),
+        )
+    if backend == "stub":
+        return StubClient(
+            config.get("stub_latency_ms", 0),
+            config.get("stub_jitter_ms", 0),
+            config.get("stub_throttle_rate", 0),
+            config.get("stub_response_tokens", 0),
+            config.get("stub_seed", 0),
+            config.get("stub_latency_per_1k_tokens_ms", 0),
+            config.get("stub_straggler_rate", 0),
+        )
+    raise ValueError(f"Unknown backend '{backend}', expected bedrock, openai or stub")
+
+
+def stage_config(config: Dict[str, Any], stage: str) -> Dict[str, Any]:
+    # Settings under backends.<stage> override the top-level config for that stage
+    return {**config, **config.get("backends", {}).get(stage, {})}
+
+
+def create_stage_clients(
+    config: Dict[str, Any], stages: List[str]
+) -> Dict[str, RateLimitedClient]:
+    # Stages with identical settings share one client, so they also share its
+    # connection pool and rate limits. The usage tracker is shared by every stage
+    # so that max_cost_usd covers the whole run.
+    usage = UsageTracker(config)
+    clients, stage_clients = {}, {}
+    for stage in stages:
+        settings = config.get("backends", {}).get(stage, {})
+        key = json.dumps(settings, sort_keys=True)
+        if key not in clients:
+            settings_config = stage_config(config, stage)
+            max_concurrency = (
+                settings_config.get("max_in_flight_requests", 64)
+                if settings_config.get("async_requests")
+                else settings_config.get("parallel") or 1
+            )
+            clients[key] = RateLimitedClient(
+                create_backend_client(settings_config, max_concurrency),
+                RateLimiter(settings_config, max_concurrency),
+                usage,
+                settings_config.get("hedge_after_seconds") or 0,
+                settings_config.get("request_deadline_seconds") or 0,
+            )
+        stage_clients[stage] = clients[key]
+    return stage_clients
+
+
+def throttle_backoff(attempt: int) -> float:
+    return min(60.0, 2**attempt) * random.uniform(0.5, 1.0)
+
+
+def call_with_backoff(config: Dict[str, Any], function: Any, *args) -> Any:
+    # Used for the one-off supersummary/final calls, which can't be requeued like files
+    max_retries = config.get("max_throttle_retries", 8)
+    for attempt in range(max_retries + 1):
+        try:
+            return function(*args)
+        except ThrottledError as e:
+            if attempt == max_retries:
+                print(f"ERROR: Still throttled after {max_retries} retries. Reason: {e}")
+                return None
+            time.sleep(throttle_backoff(attempt))
+
+
+def record_result(
+    file_path: str,
+    summary: Dict[str, str],
+    store: StateStore,
+    state: Dict[str, Any],
+    sink: "MarkdownSink",
+    version: Optional[Tuple[str, float]] = None,
+):
+    # Duplicates of this file share its summary, with each copy pointing at the others
+    duplicates = state.get("duplicates", {}).pop(file_path, [])
+    if duplicates:
+        store_result(
+            file_path,
+            {**summary, "duplicates": [path for path, _ in duplicates]},
+            store,
+            state,
+            sink,
+            version,
+        )
+    else:
+        store_result(file_path, summary, store, state, sink, version)
+    for duplicate, similarity in duplicates:
+        store_result(
+            duplicate,
+            {**summary, "duplicate_of": file_path, "similarity": similarity},
+            store,
+            state,
+            sink,
+        )
+
+
+def store_result(
+    file_path: str,
+    summary: Dict[str, Any],
+    store: StateStore,
+    state: Dict[str, Any],
+    sink: "MarkdownSink",
+    version: Optional[Tuple[str, float]] = None,
+):
+    # The version is the hash and mtime of the content that was summarised. Copies of
+    # a file weren't read for the request, so theirs is read now.
+    if version is None:
+        try:
+            version = (hash_file(file_path), os.path.getmtime(file_path))
+        except OSError as e:
+            # Left out of the state, so a later run picks it up again if it comes back
+            print(f"ERROR: Can't read '{file_path}'. Reason: {e}")
+            return
+    file_hash, mtime = version
+    with METRICS.timer("output_write"):
+        sink.write(file_path, summary)
+    with METRICS.timer("state_write"):
+        store.record_file(file_path, file_hash, mtime, summary)
+    state["processed_files"].add(file_path)
+    state["summaries"][file_path] = summary
+    state["file_hashes"][file_path] = file_hash
+    state["file_mtimes"][file_path] = mtime
+    if "duplicate_of" in summary:
+        state["duplicate_of"][file_path] = summary["duplicate_of"]
+    else:
+        state["duplicate_of"].pop(file_path, None)
+
+
+def plan_work_items(
+    files: List[str], config: Dict[str, Any], index: Optional[FileIndex] = None
+) -> List[Tuple[str, ...]]:
+    # Files too small to be worth a request of their own are packed together, using
+    # their size on disk as a cheap token estimate
+    pack_below = config.get("pack_files_below_tokens") or 0
+    pack_max_tokens = config.get("pack_max_tokens", 4000)
+    pack_max_files = config.get("pack_max_files", 10)
+
+    work_items, pack, pack_tokens = [], [], 0
+    item_tokens = {}
+    for file_path in files:
+        try:
+            size = index.stats[file_path][0] if index else os.path.getsize(file_path)
+            tokens = size // 4
+        except (KeyError, OSError):
+            tokens = pack_below
+        if tokens >= pack_below:
+            work_items.append((file_path,))
+            item_tokens[work_items[-1]] = tokens
+            continue
+        if pack and (
+            pack_tokens + tokens > pack_max_tokens or len(pack) >= pack_max_files
+        ):
+            work_items.append(tuple(pack))
+            item_tokens[work_items[-1]] = pack_tokens
+            pack, pack_tokens = [], 0
+        pack.append(file_path)
+        pack_tokens += tokens
+    if pack:
+        work_items.append(tuple(pack))
+        item_tokens[work_items[-1]] = pack_tokens
+    if config.get("longest_first", True):
+        # The slowest requests start first, so the run doesn't end waiting on one
+        # large file that happened to be picked up last
+        work_items.sort(key=item_tokens.__getitem__, reverse=True)
+    return work_items
+
+
+class BatchProgress:
+    """Result handling shared by the thread pool and asyncio batch paths, always called from one thread."""
+
+    def __init__(
+        self,
+        files: List[str],
+        config: Dict[str, Any],
+        store: StateStore,
+        state: Dict[str, Any],
+        sink: "MarkdownSink",
+    ):
+        self.store = store
+        self.state = state
+        self.sink = sink
+        self.max_retries = config.get("max_throttle_retries", 8)
+        self.attempts: Dict[Tuple[str, ...], int] = {}
+        self.completed: Set[str] = set()
+        self.start_time = time.monotonic()
+        self.progress = tqdm.tqdm(total=len(files) or None, desc="Processing files")
+
+    def record(
+        self,
+        item: Tuple[str, ...],
+        results: Dict[str, Dict[str, str]],
+        versions: Dict[str, Tuple[str, float]],
+    ):
+        # Results are only handled on one thread, so the state and output file never
+        # see concurrent writers
+        for file_path, summary in results.items():
+            self.completed.add(file_path)
+            record_result(
+                file_path, summary, self.store, self.state, self.sink, versions.get(file_path)
+            )
+        elapsed = time.monotonic() - self.start_time
+        self.progress.set_postfix(files_per_sec=f"{len(self.completed) / elapsed:.2f}")
+        self.progress.update(len(item))
+
+    def retry_delay(self, item: Tuple[str, ...], error: Exception) -> Optional[float]:
+        # How long to back off before retrying a failed work item, or None once it's
+        # been given up on. Its files are left out of the state either way, so that a
+        # later run picks them up.
+        if isinstance(error, ThrottledError):
+            self.attempts[item] = self.attempts.get(item, 0) + 1
+            if self.attempts[item] <= self.max_retries:
+                return throttle_backoff(self.attempts[item])
+            print(f"ERROR: '{', '.join(item)}' still throttled after {self.max_retries} retries. Reason: {error}")
+        elif isinstance(error, (OSError, UnicodeDecodeError)):
+            print(f"ERROR: Can't read '{', '.join(item)}'. Reason: {error}")
+        elif not isinstance(error, BudgetExceededError):
+            raise error
+        self.progress.update(len(item))
+        return None
+
+    def close(self) -> Set[str]:
+        self.progress.close()
+        elapsed = time.monotonic() - self.start_time
+        throughput = len(self.completed) / elapsed if elapsed > 0 else 0.0
+        print(
+            f"Processed {len(self.completed)} files in {elapsed:.1f}s ({throughput:.2f} files/sec)."
+        )
+        return self.completed
+
+
+def process_batch(
+    files: List[str],
+    bedrock_client: Any,
+    config: Dict[str, Any],
+    store: StateStore,
+    state: Dict[str, Any],
+    sink: "MarkdownSink",
+    cache: Optional[SummaryCache] = None,
+    index: Optional[FileIndex] = None,
+    project_tree: str = "",
+    work_items: Optional[Iterable[Tuple[str, ...]]] = None,
+) -> Set[str]:
+    # Work items can also be passed in as an iterator, which is read only as
+    # workers free up, so that a worker leasing from a queue never drains its pool
+    parallel = max(1, config.get("parallel") or 1)
+    if work_items is None:
+        work_items = plan_work_items(files, config, index)
+        print(
+            f"Processing batch of {len(files)} files in {len(work_items)} requests with {parallel} workers."
+        )
+    batch = BatchProgress(files, config, store, state, sink)
+
+    def process_item(item):
+        return run_plan(
+            work_item_plan(item, config, project_tree, cache, index), bedrock_client
+        )
+
+    retry_queue = []
+    # Work is only submitted while there's room in the window, so no more than this
+    # many work items' files and results are held in memory at once
+    window = parallel * 2
+    pending_items = iter(work_items)
+
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        future_to_item = {}
+        while True:
+            # Throttled files go back into the pool once their backoff has elapsed
+            while retry_queue and retry_queue[0][0] <= time.monotonic():
+                _, item = heapq.heappop(retry_queue)
+                future_to_item[executor.submit(process_item, item)] = item
+            for item in itertools.islice(
+                pending_items, max(0, window - len(future_to_item))
+            ):
+                future_to_item[executor.submit(process_item, item)] = item
+            if not future_to_item and not retry_queue:
+                break
+            timeout = (
+                max(0, retry_queue[0][0] - time.monotonic()) if retry_queue else None
+            )
+            if not future_to_item:
+                time.sleep(timeout)
+                continue
+
+            done, _ = wait(future_to_item, timeout=timeout, return_when=FIRST_COMPLETED)
+            for future in done:
+                item = future_to_item.pop(future)
+                try:
+                    results, versions = future.result()
+                except Exception as e:
+                    delay = batch.retry_delay(item, e)
+                    if delay is not None:
+                        heapq.heappush(retry_queue, (time.monotonic() + delay, item))
+                    continue
+                batch.record(item, results, versions)
+    return batch.close()
+
+
+class ThreadedAsyncClient:
+    """Async facade over a blocking client, for non-Bedrock backends or when aiobotocore isn't installed."""
+
+    def __init__(self, bedrock_client: Any):
+        self.bedrock_client = bedrock_client
+
+    async def converse(self, **kwargs) -> Dict[str, Any]:
+        return await asyncio.to_thread(self.bedrock_client.converse, **kwargs)
+
+
+@contextlib.asynccontextmanager
+async def async_bedrock_client(config: Dict[str, Any], bedrock_client: Any):
+    max_in_flight = config.get("max_in_flight_requests", 64)
+    try:
+        if config.get("backend", "bedrock") != "bedrock":
+            # Only Bedrock has a native async client, other backends use the thread pool
+            raise ImportError
+        from aiobotocore.config import AioConfig
+        from aiobotocore.session import get_session
+    except ImportError:
+        if config.get("backend", "bedrock") == "bedrock":
+            print(
+                "aiobotocore is not installed, running requests on a thread pool instead. (Tip: You can install it by running `pip install -r requirements-async.txt`)"
+            )
+        asyncio.get_running_loop().set_default_executor(
+            ThreadPoolExecutor(max_workers=max_in_flight)
+        )
+        yield AsyncRateLimitedClient(
+            ThreadedAsyncClient(bedrock_client.client), bedrock_client
+        )
+        return
+
+    async with get_session().create_client(
+        "bedrock-runtime",
+        region_name=config["aws_region"],
+        config=AioConfig(
+            retries={"max_attempts": 5, "mode": "standard"},
+            max_pool_connections=max_in_flight,
+        ),
+    ) as client:
+        yield AsyncRateLimitedClient(client, bedrock_client)
+
+
+async def process_batch_async(
+    files: List[str],
+    bedrock_client: Any,
+    config: Dict[str, Any],
+    store: StateStore,
+    state: Dict[str, Any],
+    sink: "MarkdownSink",
+    cache: Optional[SummaryCache] = None,
+    index: Optional[FileIndex] = None,
+    project_tree: str = "",
+    work_items: Optional[Iterable[Tuple[str, ...]]] = None,
+) -> Set[str]:
+    max_in_flight = max(1, config.get("max_in_flight_requests", 64))
+    if work_items is None:
+        work_items = plan_work_items(files, config, index)
+        workers = min(max_in_flight, len(work_items))
+        print(
+            f"Processing batch of {len(files)} files in {len(work_items)} requests with up to {max_in_flight} requests in flight."
+        )
+    else:
+        workers = max_in_flight
+    batch = BatchProgress(files, config, store, state, sink)
+    # Throttled work goes on the retry queue, which is emptied before new work
+    retry_queue: asyncio.Queue = asyncio.Queue()
+    pending_items = iter(work_items)
+
+    async def worker(async_client):
+        # Each worker has at most one work item in flight, so the number of workers is
+        # the in-flight window. Reading files and recording results all happen on the
+        # event loop thread while other workers are waiting on the network.
+        while True:
+            try:
+                item = retry_queue.get_nowait()
+            except asyncio.QueueEmpty:
+                item = next(pending_items, None)
+                if item is None:
+                    return
+            try:
+                results, versions = await run_plan_async(
+                    work_item_plan(item, config, project_tree, cache, index), async_client
+                )
+            except Exception as e:
+                delay = batch.retry_delay(item, e)
+                if delay is not None:
+                    # Back off, then put the work back on the queue to be retried
+                    await asyncio.sleep(delay)
+                    retry_queue.put_nowait(item)
+                continue
+            batch.record(item, results, versions)
+
+    async with async_bedrock_client(config, bedrock_client) as async_client:
+        await asyncio.gather(*(worker(async_client) for _ in range(workers)))
+    return batch.close()
+
+
+def converse_to_model_input(request: Dict[str, Any]) -> Dict[str, Any]:
+    # Batch jobs take each model's native request body rather than the Converse shape
+    if "anthropic." not in request["modelId"]:
+        raise ValueError(
+            f"Batch inference is only supported for Anthropic models, not {request['modelId']}"
+        )
+    inference_config = request["inferenceConfig"]
+    return {
+        "anthropic_version": "bedrock-2023-05-31",
+        "max_tokens": inference_config["maxTokens"],
+        "temperature": inference_config["temperature"],
+        "top_p": inference_config["topP"],
+        "system": "\n\n".join(
+            block["text"] for block in request["system"] if "text" in block
+        ),
+        "messages": [
+            {
+                "role": message["role"],
+                "content": [
+                    {"type": "text", "text": block["text"]}
+                    for block in message["content"]
+                    if "text" in block
+                ],
+            }
+            for message in request["messages"]
+        ],
+    }
+
+
+def model_output_to_converse(model_output: Dict[str, Any]) -> Dict[str, Any]:
+    usage = model_output.get("usage", {})
+    input_tokens = usage.get("input_tokens", 0)
+    output_tokens = usage.get("output_tokens", 0)
+    return {
+        "output": {
+            "message": {
+                "role": "assistant",
+                "content": [
+                    {"text": "".join(
+                        block.get("text", "") for block in model_output["content"]
+                    )}
+                ],
+            }
+        },
+        "usage": {
+            "inputTokens": input_tokens,
+            "outputTokens": output_tokens,
+            "totalTokens": input_tokens + output_tokens,
+        },
+    }
+
+
+class S3BatchStorage:
+    """Reads and writes batch job files under an s3:// prefix."""
+
+    def __init__(self, uri: str, region: str):
+        url = urllib.parse.urlparse(uri)
+        self.bucket = url.netloc
+        self.prefix = url.path.lstrip("/")
+        if self.prefix and not self.prefix.endswith("/"):
+            self.prefix += "/"
+        self.s3 = boto3.client("s3", region_name=region)
+
+    def uri(self, key: str) -> str:
+        return f"s3://{self.bucket}/{self.prefix}{key}"
+
+    def write_lines(self, key: str, lines: Iterator[str]):
+        # Job files can be large, so they're spooled to disk and uploaded in parts
+        with tempfile.TemporaryFile("w+b") as f:
+            for line in lines:
+                f.write(line.encode() + b"\n")
+            f.seek(0)
+            self.s3.upload_fileobj(f, self.bucket, self.prefix + key)
+
+    def list(self, key_prefix: str) -> List[str]:
+        keys = []
+        paginator = self.s3.get_paginator("list_objects_v2")
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.prefix + key_prefix):
+            keys.extend(obj["Key"][len(self.prefix) :] for obj in page.get("Contents", []))
+        return keys
+
+    def read_lines(self, key: str) -> Iterator[str]:
+        body = self.s3.get_object(Bucket=self.bucket, Key=self.prefix + key)["Body"]
+        for line in body.iter_lines():
+            yield line.decode()
+
+
+class DirectoryBatchStorage:
+    """Local stand-in for S3BatchStorage that keeps job files in a directory."""
+
+    def __init__(self, directory: str):
+        self.directory = directory
+
+    def uri(self, key: str) -> str:
+        return os.path.join(self.directory, key)
+
+    def write_lines(self, key: str, lines: Iterator[str]):
+        path = self.uri(key)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "w") as f:
+            for line in lines:
+                f.write(line + "\n")
+
+    def list(self, key_prefix: str) -> List[str]:
+        return sorted(
+            os.path.relpath(path, self.directory)
+            for path in glob.glob(os.path.join(self.directory, key_prefix + "*"))
+            if os.path.isfile(path)
+        )
+
+    def read_lines(self, key: str) -> Iterator[str]:
+        with open(self.uri(key), "r") as f:
+            for line in f:
+                yield line.rstrip("\n")
+
+
+class LocalBatchJobs:
+    """Stands in for the Bedrock batch API, running each job's records through a local client when it's polled."""
+
+    def __init__(self, storage: DirectoryBatchStorage, client: Any):
+        self.storage = storage
+        self.client = client
+
+    def create_model_invocation_job(self, **kwargs) -> Dict[str, Any]:
+        job_id = hash_content(kwargs["jobName"])[:12]
+        self.storage.write_lines(f"jobs/{job_id}.json", [json.dumps(kwargs)])
+        return {"jobArn": f"arn:local:bedrock:model-invocation-job/{job_id}"}
+
+    def get_model_invocation_job(self, jobIdentifier: str) -> Dict[str, Any]:
+        job_id = jobIdentifier.rsplit("/", 1)[-1]
+        job = json.loads(next(self.storage.read_lines(f"jobs/{job_id}.json")))
+        input_key = os.path.relpath(
+            job["inputDataConfig"]["s3InputDataConfig"]["s3Uri"], self.storage.directory
+        )
+        output_dir = os.path.relpath(
+            job["outputDataConfig"]["s3OutputDataConfig"]["s3Uri"], self.storage.directory
+        )
+        output_key = f"{output_dir}/{job_id}/{os.path.basename(input_key)}.out"
+        if not self.storage.list(output_key):
+            self.storage.write_lines(output_key, self._run(job, input_key))
+        return {"status": "Completed"}
+
+    def _run(self, job: Dict[str, Any], input_key: str) -> Iterator[str]:
+        for line in self.storage.read_lines(input_key):
+            record = json.loads(line)
+            model_input = record["modelInput"]
+            response = self.client.converse(
+                modelId=job["modelId"],
+                system=[{"text": model_input["system"]}],
+                messages=[
+                    {
+                        "role": message["role"],
+                        "content": [{"text": block["text"]} for block in message["content"]],
+                    }
+                    for message in model_input["messages"]
+                ],
+                inferenceConfig={
+                    "maxTokens": model_input["max_tokens"],
+                    "temperature": model_input["temperature"],
+                    "topP": model_input["top_p"],
+                },
+            )
+            usage = response["usage"]
+            record["modelOutput"] = {
+                "content": [{"type": "text", "text": response_text(response)}],
+                "usage": {
+                    "input_tokens": usage["inputTokens"],
+                    "output_tokens": usage["outputTokens"],
+                },
+            }
+            yield json.dumps(record)
+
+
+BATCH_FINISHED_STATUSES = {"Completed", "PartiallyCompleted", "Failed", "Stopped", "Expired"}
+
+
+def create_batch_service(config: Dict[str, Any]) -> Tuple[Any, Any]:
+    if config.get("batch_local_dir"):
+        storage = DirectoryBatchStorage(config["batch_local_dir"])
+        return LocalBatchJobs(storage, StubClient()), storage
+    return (
+        boto3.client("bedrock", region_name=config["aws_region"]),
+        S3BatchStorage(config["batch_s3_uri"], config["aws_region"]),
+    )
+
+
+def build_batch_records(
+    work_items: List[Tuple[str, ...]],
+    config: Dict[str, Any],
+    cache: Optional[SummaryCache],
+    index: Optional[FileIndex],
+    project_tree: str,
+    versions: Optional[Dict[str, Tuple[str, float]]] = None,
+) -> Tuple[
+    List[Dict[str, Any]],
+    Dict[str, Tuple[int, str]],
+    Dict[str, Dict[str, str]],
+    Dict[str, Optional[str]],
+]:
+    # Builds the same first requests file_plan()/file_pack_plan() would send.
+    # Returns the job records, which work item and result key each record belongs to,
+    # results already in the cache and the cache keys of the files being sent. Files
+    # left out of the records are summarised on demand afterwards.
+    records, record_owners, cached_results, cache_keys = [], {}, {}, {}
+    for n, item in enumerate(work_items):
+        if len(item) > 1:
+            results, contents, pack_cache_keys = read_pack_files(
+                list(item), config, cache, versions
+            )
+            cached_results.update(results)
+            if len(contents) < 2:
+                continue
+            cache_keys.update(pack_cache_keys)
+            requests = {
+                "pack": build_converse_request(
+                    config,
+                    build_pack_prompt(config, len(contents)),
+                    build_pack_context(contents),
+                    config["max_tokens"],
+                    project_tree,
+                )
+            }
+        else:
+            try:
+                content, cache_key, cached = read_cached_file(
+                    item[0], config, cache, versions
+                )
+            except (OSError, UnicodeDecodeError) as e:
+                # Leave the file out of the state so that a resumed run retries it
+                print(f"ERROR: Can't read '{item[0]}'. Reason: {e}")
+                continue
+            if cached is not None:
+                cached_results[item[0]] = cached
+                continue
+            contexts = chunk_contexts(item[0], content, config, index)
+            if len(contexts) > 1:
+                # Merging parts needs their responses first, so split files aren't batched
+                continue
+            cache_keys[item[0]] = cache_key
+            if combined_file_requests(config):
+                prompts = {"combined": (build_combined_prompt(config), config["max_tokens"] * 2)}
+            else:
+                prompts = {"summary": (config["file_prompt"], config["max_tokens"])}
+                if config.get("generate_file_modernisation_recommendations", False):
+                    prompts["modernisation_recommendations"] = (
+                        config["file_modernisation_prompt"],
+                        config["max_tokens"],
+                    )
+            requests = {
+                key: build_converse_request(
+                    config, prompt, contexts[0], max_tokens, project_tree
+                )
+                for key, (prompt, max_tokens) in prompts.items()
+            }
+
+        for key, request in requests.items():
+            record_id = f"{n:08d}-{key}"
+            records.append(
+                {"recordId": record_id, "modelInput": converse_to_model_input(request)}
+            )
+            record_owners[record_id] = (n, key)
+    return records, record_owners, cached_results, cache_keys
+
+
+def process_batch_job(
+    files: List[str],
+    bedrock_client: Any,
+    config: Dict[str, Any],
+    store: StateStore,
+    state: Dict[str, Any],
+    sink: "MarkdownSink",
+    cache: Optional[SummaryCache] = None,
+    index: Optional[FileIndex] = None,
+    project_tree: str = "",
+) -> Set[str]:
+    work_items = plan_work_items(files, config, index)
+    min_records = config.get("batch_min_records", 100)
+    versions: Dict[str, Tuple[str, float]] = {}
+    try:
+        if len(work_items) < min_records:
+            raise ValueError(
+                f"Only {len(work_items)} requests, fewer than the {min_records} a batch job needs"
+            )
+        records, record_owners, cached_results, cache_keys = build_batch_records(
+            work_items, config, cache, index, project_tree, versions
+        )
+    except ValueError as e:
+        print(f"{e}, processing on demand instead.")
+        return process_batch(
+            files, bedrock_client, config, store, state, sink, cache, index, project_tree
+        )
+    for file_path, summary in cached_results.items():
+        record_result(file_path, summary, store, state, sink, versions.get(file_path))
+    completed = set(cached_results)
+    del cached_results
+
+    if len(records) < min_records:
+        print(
+            f"Only {len(records)} requests, fewer than the {min_records} a batch job needs, processing on demand instead."
+        )
+        remaining = [f for f in files if f not in completed]
+        return completed | process_batch(
+            remaining, bedrock_client, config, store, state, sink, cache, index, project_tree
+        )
+
+    jobs, storage = create_batch_service(config)
+    job_name = f"treesummary-{datetime.now().strftime('%Y%m%d-%H%M%S')}"
+    input_key = f"input/{job_name}.jsonl"
+    storage.write_lines(input_key, (json.dumps(record) for record in records))
+    job_arn = jobs.create_model_invocation_job(
+        jobName=job_name,
+        roleArn=config.get("batch_role_arn", ""),
+        modelId=config["model_id"],
+        inputDataConfig={"s3InputDataConfig": {"s3Uri": storage.uri(input_key)}},
+        outputDataConfig={"s3OutputDataConfig": {"s3Uri": storage.uri("output")}},
+    )["jobArn"]
+    print(f"Submitted batch job {job_arn} with {len(records)} requests.")
+
+    poll_seconds = config.get("batch_poll_seconds", 60)
+    while True:
+        job = jobs.get_model_invocation_job(jobIdentifier=job_arn)
+        if job["status"] in BATCH_FINISHED_STATUSES:
+            break
+        print(f"Batch job is {job['status']}, checking again in {poll_seconds}s.")
+        time.sleep(poll_seconds)
+    print(f"Batch job finished with status {job['status']}.")
+    if job["status"] not in ("Completed", "PartiallyCompleted"):
+        print(f"ERROR: Batch job failed. Reason: {job.get('message', 'unknown')}")
+
+    # Results are recorded as they are read back, so a long output file never has
+    # to be held in memory and an interrupted run keeps what it has already read
+    job_id = job_arn.rsplit("/", 1)[-1]
+    pending: Dict[int, Dict[str, str]] = {}
+    price_factor = config.get("batch_price_factor", 0.5)
+    progress = tqdm.tqdm(total=len(files), desc="Reading batch results")
+    progress.update(len(completed))
+    for key in storage.list(f"output/{job_id}/"):
+        if not key.endswith(".jsonl.out"):
+            continue
+        for line in storage.read_lines(key):
+            record = json.loads(line)
+            if record.get("recordId") not in record_owners or "modelOutput" not in record:
+                continue
+            n, result_key = record_owners[record["recordId"]]
+            response = model_output_to_converse(record["modelOutput"])
+            METRICS.record_call(config["model_id"], "batch", None, None, response)
+            bedrock_client.usage.record(config["model_id"], response["usage"], price_factor)
+            text = response_text(response)
+            item = work_items[n]
+
+            if result_key == "pack":
+                results = parse_pack_response(text, list(item), config)
+            elif result_key == "combined":
+                result = parse_combined_response(text)
+                results = {item[0]: result} if result is not None else {}
+            else:
+                pending.setdefault(n, {})[result_key] = text
+                expected = 2 if config.get("generate_file_modernisation_recommendations", False) else 1
+                results = {item[0]: pending.pop(n)} if len(pending[n]) == expected else {}
+
+            for file_path, summary in results.items():
+                completed.add(file_path)
+                record_result(file_path, summary, store, state, sink, versions.get(file_path))
+                if cache is not None:
+                    cache.put(cache_keys[file_path], summary)
+            progress.update(len(results))
+    progress.close()
+
+    # Split files, failed records and anything that couldn't be parsed go on demand
+    remaining = [f for f in files if f not in completed]
+    if remaining:
+        print(f"Processing {len(remaining)} files the batch job didn't cover on demand.")
+        completed |= process_batch(
+            remaining, bedrock_client, config, store, state, sink, cache, index, project_tree
+        )
+    return completed
+
+
+DEPENDENCY_CONTEXT_LIMIT = 30
+
+
+def format_dependency_list(file_paths: List[str], root: str) -> str:
+    if not file_paths:
+        return "None"
+    listed = ", ".join(
+        os.path.relpath(f, root) for f in file_paths[:DEPENDENCY_CONTEXT_LIMIT]
+    )
+    if len(file_paths) > DEPENDENCY_CONTEXT_LIMIT:
+        listed += f" and {len(file_paths) - DEPENDENCY_CONTEXT_LIMIT} more"
+    return listed
+
+
+def build_file_context(
+    file_path: str, content: str, index: Optional[FileIndex] = None
+) -> str:
+    # With a dependency graph, a file's own imports and importers stand in for its
+    # directory listing, unless it has neither
+    if index is not None and index.dependencies is not None:
+        dependencies = index.dependencies.get(file_path, [])
+        dependents = (index.dependents or {}).get(file_path, [])
+        if dependencies or dependents:
+            return f"""
+Files imported by {os.path.basename(file_path)}:
+{format_dependency_list(dependencies, index.directory)}
+
+Files that import {os.path.basename(file_path)}:
+{format_dependency_list(dependents, index.directory)}
+
+File Content:
+{content}
+    """
+
+    directory = os.path.dirname(file_path)
+    if index is not None and (
+        directory in index.neighbourhoods or directory in index.subdirectories
+    ):
+        return f"""
+Files around {os.path.basename(file_path)}:
+{index.neighbourhood(directory)}
+
+File Content:
+{content}
+    """
+
+    files_in_directory = (
+        index.siblings(directory) if index else get_files_in_directory(directory)
+    )
+
+    return f"""
+Files in the same directory as {os.path.basename(file_path)}:
+{', '.join(files_in_directory)}
+
+File Content:
+{content}
+    """
+
+
+def build_converse_request(
+    config: Dict[str, Any],
+    prompt: str,
+    context: str,
+    max_tokens: int,
+    project_tree: str = "",
+) -> Dict[str, Any]:
+    # The project tree is the same for every file, so it goes in the system prompt
+    # where it forms a stable prefix that Bedrock can cache between requests
+    system = [{"text": config["system_prompt"]}]
+    if project_tree:
+        system.append({"text": f"Project Structure:\n{project_tree}"})
+        if config.get("prompt_caching", False):
+            system.append({"cachePoint": {"type": "default"}})
+
+    return {
+        "modelId": config["model_id"],
+        "messages": [
+            {
+                "role": "user",
+                "content": [{"text": f"{prompt}\n\n{context}"}],
+            }
+        ],
+        "system": system,
+        "inferenceConfig": {
+            "maxTokens": max_tokens,
+            "temperature": config["temperature"],
+            "topP": config["top_p"],
+        },
+    }
+
+
+def response_text(response: Dict[str, Any]) -> str:
+    return response["output"]["message"]["content"][0]["text"]
+
+
+@METRICS.timer("file_read")
+def read_cached_file(
+    file_path: str,
+    config: Dict[str, Any],
+    cache: Optional[SummaryCache],
+    versions: Optional[Dict[str, Tuple[str, float]]] = None,
+) -> Tuple[str, Optional[str], Optional[Dict[str, str]]]:
+    with open(file_path, "rb") as file:
+        data = file.read()
+        mtime = os.fstat(file.fileno()).st_mtime
+    # Decoded the same way open() in text mode would
+    content = io.TextIOWrapper(io.BytesIO(data)).read()
+    # The hash and mtime of the content actually sent are what gets recorded, as
+    # the file may change or disappear before its summary comes back
+    if versions is not None:
+        versions[file_path] = (hashlib.sha256(data).hexdigest(), mtime)
+
+    if cache is None:
+        return content, None, None
+    cache_key = summary_cache_key(hash_content(content), config)
+    return content, cache_key, cache.get(cache_key)
+
+
+# Lines that start a new top-level definition, used to split oversized files along
+# natural boundaries. Other file types are split on blank lines.
+CHUNK_BOUNDARIES = {
+    ".py": re.compile(r"^(?:@|class\s|def\s|async\s+def\s)"),
+    ".go": re.compile(r"^(?:func|type|var|const)\s"),
+    # Only top-level and member indentation count, and the return type can't contain
+    # spaces, so statements such as `return foo(` or `new Foo(` inside methods don't match
+    ".java": re.compile(
+        r"^(?: {4}|\t)?(?!(?:return|new|throw|else)\b)"
+        r"(?:(?:public|protected|private|static|final|abstract|synchronized|default)\s+)*"
+        r"(?:class\s|interface\s|enum\s|record\s|@|[\w<>\[\].?]+(?:,\s*[\w<>\[\].?]+)*\s+\w+\s*\()"
+    ),
+}
+
+
+def split_into_chunks(file_path: str, content: str, max_tokens: int) -> List[str]:
+    boundary = CHUNK_BOUNDARIES.get(os.path.splitext(file_path)[1])
+    segments, current = [], []
+    for line in content.splitlines(keepends=True):
+        starts_segment = boundary.match(line) if boundary else not line.strip()
+        if current and starts_segment:
+            segments.append("".join(current))
+            current = []
+        current.append(line)
+    if current:
+        segments.append("".join(current))
+
+    # Segments that are too big on their own are split by line
+    max_chars = max_tokens * 4
+    pieces = []
+    for segment in segments:
+        if len(segment) <= max_chars:
+            pieces.append(segment)
+            continue
+        piece = ""
+        for line in segment.splitlines(keepends=True):
+            if piece and len(piece) + len(line) > max_chars:
+                pieces.append(piece)
+                piece = ""
+            piece += line
+        if piece:
+            pieces.append(piece)
+
+    return ["".join(chunk) for chunk in pack_by_token_budget(pieces, max_tokens)]
+
+
+def build_chunk_merge_context(
+    file_path: str, results: List[Dict[str, str]], key: str
 ) -> str:
-    tree = []
-    for root, dirs, files in os.walk(path):
-        level = root.replace(path, "").count(os.sep)
-        if level > max_depth:
+    parts = "\n\n".join(
+        f"Part {i + 1} of {len(results)}:\n{result[key]}"
+        for i, result in enumerate(results)
+    )
+    return f"""
+The file {file_path} was too large to send in one request, so it was split into {len(results)} consecutive parts and each part was handled separately. Combine the following part responses into a single response for the whole file.
+
+{parts}
+    """
+
+
+PACK_FILE_MARKER = re.compile(r"^#{1,3}\s*FILE:\s*`?(.+?)`?\s*$", re.MULTILINE)
+PACK_MODERNISATION_MARKER = re.compile(
+    r"^#{1,4}\s*Modernisation Recommendations:?\s*$", re.MULTILINE | re.IGNORECASE
+)
+
+
+PACK_RESPONSE_INSTRUCTION = "`### FILE: <path>`"
+PACK_MODERNISATION_INSTRUCTION = "`#### Modernisation Recommendations`"
+
+
+def build_pack_prompt(config: Dict[str, Any], file_count: int) -> str:
+    prompt = (
+        f"The following {file_count} small files have been sent together in one request. "
+        f"For each file: {config['file_prompt']}\n\n"
+        "Respond with one section per file, starting each section with a line of the form "
+        f"{PACK_RESPONSE_INSTRUCTION} using the exact path given."
+    )
+    if config.get("generate_file_modernisation_recommendations", False):
+        prompt += (
+            " Within each file's section, after its summary, add a line "
+            f"{PACK_MODERNISATION_INSTRUCTION} followed by: "
+            f"{config['file_modernisation_prompt']}"
+        )
+    return prompt
+
+
+@METRICS.timer("prompt_build")
+def build_pack_context(contents: Dict[str, str]) -> str:
+    files = "\n\n".join(
+        f"File: {file_path}\n```\n{content}\n```"
+        for file_path, content in contents.items()
+    )
+    return f"""
+{files}
+    """
+
+
+def parse_pack_response(
+    text: str, file_paths: List[str], config: Dict[str, Any]
+) -> Dict[str, Dict[str, str]]:
+    matches = list(PACK_FILE_MARKER.finditer(text))
+    results = {}
+    for i, match in enumerate(matches):
+        file_path = match.group(1).strip()
+        if file_path not in file_paths:
             continue
+        end = matches[i + 1].start() if i + 1 < len(matches) else len(text)
+        section = text[match.end() : end].strip()
+
+        result = {"summary": section}
+        if config.get("generate_file_modernisation_recommendations", False):
+            parts = PACK_MODERNISATION_MARKER.split(section, maxsplit=1)
+            if len(parts) != 2:
+                continue
+            result = {
+                "summary": parts[0].strip(),
+                "modernisation_recommendations": parts[1].strip(),
+            }
+        if result["summary"]:
+            results[file_path] = result
+    return results
+
 
-        # Check if the current directory should be ignored
-        if any(ignored_path in root for ignored_path in ignore_paths):
+def read_pack_files(
+    file_paths: List[str],
+    config: Dict[str, Any],
+    cache: Optional[SummaryCache],
+    versions: Optional[Dict[str, Tuple[str, float]]] = None,
+) -> Tuple[Dict[str, Dict[str, str]], Dict[str, str], Dict[str, Optional[str]]]:
+    results, contents, cache_keys = {}, {}, {}
+    for file_path in file_paths:
+        try:
+            content, cache_key, cached = read_cached_file(file_path, config, cache, versions)
+        except (OSError, UnicodeDecodeError) as e:
+            # Leave the file out of the state so that a resumed run retries it
+            print(f"ERROR: Can't read '{file_path}'. Reason: {e}")
             continue
+        if cached is not None:
+            results[file_path] = cached
+        else:
+            contents[file_path] = content
+            cache_keys[file_path] = cache_key
+    return results, contents, cache_keys
 
-        indent = "  " * level
-        tree.append(f"{indent}{os.path.basename(root)}/")
-        sub_indent = "  " * (level + 1)
-        for file in files:
-            tree.append(f"{sub_indent}{file}")
-    return "\n".join(tree)
 
+def combined_file_requests(config: Dict[str, Any]) -> bool:
+    return config.get("generate_file_modernisation_recommendations", False) and config.get(
+        "combine_file_requests", False
+    )
 
-def get_files_in_directory(directory: str) -> List[str]:
+
+COMBINED_RESPONSE_INSTRUCTION = (
+    "Respond with a single JSON object with two string fields and nothing else."
+)
+
+
+def build_combined_prompt(config: Dict[str, Any]) -> str:
+    return (
+        f"{COMBINED_RESPONSE_INSTRUCTION}\n"
+        f'"summary": {config["file_prompt"]}\n'
+        f'"modernisation_recommendations": {config["file_modernisation_prompt"]}'
+    )
+
+
+def parse_combined_response(text: str) -> Optional[Dict[str, str]]:
+    # Models often wrap the object in a code fence or a sentence, so only the
+    # outermost braces are parsed
+    start, end = text.find("{"), text.rfind("}")
+    if start == -1 or end <= start:
+        return None
+    try:
+        parsed = json.loads(text[start : end + 1])
+    except json.JSONDecodeError:
+        return None
+    if not isinstance(parsed, dict):
+        return None
+    result = {
+        key: parsed.get(key)
+        for key in ("summary", "modernisation_recommendations")
+    }
+    if not all(isinstance(value, str) and value.strip() for value in result.values()):
+        return None
+    return {key: value.strip() for key, value in result.items()}
+
+
+@METRICS.timer("prompt_build")
+def chunk_contexts(
+    file_path: str,
+    content: str,
+    config: Dict[str, Any],
+    index: Optional[FileIndex] = None,
+) -> List[str]:
+    max_file_tokens = config.get("max_file_tokens") or 0
+    if not max_file_tokens or estimate_tokens(content) <= max_file_tokens:
+        return [build_file_context(file_path, content, index)]
+
+    chunks = split_into_chunks(file_path, content, max_file_tokens)
     return [
-        f for f in os.listdir(directory) if os.path.isfile(os.path.join(directory, f))
+        build_file_context(
+            file_path, f"(Part {i + 1} of {len(chunks)})\n{chunk}", index
+        )
+        for i, chunk in enumerate(chunks)
     ]
 
 
-def get_files_to_process(
-    directory: str, file_extensions: List[str], ignore_paths: List[str]
-) -> List[str]:
-    files_to_process = []
-    for root, _, files in os.walk(directory):
-        if any(ignored_path in root for ignored_path in ignore_paths):
-            continue
-        for file in files:
-            if any(file.endswith(ext) for ext in file_extensions):
-                files_to_process.append(os.path.join(root, file))
-    return files_to_process
+# Summarising a file is written once as a plan: a generator that yields each step's
+# converse requests and is sent back their responses. run_plan() carries it out on
+# threads and run_plan_async() on the event loop, sending each step's requests at
+# the same time.
+Plan = Generator[List[Dict[str, Any]], List[Dict[str, Any]], Any]
 
 
-def run_ingest(files: List[str]) -> int:
-    print(f"Attempting to run ingest on {len(files)} files.")
-    if shutil.which("ingest") is None:
-        print(
-            "The 'ingest' command is not available in the system path. Skipping ingestion. (Tip: You can install ingest by running `go install github.com/sammcj/ingest@HEAD`)"
-        )
-        return 0
+def run_plan(plan: Plan, bedrock_client: Any) -> Any:
+    send, value = plan.send, None
+    while True:
+        try:
+            requests = send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            if len(requests) == 1:
+                value = [bedrock_client.converse(**requests[0])]
+            else:
+                with ThreadPoolExecutor(max_workers=len(requests)) as executor:
+                    value = list(
+                        executor.map(lambda request: bedrock_client.converse(**request), requests)
+                    )
+            send = plan.send
+        except Exception as e:
+            # The plan sees a failed request as an exception raised where it yielded
+            send, value = plan.throw, e
 
-    if not files:
-        print("No files to process. Skipping ingestion.")
-        return 0
 
-    command = ["ingest"] + files
-    print(f"Running ingest command: {' '.join(command)}")
+async def run_plan_async(plan: Plan, async_client: Any) -> Any:
+    send, value = plan.send, None
+    while True:
+        try:
+            requests = send(value)
+        except StopIteration as stop:
+            return stop.value
+        try:
+            value = await asyncio.gather(
+                *(async_client.converse(**request) for request in requests)
+            )
+            send = plan.send
+        except Exception as e:
+            send, value = plan.throw, e
 
-    try:
-        result = subprocess.run(command, capture_output=True, text=True, check=True)
 
-        print("Ingest command output:")
-        print(result.stdout)
+def in_parallel(plans: List[Plan]) -> Plan:
+    # Runs several plans side by side, sending their requests in the same steps
+    results: List[Any] = [None] * len(plans)
+    waiting = {}
+    for i, plan in enumerate(plans):
+        try:
+            waiting[i] = next(plan)
+        except StopIteration as stop:
+            results[i] = stop.value
+    while waiting:
+        steps = list(waiting.items())
+        responses = yield [request for _, requests in steps for request in requests]
+        waiting = {}
+        for i, requests in steps:
+            part, responses = responses[: len(requests)], responses[len(requests) :]
+            try:
+                waiting[i] = plans[i].send(part)
+            except StopIteration as stop:
+                results[i] = stop.value
+    return results
 
-        output_lines = result.stdout.split("\n")
-        token_count_line = next(
-            (line for line in output_lines if "Tokens (Approximate):" in line), None
-        )
 
-        if token_count_line:
-            token_count = int(token_count_line.split(":")[1].strip().replace(",", ""))
-            print(f"Extracted token count: {token_count}")
-            return token_count
-        else:
-            print("Unable to find token count in ingest output.")
-            return 0
-    except subprocess.CalledProcessError as e:
-        print(f"Error running ingest command: {e}")
-        print(f"Command output: {e.stderr}")
-        return 0
+def context_plan(context: str, config: Dict[str, Any], project_tree: str = "") -> Plan:
+    if combined_file_requests(config):
+        (response,) = yield [
+            build_converse_request(
+                config,
+                build_combined_prompt(config),
+                context,
+                config["max_tokens"] * 2,
+                project_tree,
+            )
+        ]
+        result = parse_combined_response(response_text(response))
+        if result is not None:
+            return result
+        print("Combined response could not be parsed, falling back to separate requests.")
+
+    # The two prompts share nothing but their input, so they are sent at the same time
+    prompts = ["file_prompt"]
+    if config.get("generate_file_modernisation_recommendations", False):
+        prompts.append("file_modernisation_prompt")
+    responses = yield [
+        build_converse_request(
+            config, config[prompt], context, config["max_tokens"], project_tree
+        )
+        for prompt in prompts
+    ]
+    result = {"summary": response_text(responses[0])}
+    if len(responses) > 1:
+        result["modernisation_recommendations"] = response_text(responses[1])
+    return result
 
 
-def process_batch(
-    files: List[str], bedrock_client: Any, config: Dict[str, Any], state_file: str
-) -> Dict[str, str]:
-    print(f"Processing batch of {len(files)} files.")
-    summaries = {}
-    for file_path in tqdm.tqdm(files, desc="Processing files"):
-        print(f"Processing file: {file_path}")
-        summary = summarise_file(
-            file_path, bedrock_client, config, ""
-        )  # Project tree removed for simplicity
-        summaries[file_path] = summary
-        state = load_state(state_file)
-        state["processed_files"].add(file_path)
-        save_state(state_file, state)
-    return summaries
-
-
-def summarise_file(
+def file_plan(
     file_path: str,
-    bedrock_client: Any,
     config: Dict[str, Any],
     project_tree: str,
-) -> Dict[str, str]:
-    with open(file_path, "r") as file:
-        content = file.read()
+    cache: Optional[SummaryCache] = None,
+    index: Optional[FileIndex] = None,
+    versions: Optional[Dict[str, Tuple[str, float]]] = None,
+) -> Plan:
+    content, cache_key, cached = read_cached_file(file_path, config, cache, versions)
+    if cached is not None:
+        return cached
 
-    directory = os.path.dirname(file_path)
-    files_in_directory = get_files_in_directory(directory)
+    contexts = chunk_contexts(file_path, content, config, index)
+    if len(contexts) > 1:
+        print(f"Splitting {file_path} into {len(contexts)} parts.")
+
+    try:
+        if len(contexts) == 1:
+            result = yield from context_plan(contexts[0], config, project_tree)
+        else:
+            parts = yield from in_parallel(
+                [context_plan(context, config, project_tree) for context in contexts]
+            )
+            keys = list(parts[0])
+            responses = yield [
+                build_converse_request(
+                    config,
+                    config["file_prompt" if key == "summary" else "file_modernisation_prompt"],
+                    build_chunk_merge_context(file_path, parts, key),
+                    config["max_tokens"],
+                )
+                for key in keys
+            ]
+            result = {key: response_text(response) for key, response in zip(keys, responses)}
 
-    context = f"""
-Project Structure:
-{project_tree}
+        if cache is not None:
+            cache.put(cache_key, result)
 
-Files in the same directory as {os.path.basename(file_path)}:
-{', '.join(files_in_directory)}
+        return result
+
+    except ClientError as e:
+        print(f"ERROR: Can't invoke '{config['model_id']}'. Reason: {e}")
+        return {"summary": f"Error summarising file: {e}"}
+
+
+def file_pack_plan(
+    file_paths: List[str],
+    config: Dict[str, Any],
+    project_tree: str,
+    cache: Optional[SummaryCache] = None,
+    index: Optional[FileIndex] = None,
+    versions: Optional[Dict[str, Tuple[str, float]]] = None,
+) -> Plan:
+    results, contents, cache_keys = read_pack_files(file_paths, config, cache, versions)
+    if len(contents) > 1:
+        try:
+            (response,) = yield [
+                build_converse_request(
+                    config,
+                    build_pack_prompt(config, len(contents)),
+                    build_pack_context(contents),
+                    config["max_tokens"],
+                    project_tree,
+                )
+            ]
+            parsed = parse_pack_response(response_text(response), list(contents), config)
+        except ClientError as e:
+            print(f"ERROR: Can't invoke '{config['model_id']}'. Reason: {e}")
+            parsed = {}
+        for file_path, result in parsed.items():
+            results[file_path] = result
+            if cache is not None:
+                cache.put(cache_keys[file_path], result)
+
+    # Anything the model didn't return a usable section for is summarised on its own
+    leftovers = [file_path for file_path in contents if file_path not in results]
+    summaries = yield from in_parallel(
+        [
+            file_plan(file_path, config, project_tree, cache, index, versions)
+            for file_path in leftovers
+        ]
+    )
+    results.update(zip(leftovers, summaries))
+    return results
 
-File Content:
-{content}
-    """
 
-    conversation = [
-        {
-            "role": "user",
-            "content": [{"text": f"{config['file_prompt']}\n\n{context}"}],
+def work_item_plan(
+    item: Tuple[str, ...],
+    config: Dict[str, Any],
+    project_tree: str,
+    cache: Optional[SummaryCache] = None,
+    index: Optional[FileIndex] = None,
+) -> Plan:
+    # Returns each file's summary, and the hash and mtime of the content summarised
+    if config.get("verbose"):
+        print(f"Processing file(s): {', '.join(item)}")
+    versions: Dict[str, Tuple[str, float]] = {}
+    if len(item) > 1:
+        results = yield from file_pack_plan(
+            list(item), config, project_tree, cache, index, versions
+        )
+    else:
+        results = {
+            item[0]: (yield from file_plan(item[0], config, project_tree, cache, index, versions))
         }
+    return results, versions
+
+
+def estimate_work_item(
+    item: Tuple[str, ...],
+    config: Dict[str, Any],
+    local_index: Optional[FileIndex] = None,
+) -> Tuple[int, int, int, int]:
+    # Builds the same requests file_plan()/file_pack_plan() would send and
+    # returns their (input tokens, maximum output tokens, request count, number of
+    # requests carrying the project tree). The project tree itself is left out and
+    # added by estimate_run(), which knows whether it will be cached.
+    max_tokens = config["max_tokens"]
+    try:
+        if len(item) > 1:
+            contents = {}
+            for file_path in item:
+                with open(file_path, "r") as file:
+                    contents[file_path] = file.read()
+            request = build_converse_request(
+                config,
+                build_pack_prompt(config, len(contents)),
+                build_pack_context(contents),
+                max_tokens,
+            )
+            return request_input_tokens(request), max_tokens, 1, 1
+
+        with open(item[0], "r") as file:
+            content = file.read()
+    except (OSError, UnicodeDecodeError):
+        return 0, 0, 0, 0
+
+    if combined_file_requests(config):
+        prompts = [(build_combined_prompt(config), max_tokens * 2)]
+    else:
+        prompts = [(config["file_prompt"], max_tokens)]
+        if config.get("generate_file_modernisation_recommendations", False):
+            prompts.append((config["file_modernisation_prompt"], max_tokens))
+    # The index itself is too big to ship to worker processes, so the caller passes
+    # a view of just the parts this file's context is built from
+    contexts = chunk_contexts(item[0], content, config, local_index)
+
+    input_tokens = sum(
+        request_input_tokens(
+            build_converse_request(config, prompt, context, prompt_max_tokens)
+        )
+        for prompt, prompt_max_tokens in prompts
+        for context in contexts
+    )
+    output_tokens = sum(tokens for _, tokens in prompts) * len(contexts)
+    requests = tree_requests = len(prompts) * len(contexts)
+    if len(contexts) > 1:
+        # One merge request per result key, fed with every part's response
+        keys = 2 if config.get("generate_file_modernisation_recommendations", False) else 1
+        input_tokens += keys * len(contexts) * max_tokens
+        output_tokens += keys * max_tokens
+        requests += keys
+    return input_tokens, output_tokens, requests, tree_requests
+
+
+def estimate_run(
+    files: List[str],
+    config: Dict[str, Any],
+    index: Optional[FileIndex] = None,
+    project_tree: str = "",
+) -> Dict[str, int]:
+    work_items = plan_work_items(files, config, index)
+    local_indexes = [
+        index.local_view(item[0]) if index and len(item) == 1 else None
+        for item in work_items
     ]
+    if len(work_items) < 256:
+        results = [
+            estimate_work_item(item, config, local_index)
+            for item, local_index in zip(work_items, local_indexes)
+        ]
+    else:
+        with ProcessPoolExecutor() as executor:
+            results = list(
+                executor.map(
+                    estimate_work_item,
+                    work_items,
+                    itertools.repeat(config),
+                    local_indexes,
+                    chunksize=64,
+                )
+            )
+
+    estimate = {
+        "files": len(files),
+        "input_tokens": sum(r[0] for r in results),
+        "output_tokens": sum(r[1] for r in results),
+        "requests": sum(r[2] for r in results),
+        "cache_read_tokens": 0,
+        "cache_write_tokens": 0,
+    }
+
+    tree_requests = sum(r[3] for r in results)
+    if project_tree and tree_requests:
+        tree_tokens = estimate_tokens(f"Project Structure:\n{project_tree}")
+        if config.get("prompt_caching", False):
+            # Written once, then read back by every later request in the batch
+            estimate["cache_write_tokens"] = tree_tokens
+            estimate["cache_read_tokens"] = tree_tokens * (tree_requests - 1)
+        else:
+            estimate["input_tokens"] += tree_tokens * tree_requests
+
+    # Supersummaries and the final outputs can only be bounded, as their inputs are
+    # responses that don't exist yet, so they're kept apart from the exact figures
+    estimate["summary_input_tokens"] = 0
+    estimate["summary_output_tokens"] = 0
+    estimate["summary_requests"] = 0
+    interval = config.get("supersummary_interval")
+    budget = config.get("supersummary_token_budget", 50000)
+    if interval and files:
+        # Grouped the same way refresh_supersummaries() will, and each supersummary
+        # reads at most one response per file in its group
+        file_groups = group_files_for_supersummary(
+            files, interval, index, budget, lambda file_path: config["max_tokens"]
+        )
+        groups = len(file_groups)
+        estimate["summary_input_tokens"] += sum(
+            min(budget, len(group) * config["max_tokens"]) for group in file_groups
+        )
+        estimate["summary_output_tokens"] += groups * config["max_tokens"]
+        estimate["summary_requests"] += groups
+        for key in ("generate_final_summary", "generate_modernisation_summary"):
+            if config.get(key):
+                estimate["summary_input_tokens"] += min(budget, groups * config["max_tokens"])
+                estimate["summary_output_tokens"] += config["final_summary_max_tokens"]
+                estimate["summary_requests"] += 1
+    return estimate
+
+
+def estimate_cost(
+    estimate: Dict[str, int], config: Dict[str, Any], include_output: bool
+) -> Optional[float]:
+    # Without the outputs this is the exact cost of the file requests' inputs. With
+    # them it's an upper bound on the whole run, including the summaries.
+    cost = model_cost(
+        config,
+        config["model_id"],
+        estimate["input_tokens"]
+        + (estimate.get("summary_input_tokens", 0) if include_output else 0),
+        (
+            estimate["output_tokens"] + estimate.get("summary_output_tokens", 0)
+            if include_output
+            else 0
+        ),
+        estimate["cache_read_tokens"],
+        estimate["cache_write_tokens"],
+    )
+    if cost is not None and config.get("batch_inference"):
+        cost *= config.get("batch_price_factor", 0.5)
+    return cost
+
+
+def print_estimate(estimate: Dict[str, int], config: Dict[str, Any]):
+    print(
+        f"Estimated {estimate['requests']} requests for {estimate['files']} files using {config['model_id']}:"
+    )
+    print(f"  Input tokens: {estimate['input_tokens']:,}")
+    print(f"  Output tokens (upper bound): {estimate['output_tokens']:,}")
+    if estimate["cache_read_tokens"] or estimate["cache_write_tokens"]:
+        print(
+            f"  Prompt cache tokens: {estimate['cache_write_tokens']:,} written, {estimate['cache_read_tokens']:,} read"
+        )
+    if estimate.get("summary_requests"):
+        print(
+            f"  Supersummaries and final summaries (upper bound): {estimate['summary_requests']} requests, {estimate['summary_input_tokens']:,} input and {estimate['summary_output_tokens']:,} output tokens"
+        )
+    input_cost = estimate_cost(estimate, config, include_output=False)
+    if input_cost is None:
+        print(
+            f"  No pricing for {config['model_id']} in model_pricing, unable to estimate cost."
+        )
+        return
+    max_cost = estimate_cost(estimate, config, include_output=True)
+    print(f"  Estimated cost: ${input_cost:.2f} input, up to ${max_cost:.2f} in total")
+
+
+def summarise_summaries(
+    summaries: Dict[str, str],
+    bedrock_client: Any,
+    config: Dict[str, Any],
+    label: str = "File",
+) -> Optional[str]:
+    context = "\n\n".join(
+        [f"{label}: {name}\nSummary: {summary}" for name, summary in summaries.items()]
+    )
 
     try:
         response = bedrock_client.converse(
-            modelId=config["model_id"],
-            messages=conversation,
-            system=[{"text": config["system_prompt"]}],
-            inferenceConfig={
-                "maxTokens": config["max_tokens"],
-                "temperature": config["temperature"],
-                "topP": config["top_p"],
-            },
+            **build_converse_request(
+                config, config["summary_prompt"], context, config["max_tokens"]
+            )
+        )
+        return response_text(response)
+
+    except ClientError as e:
+        print(f"ERROR: Can't invoke '{config['model_id']}'. Reason: {e}")
+        # Failures return None rather than an error message, so that nothing is
+        # saved under the group's signature and the next run tries again
+        return None
+
+
+def generate_modernisation_summary(
+    supersummaries: List[str],
+    bedrock_client: Any,
+    config: Dict[str, Any],
+) -> Optional[str]:
+    context = "\n\n".join(
+        [f"Supersummary {i+1}:\n{summary}" for i, summary in enumerate(supersummaries)]
+    )
+
+    try:
+        response = bedrock_client.converse(
+            **build_converse_request(
+                config, config["modernisation_summary_prompt"], context, config["final_summary_max_tokens"]
+            )
         )
+        return response_text(response)
 
-        summary = response["output"]["message"]["content"][0]["text"]
+    except ClientError as e:
+        print(f"ERROR: Can't invoke '{config['model_id']}'. Reason: {e}")
+        return None
 
-        result = {"summary": summary}
 
-        if config.get("generate_file_modernisation_recommendations", False):
-            modernisation_conversation = [
-                {
-                    "role": "user",
-                    "content": [
-                        {"text": f"{config['file_modernisation_prompt']}\n\n{context}"}
-                    ],
+def save_individual_summary(file_path: str, content: Dict[str, str], output_dir: str):
+    # Create a sanitized filename from the whole path so same-named files don't collide
+    safe_filename = os.path.normpath(file_path).lstrip(os.sep).replace(os.sep, "_")
+    output_file = os.path.join(output_dir, f"{safe_filename}_summary.md")
+
+    with open(output_file, "w", encoding="utf-8") as f:
+        f.write(f"# File: {file_path}\n\n")
+        f.write(duplicate_note(content))
+        f.write("## Summary:\n\n")
+        f.write(content["summary"])
+
+        if "modernisation_recommendations" in content:
+            f.write("\n\n## Modernisation Recommendations:\n\n")
+            f.write(content["modernisation_recommendations"])
+
+
+def duplicate_note(content: Dict[str, Any]) -> str:
+    if "duplicate_of" in content:
+        kind = "Identical" if content["similarity"] == 1.0 else "Near-identical"
+        return f"_{kind} to `{content['duplicate_of']}` ({content['similarity']:.0%} similar), which was summarised in its place._\n\n"
+    if content.get("duplicates"):
+        copies = ", ".join(f"`{path}`" for path in content["duplicates"])
+        return f"_This summary also covers identical or near-identical copies: {copies}._\n\n"
+    return ""
+
+
+def summary_text(result: Dict[str, str], summaries: Any = None) -> str:
+    # A copy is described by reference rather than repeating its summary, so
+    # duplicated code doesn't crowd out the rest of a supersummary. If the file it
+    # copies has gone, the summary they shared is used instead.
+    if "duplicate_of" in result and (summaries is None or result["duplicate_of"] in summaries):
+        return f"Duplicate of {result['duplicate_of']} ({result['similarity']:.0%} similar)."
+    text = result["summary"]
+    if "modernisation_recommendations" in result:
+        text += f"\nModernisation Recommendations: {result['modernisation_recommendations']}"
+    return text
+
+
+def group_files_for_supersummary(
+    files: List[str],
+    group_size: int,
+    index: Optional[FileIndex] = None,
+    token_budget: int = 0,
+    file_tokens: Any = None,
+) -> List[List[str]]:
+    # Keep each directory's files, or with a dependency graph each set of files
+    # that import one another, next to each other
+    if index is not None and index.dependencies is not None:
+        clusters = dependency_components(sorted(files), index.dependencies)
+    else:
+        by_directory: Dict[str, List[str]] = {}
+        for file_path in sorted(files):
+            by_directory.setdefault(os.path.dirname(file_path), []).append(file_path)
+        clusters = list(by_directory.values())
+
+    # Groups start at files whose path hashes to a split point, rather than every
+    # group_size files, so adding or removing a file only moves the boundaries of
+    # the groups around it and not every group after it. Split points closer than
+    # a quarter of the group size to the last are skipped, and a group that reaches
+    # the group size, or whose summaries would go over the token budget, is cut short.
+    spacing = max(1, group_size // 2)
+    min_size = max(1, group_size // 4)
+    groups, current, current_tokens = [], [], 0
+    for file_path in itertools.chain.from_iterable(clusters):
+        tokens = file_tokens(file_path) if token_budget and file_tokens else 0
+        if current and (
+            len(current) >= group_size
+            or (token_budget and current_tokens + tokens > token_budget)
+            or (
+                len(current) >= min_size
+                and zlib.crc32(file_path.encode()) % spacing == 0
+            )
+        ):
+            groups.append(current)
+            current, current_tokens = [], 0
+        current.append(file_path)
+        current_tokens += tokens
+    if current:
+        groups.append(current)
+    return groups
+
+
+def estimate_tokens(text: str) -> int:
+    # Roughly four characters per token for English prose and code
+    return len(text) // 4
+
+
+def pack_by_token_budget(texts: List[str], budget: int) -> List[List[str]]:
+    chunks, current, current_tokens = [], [], 0
+    for text in texts:
+        tokens = estimate_tokens(text)
+        if current and current_tokens + tokens > budget:
+            chunks.append(current)
+            current, current_tokens = [], 0
+        current.append(text)
+        current_tokens += tokens
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def generate_supersummaries(
+    pending: Iterator[Tuple[str, Dict[str, str]]],
+    bedrock_client: Any,
+    config: Dict[str, Any],
+    label: str,
+    results: Dict[str, str],
+):
+    # pending is consumed lazily, so only the inputs of the groups in flight are
+    # loaded into memory at any one time. Results are added to results as they
+    # complete, so that those already paid for are kept if the budget runs out.
+    parallel = max(1, config.get("parallel") or 1)
+    pending = iter(pending)
+    failed = 0
+    exceeded: Optional[BudgetExceededError] = None
+    with ThreadPoolExecutor(max_workers=parallel) as executor:
+        future_to_signature = {}
+        while True:
+            for signature, summaries in itertools.islice(
+                pending, 0 if exceeded else max(0, parallel * 2 - len(future_to_signature))
+            ):
+                future = executor.submit(
+                    call_with_backoff,
+                    config,
+                    summarise_summaries,
+                    summaries,
+                    bedrock_client,
+                    config,
+                    label,
+                )
+                future_to_signature[future] = signature
+            if not future_to_signature:
+                break
+            done, _ = wait(future_to_signature, return_when=FIRST_COMPLETED)
+            for future in done:
+                signature = future_to_signature.pop(future)
+                try:
+                    result = future.result()
+                except BudgetExceededError as e:
+                    # Nothing more is sent, but the requests in flight are waited for
+                    exceeded = e
+                    continue
+                if result is not None:
+                    results[signature] = result
+                else:
+                    failed += 1
+    if failed:
+        print(f"{failed} supersummaries failed and will be retried on the next run.")
+    if exceeded is not None:
+        raise exceeded
+
+
+def refresh_supersummaries(
+    all_files: List[str],
+    state: Dict[str, Any],
+    bedrock_client: Any,
+    config: Dict[str, Any],
+    complete_only: bool,
+    index: Optional[FileIndex] = None,
+) -> List[List[str]]:
+    group_size = config.get("supersummary_interval")
+    if not group_size:
+        return []
+
+    directory = config["directory"]
+    previous = state["supersummaries"].get(directory, {})
+    current = {}
+    pending = {}
+    ordered = []
+
+    def generate(items: Iterator[Tuple[str, Dict[str, str]]], label: str):
+        try:
+            generate_supersummaries(items, bedrock_client, config, label, current)
+        except BudgetExceededError:
+            # Supersummaries that were paid for before the budget ran out are kept
+            state["supersummaries"][directory] = {**previous, **current}
+            raise
+
+    # Each group is also kept within the token budget, counting the text that
+    # summarise_summaries() will send for each of its files
+    budget = config.get("supersummary_token_budget", 50000)
+
+    def file_tokens(file_path: str) -> int:
+        if file_path not in state["summaries"]:
+            return 0
+        text = summary_text(state["summaries"][file_path], state["summaries"])
+        return estimate_tokens(f"File: {file_path}\nSummary: {text}")
+
+    for group in group_files_for_supersummary(
+        all_files, group_size, index, budget, file_tokens
+    ):
+        members = [f for f in group if f in state["summaries"]]
+        if not members or (complete_only and len(members) < len(group)):
+            continue
+
+        # A group only needs regenerating when one of its files, or a file one of
+        # them is a copy of, has changed
+        signature = hash_content(
+            json.dumps(
+                [config["model_id"], config["summary_prompt"]]
+                + [
+                    [f, state["file_hashes"].get(f)]
+                    + (
+                        [state["file_hashes"].get(state["duplicate_of"][f])]
+                        if f in state["duplicate_of"]
+                        else []
+                    )
+                    for f in members
+                ]
+            )
+        )
+        ordered.append(signature)
+        if signature in previous:
+            current[signature] = previous[signature]
+        else:
+            pending[signature] = members
+
+    if pending:
+        print(
+            f"Generating {len(pending)} supersummaries ({len(set(ordered)) - len(pending)} unchanged)..."
+        )
+        generate(
+            (
+                (
+                    signature,
+                    {
+                        f: summary_text(state["summaries"][f], state["summaries"])
+                        for f in members
+                    },
+                )
+                for signature, members in pending.items()
+            ),
+            "File",
+        )
+    # Groups whose supersummary failed are left out until a later run retries them
+    top = [current[signature] for signature in ordered if signature in current]
+    levels = [top] if top else []
+
+    # Partial refreshes happen mid-run, so the upper levels of the tree are only
+    # built, and stale entries only pruned, on the final pass
+    if complete_only or not levels:
+        state["supersummaries"][directory] = (
+            {**previous, **current} if complete_only else current
+        )
+        return levels
+
+    # Reduce each level into the next, never sending more than the token budget in
+    # a single call, until the top level fits in one final/modernisation prompt
+    while len(levels[-1]) > 1 and estimate_tokens("\n\n".join(levels[-1])) > budget:
+        chunks = pack_by_token_budget(levels[-1], budget)
+        if len(chunks) == len(levels[-1]):
+            # Every summary is over budget on its own, so pair them up to make progress
+            chunks = [levels[-1][i : i + 2] for i in range(0, len(levels[-1]), 2)]
+
+        ordered = []
+        pending = {}
+        for chunk in chunks:
+            signature = hash_content(
+                json.dumps([config["model_id"], config["summary_prompt"]] + chunk)
+            )
+            ordered.append(signature)
+            if signature in previous:
+                current[signature] = previous[signature]
+            elif signature not in pending:
+                pending[signature] = {
+                    str(i + 1): summary for i, summary in enumerate(chunk)
                 }
-            ]
 
-            modernisation_response = bedrock_client.converse(
-                modelId=config["model_id"],
-                messages=modernisation_conversation,
-                system=[{"text": config["system_prompt"]}],
-                inferenceConfig={
-                    "maxTokens": config["max_tokens"],
-                    "temperature": config["temperature"],
-                    "topP": config["top_p"],
-                },
-            )
+        if pending:
+            print(
+                f"Generating {len(pending)} level {len(levels)} supersummaries ({len(set(ordered)) - len(pending)} unchanged)..."
+            )
+            generate(pending.items(), "Supersummary")
+        levels.append([current[signature] for signature in ordered if signature in current])
+
+    state["supersummaries"][directory] = current
+    return levels
+
+
+def reuse_or_generate(
+    state: Dict[str, Any], directory: str, name: str, inputs: List[str], generate: Any
+) -> Optional[str]:
+    signature = hash_content(json.dumps(inputs))
+    outputs = state["final_outputs"].setdefault(directory, {})
+    previous = outputs.get(name)
+    if previous and previous["signature"] == signature:
+        print(f"Inputs unchanged, reusing the previous {name.replace('_', ' ')}.")
+        return previous["text"]
+
+    text = generate()
+    if text is None:
+        print(f"ERROR: The {name.replace('_', ' ')} failed and will be retried on the next run.")
+        return None
+    outputs[name] = {"signature": signature, "text": text}
+    return text
+
+
+@METRICS.timer("output_write")
+def save_supersummaries(levels: List[List[str]], supersummary_file: str):
+    with open(supersummary_file, "w", encoding="utf-8") as f:
+        for level, supersummaries in enumerate(levels):
+            heading = "Supersummary" if level == 0 else f"Level {level} Supersummary"
+            for supersummary in supersummaries:
+                f.write(f"# {heading}\n\n{supersummary}\n\n---\n\n")
+
+
+def write_markdown_section(f: Any, file: str, content: Dict[str, str]):
+    # Escape any existing # characters in the file path
+    safe_file_path = file.replace("#", "\\#")
+    f.write(f"# File: {safe_file_path}\n\n")
+    f.write(duplicate_note(content))
+    f.write("## Summary:\n\n")
+
+    # Split the summary into lines and properly format any list items or code blocks
+    lines = content["summary"].split("\n")
+    in_code_block = False
+    for line in lines:
+        if line.strip().startswith("```"):
+            in_code_block = not in_code_block
+            f.write(line + "\n")
+        elif in_code_block:
+            f.write(line + "\n")
+        else:
+            # Ensure list items are on their own line
+            if line.strip().startswith(("- ", "* ", "1. ")):
+                f.write("\n" + line + "\n")
+            else:
+                f.write(line + "\n")
+
+    if "modernisation_recommendations" in content:
+        f.write("\n## Modernisation Recommendations:\n\n")
+        lines = content["modernisation_recommendations"].split("\n")
+        for line in lines:
+            if line.strip().startswith(("- ", "* ", "1. ")):
+                f.write("\n" + line + "\n")
+            else:
+                f.write(line + "\n")
+
+    f.write("\n---\n\n")
+
+
+class MarkdownSink:
+    """Appends each file's section to the output as soon as its summary completes."""
 
-            modernisation_recommendations = modernisation_response["output"]["message"][
-                "content"
-            ][0]["text"]
-            result["modernisation_recommendations"] = modernisation_recommendations
+    def __init__(self, output_file: str, individual_summaries_dir: Optional[str]):
+        self.output_file = output_file
+        self.individual_summaries_dir = individual_summaries_dir
+        if individual_summaries_dir:
+            os.makedirs(individual_summaries_dir, exist_ok=True)
+        self._file = open(output_file, "a", encoding="utf-8")
 
-        return result
+    def write(self, file_path: str, content: Dict[str, str]):
+        write_markdown_section(self._file, file_path, content)
+        self._file.flush()
+        if self.individual_summaries_dir:
+            save_individual_summary(file_path, content, self.individual_summaries_dir)
 
-    except ClientError as e:
-        print(f"ERROR: Can't invoke '{config['model_id']}'. Reason: {e}")
-        return {"summary": f"Error summarising file: {e}"}
+    def close(self):
+        self._file.close()
 
 
-def summarise_summaries(
-    summaries: Dict[str, str],
+@METRICS.timer("output_write")
+def save_indexed_markdown(store: StateStore, files: List[str], index_file: str):
+    # Summaries are streamed back out of the state store one at a time, so the
+    # index can be built for any size of tree without holding them all in memory
+    paths = sorted(files)
+    with open(index_file, "w", encoding="utf-8") as f:
+        f.write("# Table of Contents\n\n")
+        for i, file_path in enumerate(paths):
+            safe_file_path = file_path.replace("#", "\\#")
+            f.write(f"- [{safe_file_path}](#file-{i + 1})\n")
+        f.write("\n---\n\n")
+
+        anchors = {file_path: i + 1 for i, file_path in enumerate(paths)}
+        for file_path, content in store.iter_summaries(anchors):
+            f.write(f'<a id="file-{anchors[file_path]}"></a>\n\n')
+            write_markdown_section(f, file_path, content)
+
+
+def generate_final_summary(
+    supersummaries: List[str],
     bedrock_client: Any,
     config: Dict[str, Any],
-) -> str:
+) -> Optional[str]:
     context = "\n\n".join(
-        [f"File: {file}\nSummary: {summary}" for file, summary in summaries.items()]
+        [f"Supersummary {i+1}:\n{summary}" for i, summary in enumerate(supersummaries)]
     )
 
-    conversation = [
-        {
-            "role": "user",
-            "content": [{"text": f"{config['summary_prompt']}\n\n{context}"}],
-        }
-    ]
-
     try:
         response = bedrock_client.converse(
-            modelId=config["model_id"],
-            messages=conversation,
-            system=[{"text": config["system_prompt"]}],
-            inferenceConfig={
-                "maxTokens": config["max_tokens"],
-                "temperature": config["temperature"],
-                "topP": config["top_p"],
-            },
+            **build_converse_request(
+                config, config["final_summary_prompt"], context, config["final_summary_max_tokens"]
+            )
         )
-
-        response_text = response["output"]["message"]["content"][0]["text"]
-        return response_text
+        return response_text(response)
 
     except ClientError as e:
         print(f"ERROR: Can't invoke '{config['model_id']}'. Reason: {e}")
-        return f"Error summarising summaries: {e}"
+        return None
 
 
-def generate_modernisation_summary(
-    all_summaries: Dict[str, str],
-    bedrock_client: Any,
-    config: Dict[str, Any],
-) -> str:
-    context = "\n\n".join(
-        [f"File: {file}\nSummary: {summary}" for file, summary in all_summaries.items()]
+def index_directory(config: Dict[str, Any]) -> Tuple[FileIndex, str]:
+    with METRICS.timer("scan"):
+        index = scan_directory(config["directory"], config)
+    # The dependency graph gives each file its own imports and importers alongside
+    # the budgeted project tree, which is the same for every file and so stays a
+    # cacheable prefix
+    if config.get("dependency_graph", True):
+        with METRICS.timer("dependency_graph"):
+            build_dependency_graph(index)
+        print(
+            f"Found {sum(len(d) for d in index.dependencies.values())} imports between the files."
+        )
+    return index, index.tree_text(
+        config.get("project_tree_depth", 3), config.get("project_tree_token_budget", 2000)
     )
 
-    conversation = [
-        {
-            "role": "user",
-            "content": [
-                {"text": f"{config['modernisation_summary_prompt']}\n\n{context}"}
-            ],
-        }
-    ]
 
-    try:
-        response = bedrock_client.converse(
-            modelId=config["model_id"],
-            messages=conversation,
-            system=[{"text": config["system_prompt"]}],
-            inferenceConfig={
-                "maxTokens": config["final_summary_max_tokens"],
-                "temperature": config["temperature"],
-                "topP": config["top_p"],
-            },
+def summarise_files(
+    files: List[str],
+    file_client: Any,
+    file_config: Dict[str, Any],
+    store: StateStore,
+    state: Dict[str, Any],
+    sink: MarkdownSink,
+    cache: Optional[SummaryCache],
+    index: FileIndex,
+    project_tree: str,
+    work_items: Optional[Iterable[Tuple[str, ...]]] = None,
+) -> Set[str]:
+    METRICS.stage = "files"
+    if file_config.get("batch_inference"):
+        # A batch job needs all of its work up front
+        if work_items is not None:
+            files = [f for item in work_items for f in item]
+        return process_batch_job(
+            files,
+            file_client,
+            file_config,
+            store,
+            state,
+            sink,
+            cache,
+            index,
+            project_tree,
         )
+    if file_config.get("async_requests"):
+        return asyncio.run(
+            process_batch_async(
+                files,
+                file_client,
+                file_config,
+                store,
+                state,
+                sink,
+                cache,
+                index,
+                project_tree,
+                work_items,
+            )
+        )
+    return process_batch(
+        files,
+        file_client,
+        file_config,
+        store,
+        state,
+        sink,
+        cache,
+        index,
+        project_tree,
+        work_items,
+    )
 
-        response_text = response["output"]["message"]["content"][0]["text"]
-        return response_text
-
-    except ClientError as e:
-        print(f"ERROR: Can't invoke '{config['model_id']}'. Reason: {e}")
-        return f"Error generating modernisation summary: {e}"
 
+def open_summary_cache(
+    config: Dict[str, Any], args: argparse.Namespace, output_dir: str
+) -> Optional[SummaryCache]:
+    if args.no_cache or not config.get("cache_enabled", True):
+        return None
+    cache_dir = config.get("cache_dir") or os.path.join(output_dir, "cache")
+    return SummaryCache(cache_dir, int(config.get("cache_max_mb", 512) * 1024 * 1024))
 
-def process_directory(
-    directory: str,
-    bedrock_client: Any,
-    config: Dict[str, Any],
-    file_limit: int,
-    parallel: int,
-    supersummary_interval: int,
-    state_file: str,
-    restart: bool,
-) -> Dict[str, str]:
-    project_tree = get_directory_tree(
-        directory, ignore_paths=config.get("ignore_paths", [])
-    )
-    summaries = {}
-    files_to_process = []
-
-    state = (
-        load_state(state_file)
-        if not restart
-        else {"processed_files": set(), "last_directory": None}
-    )
-
-    if state["last_directory"] != directory:
-        state["processed_files"] = set()
-    state["last_directory"] = directory
 
-    print(f"Scanning directory: {directory}")
-    print(f"File extensions to process: {config['file_extensions']}")
-    print(f"Paths to ignore: {config.get('ignore_paths', [])}")
+def queue_settings(config: Dict[str, Any]) -> Tuple[float, int]:
+    return config.get("queue_lease_seconds", 600), config.get("queue_max_attempts", 3)
 
-    for root, _, files in os.walk(directory):
-        if any(ignored_path in root for ignored_path in config.get("ignore_paths", [])):
-            if config["verbose"] == True:
-                print(f"Ignoring directory: {root}")
-            continue
 
-        for file in files:
-            if any(file.endswith(ext) for ext in config["file_extensions"]):
-                file_path = os.path.join(root, file)
-                if file_path not in state["processed_files"]:
-                    files_to_process.append(file_path)
+def wait_for_workers(queue: WorkQueue, poll_seconds: float):
+    last = None
+    while True:
+        counts = queue.counts()
+        if counts != last:
+            print(
+                f"Work queue: {counts.get('pending', 0)} pending, {counts.get('leased', 0)} leased, {counts.get('done', 0)} done, {counts.get('failed', 0)} failed."
+            )
+            last = counts
+        if not counts.get("pending") and not counts.get("leased"):
+            return
+        time.sleep(poll_seconds)
 
-    print(f"Total files found to process: {len(files_to_process)}")
 
-    if not files_to_process:
+def run_worker(
+    config: Dict[str, Any], args: argparse.Namespace, output_dir: str, timestamp: str
+) -> UsageTracker:
+    # Workers lease work items published by a coordinator into the shared state
+    # database, summarise them and record the results, until the queue is drained
+    file_client = create_stage_clients(config, ["files"])["files"]
+    file_config = stage_config(config, "files")
+    worker_id = args.worker_id
+    state_file = os.path.join(output_dir, "treesummary_state.db")
+    lease_seconds, max_attempts = queue_settings(config)
+    queue = WorkQueue(state_file, lease_seconds, max_attempts)
+    if queue.directory() is None:
+        print(f"No work has been published to {state_file}, start a coordinator first.")
+        queue.close()
+        return file_client.usage
+    if os.path.abspath(queue.directory()) != os.path.abspath(config["directory"]):
         print(
-            "No files found to process. Check your file extensions in the config and ignore_paths setting."
+            f"The work queue is for {queue.directory()}, not {config['directory']}. Workers must see the tree at the same path as the coordinator."
         )
-        return
+        queue.close()
+        return file_client.usage
 
-    # Determine if we're processing all files or using a limit
-    process_all = file_limit is None or file_limit == 0
-    if process_all:
-        print("Processing all files (no limit)")
-    else:
-        print(f"Processing files with a limit of {file_limit}")
-
-    while files_to_process:
-        if process_all:
-            current_batch = files_to_process
-            files_to_process = []
-        else:
-            current_batch = files_to_process[:file_limit]
-            files_to_process = files_to_process[file_limit:]
-
-        print(f"Processing batch of {len(current_batch)} files")
-
-        def process_file(file_path):
-            print(f"Processing file: {file_path}")
-            return file_path, summarise_file(
-                file_path, bedrock_client, config, project_tree
-            )
+    cache = open_summary_cache(config, args, output_dir)
+    store = StateStore(state_file, shared=True)
+    state = store.load()
+    # The coordinator has already scanned the tree, so the index only holds what
+    # the coordinator published with each leased item
+    index = FileIndex(config["directory"])
+    project_tree = queue.project_tree() or ""
+    sink = MarkdownSink(
+        os.path.join(output_dir, f"summary_output_{timestamp}.md"),
+        (
+            os.path.join(output_dir, f"summaries_{timestamp}")
+            if config.get("save_individual_summaries")
+            else None
+        ),
+    )
 
-        with ThreadPoolExecutor(max_workers=parallel) as executor:
-            future_to_file = {
-                executor.submit(process_file, file_path): file_path
-                for file_path in current_batch
-            }
+    # Leases are renewed in the background for as long as the worker is alive, so
+    # only a worker that has died or hung loses its items
+    stop = threading.Event()
 
-            for i, future in enumerate(
-                tqdm.tqdm(
-                    as_completed(future_to_file),
-                    total=len(current_batch),
-                    desc="Processing files",
-                )
-            ):
-                file_path, summary = future.result()
-                summaries[file_path] = summary
-                state["processed_files"].add(file_path)
+    def heartbeat():
+        while not stop.wait(lease_seconds / 3):
+            queue.renew(worker_id)
 
-                if supersummary_interval and (
-                    len(state["processed_files"]) % supersummary_interval == 0
-                ):
-                    print("Generating supersummary...")
-                    supersummary = summarise_summaries(
-                        summaries, bedrock_client, config
-                    )
-                    yield "supersummary", supersummary
+    threading.Thread(target=heartbeat, daemon=True).start()
+    lease_items = config.get("queue_lease_items") or max(1, config.get("parallel") or 1) * 4
+    poll_seconds = config.get("queue_poll_seconds", 10)
+    held: Dict[int, Tuple[str, ...]] = {}
+    state["duplicates"] = {}
 
-                save_state(state_file, state)
+    def settle():
+        # Items whose files have all been recorded are marked done as the worker
+        # goes, rather than when everything it leased has finished
+        done = [i for i, paths in held.items() if all(f in state["processed_files"] for f in paths)]
+        queue.finish(worker_id, done, "done")
+        for i in done:
+            del held[i]
 
-        # Generate supersummary after processing the batch
-        if supersummary_interval:
-            print("Generating supersummary after batch completion...")
-            supersummary = summarise_summaries(summaries, bedrock_client, config)
-            yield "supersummary", supersummary
+    def leased_items() -> Iterator[Tuple[str, ...]]:
+        # Leases are taken as the pool asks for more work, so the pool stays full
+        # from one lease to the next instead of draining at the end of each
+        while True:
+            settle()
+            leased = queue.lease(worker_id, lease_items)
+            if not leased:
+                return
+            for item_id, paths, duplicates, context in leased:
+                held[item_id] = paths
+                state["duplicates"].update(duplicates)
+                index.add_context(context)
+                # Changed files were processed before, so only a fresh result counts
+                state["processed_files"].difference_update(paths)
+            for _, paths, _, _ in leased:
+                yield paths
 
-        if not process_all and files_to_process:
-            continue_processing = (
-                input(
-                    f"Processed {file_limit} files. Continue for another {file_limit} files? (y/n): "
-                ).lower()
-                == "y"
+    print(f"Worker {worker_id} started.")
+    try:
+        while True:
+            summarise_files(
+                [],
+                file_client,
+                file_config,
+                store,
+                state,
+                sink,
+                cache,
+                index,
+                project_tree,
+                leased_items(),
             )
-            if not continue_processing:
+            # Items with a file that failed go back for another worker to retry
+            settle()
+            queue.finish(worker_id, sorted(held), "pending")
+            held.clear()
+            if file_client.usage.budget_exceeded():
+                print(
+                    f"Reached the ${file_client.usage.max_cost:.2f} budget, stopping this worker."
+                )
                 break
+            counts = queue.counts()
+            if not counts.get("pending") and not counts.get("leased"):
+                break
+            # Items leased by other workers come back if those workers die
+            time.sleep(poll_seconds)
+    finally:
+        stop.set()
+        sink.close()
+        store.close()
+        queue.close()
 
-    print(f"Total files processed: {len(summaries)}")
-    yield "summaries", summaries
+    usage = file_client.usage
+    print(
+        f"Worker {worker_id} used {usage.input_tokens:,} input and {usage.output_tokens:,} output tokens (${usage.cost:.2f})."
+    )
+    return usage
 
 
-def save_individual_summary(file_path: str, content: Dict[str, str], output_dir: str):
-    # Create a sanitized filename
-    safe_filename = os.path.basename(file_path).replace(os.sep, "_")
-    output_file = os.path.join(output_dir, f"{safe_filename}_summary.md")
+class WatchStatus:
+    """What the watch mode's HTTP endpoint serves, shared with the watch loop."""
 
-    with open(output_file, "w", encoding="utf-8") as f:
-        f.write(f"# File: {file_path}\n\n")
-        f.write("## Summary:\n\n")
-        f.write(content["summary"])
+    def __init__(self, directory: str, state_file: str):
+        self.directory = directory
+        self.state_file = state_file
+        self.lock = threading.Lock()
+        self.files = 0
+        self.pending_changes = 0
+        self.last_update: Optional[str] = None
+        self.supersummaries: List[List[str]] = []
+        self.stale = True
+        # Supersummaries are only refreshed when someone asks for them
+        self.refresh_requested = threading.Event()
+        self.refreshed = threading.Event()
 
-        if "modernisation_recommendations" in content:
-            f.write("\n\n## Modernisation Recommendations:\n\n")
-            f.write(content["modernisation_recommendations"])
 
+def create_watch_handler(status: WatchStatus) -> Any:
+    class WatchHandler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format: str, *args: Any):
+            pass
 
-def save_to_markdown(
-    results: Dict[str, Dict[str, str]], output_file: str, config: Dict[str, Any]
-):
-    with open(output_file, "w", encoding="utf-8") as f:
-        for file, content in results.items():
-            # Escape any existing # characters in the file path
-            safe_file_path = file.replace("#", "\\#")
-            f.write(f"# File: {safe_file_path}\n\n")
-            f.write("## Summary:\n\n")
-
-            # Split the summary into lines and properly format any list items or code blocks
-            lines = content["summary"].split("\n")
-            in_code_block = False
-            for line in lines:
-                if line.strip().startswith("```"):
-                    in_code_block = not in_code_block
-                    f.write(line + "\n")
-                elif in_code_block:
-                    f.write(line + "\n")
-                else:
-                    # Ensure list items are on their own line
-                    if line.strip().startswith(("- ", "* ", "1. ")):
-                        f.write("\n" + line + "\n")
-                    else:
-                        f.write(line + "\n")
-
-            if "modernisation_recommendations" in content:
-                f.write("\n## Modernisation Recommendations:\n\n")
-                lines = content["modernisation_recommendations"].split("\n")
-                for line in lines:
-                    if line.strip().startswith(("- ", "* ", "1. ")):
-                        f.write("\n" + line + "\n")
+        def send_json(self, code: int, body: Any):
+            data = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            url = urllib.parse.urlparse(self.path)
+            query = urllib.parse.parse_qs(url.query)
+            if url.path == "/status":
+                with status.lock:
+                    self.send_json(
+                        200,
+                        {
+                            "directory": status.directory,
+                            "files": status.files,
+                            "pending_changes": status.pending_changes,
+                            "last_update": status.last_update,
+                            "supersummaries_stale": status.stale,
+                        },
+                    )
+            elif url.path == "/supersummaries":
+                if status.stale:
+                    status.refreshed.clear()
+                    status.refresh_requested.set()
+                    status.refreshed.wait(300)
+                with status.lock:
+                    self.send_json(
+                        200, {"stale": status.stale, "levels": status.supersummaries}
+                    )
+            elif url.path in ("/summaries", "/summary"):
+                # Each request reads the state database over its own connection, as
+                # the watch loop's connection belongs to its thread
+                conn = sqlite3.connect(status.state_file)
+                try:
+                    if url.path == "/summaries":
+                        paths = [
+                            row[0]
+                            for row in conn.execute(
+                                "SELECT path FROM files WHERE result IS NOT NULL ORDER BY path"
+                            )
+                            if row[0].startswith(os.path.join(status.directory, ""))
+                        ]
+                        self.send_json(200, {"files": paths})
+                        return
+                    path = query.get("path", [""])[0]
+                    row = None
+                    for candidate in (path, os.path.join(status.directory, path)):
+                        row = conn.execute(
+                            "SELECT result FROM files WHERE path = ? AND result IS NOT NULL",
+                            (candidate,),
+                        ).fetchone()
+                        if row:
+                            break
+                    if row is None:
+                        self.send_json(404, {"error": f"No summary for {path}"})
                     else:
-                        f.write(line + "\n")
+                        self.send_json(200, {"path": candidate, **json.loads(row[0])})
+                finally:
+                    conn.close()
+            else:
+                self.send_json(
+                    404,
+                    {
+                        "error": "Unknown path",
+                        "paths": ["/status", "/summaries", "/summary?path=", "/supersummaries"],
+                    },
+                )
 
-            f.write("\n---\n\n")
+    return WatchHandler
 
 
-def generate_final_summary(
-    supersummaries: List[str],
-    bedrock_client: Any,
-    config: Dict[str, Any],
-) -> str:
-    context = "\n\n".join(
-        [f"Supersummary {i+1}:\n{summary}" for i, summary in enumerate(supersummaries)]
+def watch_directory(
+    config: Dict[str, Any], args: argparse.Namespace, output_dir: str, timestamp: str
+) -> UsageTracker:
+    # One long-running process keeps the clients, index and state loaded, polls the
+    # tree for changes and re-summarises just the files that changed
+    stage_clients = create_stage_clients(config, ["files", "summaries"])
+    file_client = stage_clients["files"]
+    summary_client = stage_clients["summaries"]
+    file_config = stage_config(config, "files")
+    summary_config = stage_config(config, "summaries")
+    directory = config["directory"]
+    state_file = os.path.join(output_dir, "treesummary_state.db")
+    supersummary_file = os.path.join(output_dir, f"supersummary_{timestamp}.md")
+
+    cache = open_summary_cache(config, args, output_dir)
+    store = StateStore(state_file)
+    if config["restart"] or config["clear_state"]:
+        store.clear()
+        print("State file cleared.")
+    state = store.load()
+    state["last_directory"] = directory
+    store.set_last_directory(directory)
+    sink = MarkdownSink(
+        os.path.join(output_dir, f"summary_output_{timestamp}.md"),
+        (
+            os.path.join(output_dir, f"summaries_{timestamp}")
+            if config.get("save_individual_summaries")
+            else None
+        ),
     )
 
-    conversation = [
-        {
-            "role": "user",
-            "content": [{"text": f"{config['final_summary_prompt']}\n\n{context}"}],
-        }
-    ]
+    status = WatchStatus(directory, state_file)
+    host = config.get("watch_host", "127.0.0.1")
+    port = config.get("watch_port", 8765)
+    server = http.server.ThreadingHTTPServer((host, port), create_watch_handler(status))
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving summaries on http://{host}:{port}/")
 
-    try:
-        response = bedrock_client.converse(
-            modelId=config["model_id"],
-            messages=conversation,
-            system=[{"text": config["system_prompt"]}],
-            inferenceConfig={
-                "maxTokens": config["final_summary_max_tokens"],
-                "temperature": config["temperature"],
-                "topP": config["top_p"],
-            },
-        )
+    def summarise_changes(index: FileIndex, files: List[str], project_tree: str):
+        deleted = remove_deleted_files(index.files, state, store, directory)
+        changed = []
+        for file_path in files:
+            try:
+                if hash_file(file_path) != state["file_hashes"].get(file_path):
+                    changed.append(file_path)
+            except OSError:
+                continue
+        changed += [f for f in stale_copies(changed, state) if f in index.stats]
+        if changed:
+            with METRICS.timer("dedup"):
+                changed, state["duplicates"] = find_duplicates(changed, file_config)
+            summarise_files(
+                changed,
+                file_client,
+                file_config,
+                store,
+                state,
+                sink,
+                cache,
+                index,
+                project_tree,
+            )
+        if changed or deleted:
+            with status.lock:
+                status.stale = True
+                status.last_update = datetime.now().isoformat(timespec="seconds")
+            print(
+                f"Updated {len(changed)} changed and {len(deleted)} deleted files at {status.last_update}."
+            )
 
-        response_text = response["output"]["message"]["content"][0]["text"]
-        return response_text
+    def refresh():
+        METRICS.stage = "supersummaries"
+        try:
+            levels = refresh_supersummaries(
+                index.files,
+                state,
+                summary_client,
+                summary_config,
+                complete_only=False,
+                index=index,
+            )
+        except BudgetExceededError as e:
+            # The watch loop stops once the budget is reached
+            store.save_outputs(state, directory)
+            print(f"Reached the budget ({e}), not refreshing the supersummaries.")
+            status.refreshed.set()
+            return
+        store.save_outputs(state, directory)
+        if levels:
+            save_supersummaries(levels, supersummary_file)
+        with status.lock:
+            status.supersummaries = levels
+            status.stale = False
+        status.refreshed.set()
 
-    except ClientError as e:
-        print(f"ERROR: Can't invoke '{config['model_id']}'. Reason: {e}")
-        return f"Error generating final summary: {e}"
+    index, project_tree = index_directory(config)
+    latest = index
+    with status.lock:
+        status.files = len(index.files)
+    summarise_changes(index, get_changed_files(index, state, None), project_tree)
 
+    interval = config.get("watch_interval_seconds", 2)
+    debounce = config.get("watch_debounce_seconds", 2)
+    pending: Set[str] = set()
+    last_change = time.monotonic()
+    print(f"Watching {directory} for changes. Press Ctrl+C to stop.")
+    try:
+        while not file_client.usage.budget_exceeded():
+            requested = status.refresh_requested.wait(interval)
+            status.refresh_requested.clear()
 
-def main():
-    parser = argparse.ArgumentParser(description="Code Summarisation Tool")
-    parser.add_argument("directory", help="Path to the project directory")
-    parser.add_argument(
-        "--config",
-        default=os.path.join(os.path.dirname(__file__), "config.json"),
-        help="Path to the configuration file",
-    )
-    parser.add_argument(
-        "--clear-state",
-        action="store_true",
-        help="Clear the state and restart processing",
-    )
-    parser.add_argument(
-        "--restart",
-        action="store_true",
-        help="Restart processing from the beginning",
-    )
-    args = parser.parse_args()
+            with METRICS.timer("scan"):
+                scanned = scan_directory(directory, config)
+            changes = {
+                f for f in scanned.files if scanned.stats[f] != latest.stats.get(f)
+            } | {f for f in latest.files if f not in scanned.stats}
+            latest = scanned
+            if changes:
+                pending |= changes
+                last_change = time.monotonic()
+                with status.lock:
+                    status.pending_changes = len(pending)
 
-    with open(args.config, "r") as config_file:
-        config = json.load(config_file)
+            # A burst of saves is handled once it has settled down
+            if pending and time.monotonic() - last_change >= debounce:
+                file_set_changed = set(scanned.files) != set(index.files)
+                if config.get("dependency_graph", True):
+                    if not file_set_changed:
+                        scanned.dependencies = index.dependencies
+                        scanned.dependents = index.dependents
+                        build_dependency_graph(scanned, pending)
+                    else:
+                        build_dependency_graph(scanned)
+                # The tree only lists paths, so edits alone keep the cached prefix
+                if file_set_changed:
+                    project_tree = scanned.tree_text(
+                        config.get("project_tree_depth", 3),
+                        config.get("project_tree_token_budget", 2000),
+                    )
+                index = scanned
+                summarise_changes(
+                    index, [f for f in sorted(pending) if f in index.stats], project_tree
+                )
+                pending = set()
+                with status.lock:
+                    status.files = len(index.files)
+                    status.pending_changes = 0
 
-    config["directory"] = args.directory
-    config["clear_state"] = args.clear_state
-    config["restart"] = args.restart
+            if requested:
+                refresh()
+        print(
+            f"Reached the ${file_client.usage.max_cost:.2f} budget, no longer watching."
+        )
+    except KeyboardInterrupt:
+        print("Stopped watching.")
+    finally:
+        server.shutdown()
+        server.server_close()
+        status.refreshed.set()
+        sink.close()
+        store.close()
+    return file_client.usage
 
+
+def process_directory(
+    config: Dict[str, Any], args: argparse.Namespace, output_dir: str, timestamp: str
+) -> UsageTracker:
     file_limit = config.get("limit")
     if file_limit == 0:
         file_limit = None
 
-    bedrock_client = boto3.client(
-        service_name="bedrock-runtime",
-        region_name=config["aws_region"],
-        config=Config(retries={"max_attempts": 5, "mode": "standard"}),
-    )
+    # Per-file summaries and the summaries built from them can use different backends
+    # and models, configured under backends.files and backends.summaries
+    stage_clients = create_stage_clients(config, ["files", "summaries"])
+    file_client = stage_clients["files"]
+    summary_client = stage_clients["summaries"]
+    file_config = stage_config(config, "files")
+    summary_config = stage_config(config, "summaries")
 
-    timestamp = datetime.now().strftime("%Y%m%d-%H%M")
-    output_dir = os.path.join(os.path.dirname(__file__), "output")
-    os.makedirs(output_dir, exist_ok=True)
     output_file = os.path.join(output_dir, f"summary_output_{timestamp}.md")
+    index_file = os.path.join(output_dir, f"summary_index_{timestamp}.md")
+    individual_summaries_dir = os.path.join(output_dir, f"summaries_{timestamp}")
     supersummary_file = os.path.join(output_dir, f"supersummary_{timestamp}.md")
     final_summary_file = os.path.join(output_dir, f"final_summary_{timestamp}.md")
     modernisation_summary_file = os.path.join(
         output_dir, f"modernisation_summary_{timestamp}.md"
     )
-    state_file = os.path.join(output_dir, "treesummary_state.pkl")
+    state_file = os.path.join(output_dir, "treesummary_state.db")
+    legacy_state_file = os.path.join(output_dir, "treesummary_state.pkl")
 
-    if config["restart"] or config["clear_state"]:
-        if os.path.exists(state_file):
-            os.remove(state_file)
+    cache = open_summary_cache(config, args, output_dir)
+
+    if args.dry_run:
+        # A dry run only reads the state, and with --restart starts from an empty one
+        store = StateStore(
+            ":memory:" if config["restart"] or config["clear_state"] else state_file,
+            read_only=True,
+        )
+    else:
+        store = StateStore(state_file, shared=args.coordinator)
+        if config["restart"] or config["clear_state"]:
+            store.clear()
+            if os.path.exists(legacy_state_file):
+                os.remove(legacy_state_file)
             print("State file cleared.")
+        elif os.path.exists(legacy_state_file):
+            print(f"Importing processed files from {legacy_state_file}.")
+            store.import_legacy_state(legacy_state_file)
+            os.remove(legacy_state_file)
 
-    all_files = get_files_to_process(
-        config["directory"], config["file_extensions"], config.get("ignore_paths", [])
-    )
+    index, project_tree = index_directory(config)
+    all_files = index.files
     total_files = len(all_files)
     print(f"Total files found to process: {total_files}")
 
-    if not config["restart"] and os.path.exists(state_file):
-        state = load_state(state_file)
+    # Summaries from earlier runs are loaded back so that supersummaries and the
+    # final outputs still cover files processed before a restart
+    state = store.load()
+    deleted_files = (
+        []
+        if args.dry_run
+        else remove_deleted_files(all_files, state, store, config["directory"])
+    )
+    if deleted_files:
+        print(f"Dropping {len(deleted_files)} deleted files from the saved state.")
+
+    if args.incremental or args.since:
+        files_to_process = get_changed_files(index, state, args.since)
+        print(
+            f"Incremental processing of {len(files_to_process)} changed or new files. {len(all_files) - len(files_to_process)} files unchanged."
+        )
+    elif state["processed_files"]:
         processed_files = state["processed_files"]
         files_to_process = [f for f in all_files if f not in processed_files]
         print(
@@ -555,31 +4592,118 @@ def main():
         files_to_process = all_files
         print(f"Starting fresh processing of {len(files_to_process)} files.")
 
-    supersummaries = []
-    all_summaries = {}
+    if args.dry_run:
+        with METRICS.timer("dedup"):
+            files_to_process, duplicates = find_duplicates(files_to_process, file_config)
+        if duplicates:
+            print(
+                f"Skipping {sum(len(d) for d in duplicates.values())} duplicate or near-duplicate files."
+            )
+        print_estimate(
+            estimate_run(files_to_process, file_config, index, project_tree),
+            file_config,
+        )
+        store.close()
+        return file_client.usage
+
+    state["last_directory"] = config["directory"]
+    store.set_last_directory(config["directory"])
+
+    sink = MarkdownSink(
+        output_file,
+        individual_summaries_dir if config.get("save_individual_summaries") else None,
+    )
+    budget_reached = False
+    if args.coordinator:
+        # Workers summarise the files, this process only publishes them and then
+        # reduces the results
+        batch = files_to_process[:file_limit] if file_limit else files_to_process
+        if len(batch) < len(files_to_process):
+            print(
+                f"Publishing the first {len(batch)} of {len(files_to_process)} files to process (limit). Run the coordinator again to publish the rest."
+            )
+        files_to_process = []
+        with METRICS.timer("dedup"):
+            batch, duplicates = find_duplicates(batch, file_config)
+        print_estimate(estimate_run(batch, file_config, index, project_tree), file_config)
+        queue = WorkQueue(state_file, *queue_settings(config))
+        work_items = plan_work_items(batch, file_config, index)
+        queue.publish(
+            config["directory"],
+            work_items,
+            duplicates,
+            project_tree,
+            [index.context_for(item) for item in work_items],
+        )
+        print(
+            f"Published {len(work_items)} work items. Start workers by running with --worker against the same directory and output_dir."
+        )
+        wait_for_workers(queue, config.get("queue_poll_seconds", 10))
+        queue.close()
+        state = store.load()
+
     while files_to_process:
         batch = files_to_process[:file_limit] if file_limit else files_to_process
         files_to_process = files_to_process[file_limit:] if file_limit else []
 
         print(f"Processing batch of {len(batch)} files.")
-        estimated_tokens = run_ingest(batch)
-        if estimated_tokens > 0:
-            print(f"Estimated total tokens for this batch: {estimated_tokens}")
+        with METRICS.timer("dedup"):
+            batch, state["duplicates"] = find_duplicates(batch, file_config)
+        duplicate_count = sum(len(d) for d in state["duplicates"].values())
+        if duplicate_count:
+            print(
+                f"Found {duplicate_count} duplicate or near-duplicate files, summarising {len(batch)} files and sharing their summaries."
+            )
+        with METRICS.timer("estimate"):
+            estimate = estimate_run(batch, file_config, index, project_tree)
+        print_estimate(estimate, file_config)
+        input_cost = estimate_cost(estimate, file_config, include_output=False)
+        max_cost = config.get("max_cost_usd")
+        if (
+            max_cost
+            and input_cost is not None
+            and file_client.usage.cost + input_cost > max_cost
+        ):
+            print(
+                f"The input tokens alone would exceed the ${max_cost:.2f} budget, not starting this batch."
+            )
+            budget_reached = True
+            break
 
-        summaries = process_batch(batch, bedrock_client, config, state_file)
-        all_summaries.update(summaries)
-        save_to_markdown(summaries, output_file, config)
+        summarise_files(
+            batch,
+            file_client,
+            file_config,
+            store,
+            state,
+            sink,
+            cache,
+            index,
+            project_tree,
+        )
         print(f"Results have been saved to {output_file}")
+        if file_client.usage.budget_exceeded():
+            budget_reached = True
+            break
 
-        if config.get("supersummary_interval") and (
-            len(all_summaries) % config["supersummary_interval"] == 0
-        ):
-            print("Generating supersummary...")
-            supersummary = summarise_summaries(all_summaries, bedrock_client, config)
-            supersummaries.append(supersummary)
-            with open(supersummary_file, "a") as f:
-                f.write(f"# Supersummary\n\n{supersummary}\n\n---\n\n")
-            print(f"Supersummary has been appended to {supersummary_file}")
+        METRICS.stage = "supersummaries"
+        try:
+            supersummary_levels = refresh_supersummaries(
+                all_files,
+                state,
+                summary_client,
+                summary_config,
+                complete_only=True,
+                index=index,
+            )
+        except BudgetExceededError:
+            store.save_outputs(state, config["directory"])
+            budget_reached = True
+            break
+        store.save_outputs(state, config["directory"])
+        if supersummary_levels:
+            save_supersummaries(supersummary_levels, supersummary_file)
+            print(f"Supersummaries have been saved to {supersummary_file}")
 
         if files_to_process and file_limit:
             continue_processing = (
@@ -591,24 +4715,248 @@ def main():
             if not continue_processing:
                 break
 
-    state = load_state(state_file)
+    sink.close()
     print(f"Total files processed: {len(state['processed_files'])}")
+    save_indexed_markdown(store, all_files, index_file)
+    print(f"Indexed summary of all files has been saved to {index_file}")
+    if cache is not None:
+        print(cache.stats())
+    usage = file_client.usage
+    print(
+        f"Used {usage.input_tokens:,} input and {usage.output_tokens:,} output tokens (${usage.cost:.2f})."
+    )
+    if usage.cache_read_tokens or usage.cache_write_tokens:
+        print(
+            f"Prompt cache: {usage.cache_write_tokens:,} tokens written, {usage.cache_read_tokens:,} tokens read."
+        )
+    # Stages with the same settings share a client, which is reported once for them all
+    client_stages: Dict[int, Tuple[RateLimitedClient, List[str]]] = {}
+    for stage, client in stage_clients.items():
+        client_stages.setdefault(id(client), (client, []))[1].append(stage)
+    for client, stages in client_stages.values():
+        name = " and ".join(stages)
+        if client.limiter.throttle_count:
+            print(
+                f"The {name} backend was throttled {client.limiter.throttle_count} times, settled at {client.limiter.concurrency} concurrent requests."
+            )
+        if client.hedges or client.timeouts:
+            print(
+                f"The {name} backend was sent {client.hedges} hedged requests and timed out {client.timeouts} times."
+            )
+
+    if budget_reached:
+        print(
+            f"Reached the ${usage.max_cost:.2f} budget, skipping the supersummaries and final outputs. Re-run to resume."
+        )
+        store.close()
+        return file_client.usage
+
+    # The budget is checked before every request, so it can also run out part way
+    # through the summaries. What has been generated so far is kept for the next run.
+    try:
+        METRICS.stage = "supersummaries"
+        supersummary_levels = refresh_supersummaries(
+            all_files,
+            state,
+            summary_client,
+            summary_config,
+            complete_only=False,
+            index=index,
+        )
+        store.save_outputs(state, config["directory"])
+        if supersummary_levels:
+            save_supersummaries(supersummary_levels, supersummary_file)
+            print(f"Supersummaries have been saved to {supersummary_file}")
+
+        # The final outputs consume the top of the supersummary tree rather than every
+        # file summary, falling back to the file summaries for very small runs
+        if supersummary_levels:
+            top_summaries = supersummary_levels[-1]
+        else:
+            top_summaries = [
+                f"File: {f}\n{summary_text(state['summaries'][f], state['summaries'])}"
+                for f in sorted(all_files)
+                if f in state["summaries"]
+            ]
+
+        if config.get("generate_final_summary") == True:
+            print("Generating final summary...")
+            METRICS.stage = "final_summary"
+            final_summary = reuse_or_generate(
+                state,
+                config["directory"],
+                "final_summary",
+                [summary_config["model_id"], config["final_summary_prompt"]]
+                + top_summaries,
+                lambda: call_with_backoff(
+                    summary_config,
+                    generate_final_summary,
+                    top_summaries,
+                    summary_client,
+                    summary_config,
+                ),
+            )
+            store.save_outputs(state, config["directory"])
+            if final_summary is not None:
+                with METRICS.timer("output_write"), open(final_summary_file, "w") as f:
+                    f.write(f"# Final Summary\n\n{final_summary}")
+                print(f"Final summary has been saved to {final_summary_file}")
+
+        if config.get("generate_modernisation_summary") == True:
+            print("Generating modernisation summary...")
+            METRICS.stage = "modernisation_summary"
+            modernisation_summary = reuse_or_generate(
+                state,
+                config["directory"],
+                "modernisation_summary",
+                [summary_config["model_id"], config["modernisation_summary_prompt"]]
+                + top_summaries,
+                lambda: call_with_backoff(
+                    summary_config,
+                    generate_modernisation_summary,
+                    top_summaries,
+                    summary_client,
+                    summary_config,
+                ),
+            )
+            store.save_outputs(state, config["directory"])
+            if modernisation_summary is not None:
+                with METRICS.timer("output_write"), open(modernisation_summary_file, "w") as f:
+                    f.write(f"# Modernisation Summary\n\n{modernisation_summary}")
+                print(f"Modernisation summary has been saved to {modernisation_summary_file}")
+
+    except BudgetExceededError as e:
+        store.save_outputs(state, config["directory"])
+        print(
+            f"Reached the ${usage.max_cost:.2f} budget ({e}) before the summaries were finished. Re-run to resume."
+        )
+    store.close()
+    return file_client.usage
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Code Summarisation Tool")
+    parser.add_argument("directory", help="Path to the project directory")
+    parser.add_argument(
+        "--config",
+        default=os.path.join(os.path.dirname(__file__), "config.json"),
+        help="Path to the configuration file",
+    )
+    parser.add_argument(
+        "--clear-state",
+        action="store_true",
+        help="Clear the state and restart processing",
+    )
+    parser.add_argument(
+        "--restart",
+        action="store_true",
+        help="Restart processing from the beginning",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Don't read or write the summary cache",
+    )
+    parser.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Only re-summarise files whose content changed since the last run",
+    )
+    parser.add_argument(
+        "--since",
+        metavar="GIT_REF",
+        help="Only re-summarise files changed since the given git ref (implies --incremental)",
+    )
+    parser.add_argument(
+        "--dry-run",
+        action="store_true",
+        help="Estimate the tokens and cost of the run without calling the model",
+    )
+    parser.add_argument(
+        "--profile",
+        action="store_true",
+        help="Profile the run with cProfile and save the stats to the output directory",
+    )
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Summarise files with a Bedrock batch inference job (overrides batch_inference)",
+    )
+    parser.add_argument(
+        "--max-cost",
+        type=float,
+        help="Stop the run once this many US dollars have been spent (overrides max_cost_usd)",
+    )
+    parser.add_argument(
+        "--coordinator",
+        action="store_true",
+        help="Publish the files to a work queue in the output directory for workers to summarise, then build the final outputs",
+    )
+    parser.add_argument(
+        "--worker",
+        action="store_true",
+        help="Summarise files from the work queue published by a coordinator",
+    )
+    parser.add_argument(
+        "--watch",
+        action="store_true",
+        help="Keep running, re-summarising files as they change and serving the summaries over HTTP",
+    )
+    parser.add_argument(
+        "--worker-id",
+        help="Name of this worker in the work queue (default: hostname and process ID)",
+    )
+    args = parser.parse_args()
+
+    with open(args.config, "r") as config_file:
+        config = json.load(config_file)
+
+    config["directory"] = args.directory
+    config["clear_state"] = args.clear_state
+    config["restart"] = args.restart
+    if args.max_cost is not None:
+        config["max_cost_usd"] = args.max_cost
+    if args.batch:
+        config["batch_inference"] = True
+
+    timestamp = datetime.now().strftime("%Y%m%d-%H%M%S")
+    if args.worker:
+        # Workers share an output directory, so their files are named after them
+        args.worker_id = args.worker_id or f"{socket.gethostname()}-{os.getpid()}"
+        timestamp = f"{timestamp}_{args.worker_id}"
+    output_dir = config.get("output_dir") or os.path.join(
+        os.path.dirname(__file__), "output"
+    )
+    os.makedirs(output_dir, exist_ok=True)
+    # Runs started within the same second still get their own outputs and report
+    if glob.glob(os.path.join(output_dir, f"*_{glob.escape(timestamp)}.*")):
+        timestamp = f"{timestamp}-{os.getpid()}"
+    METRICS.open_call_log(os.path.join(output_dir, f"run_report_{timestamp}.csv"))
+
+    # The profiler only sees the main thread: scanning, planning, result handling
+    # and output, plus the requests themselves when parallel is 1
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    try:
+        if args.worker:
+            usage = run_worker(config, args, output_dir, timestamp)
+        elif args.watch:
+            usage = watch_directory(config, args, output_dir, timestamp)
+        else:
+            usage = process_directory(config, args, output_dir, timestamp)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            profile_file = os.path.join(output_dir, f"profile_{timestamp}.prof")
+            profiler.dump_stats(profile_file)
+            with open(os.path.join(output_dir, f"profile_{timestamp}.txt"), "w") as f:
+                pstats.Stats(profiler, stream=f).sort_stats("cumulative").print_stats(50)
+            print(f"Profile has been saved to {profile_file}")
 
-    if config.get("generate_final_summary") == True:
-        print("Generating final summary...")
-        final_summary = generate_final_summary(supersummaries, bedrock_client, config)
-        with open(final_summary_file, "w") as f:
-            f.write(f"# Final Summary\n\n{final_summary}")
-        print(f"Final summary has been saved to {final_summary_file}")
-
-    if config.get("generate_modernisation_summary") == True:
-        print("Generating modernisation summary...")
-        modernisation_summary = generate_modernisation_summary(
-            all_summaries, bedrock_client, config
-        )
-        with open(modernisation_summary_file, "w") as f:
-            f.write(f"# Modernisation Summary\n\n{modernisation_summary}")
-        print(f"Modernisation summary has been saved to {modernisation_summary_file}")
+    report_file = os.path.join(output_dir, f"run_report_{timestamp}.json")
+    METRICS.write_report(usage, report_file)
+    print(f"Run report has been saved to {report_file}")
 
 
 if __name__ == "__main__":